@@ -0,0 +1,312 @@
+import os
+import csv
+import json
+import time
+import datetime
+import argparse
+import importlib
+import traceback
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from constants import BATCH_OUTPUT, MAX_CONCURRENT_VENDORS, QUESTION_SETS, REASSESS
+from cache_code import SQLiteStore
+from llm_code import Profile, build_graph, iter_assessment, ask_llm, assessment_key
+from prompt_code import make_summary_prompt
+from reporting_code import (
+    summary_markdown,
+    StreamingReport,
+    report_confidence,
+    calculate_token_counts,
+    token_count_markdown,
+    calculate_latencies,
+    latency_markdown,
+)
+from token_code import token_ledger
+from trace_code import tracer
+
+
+def load_profiles(path):
+    """
+    Load the profiles to assess from a CSV file with company, product and url columns,
+    a JSON list, or a JSON lines file.
+    """
+    with open(path, "r", encoding="utf-8") as f:
+        if path.endswith(".csv"):
+            rows = list(csv.DictReader(f))
+        elif path.endswith(".jsonl"):
+            rows = [json.loads(line) for line in f if line.strip()]
+        else:
+            rows = json.load(f)
+
+    profiles = []
+    for row in rows:
+        profile = Profile(
+            {key: (row.get(key) or "").strip() for key in ["company", "product", "url"]}
+        )
+        if not profile["company"] or not profile["url"]:
+            print(f"! Skipping profile without company or url: {row}")
+            continue
+        profiles.append(profile)
+    return profiles
+
+
+class BatchState(SQLiteStore):
+    """Status of each vendor of a batch, used to resume the batch where it stopped"""
+
+    schema = [
+        """CREATE TABLE IF NOT EXISTS vendors (
+            assessment TEXT PRIMARY KEY,
+            company TEXT,
+            product TEXT,
+            url TEXT,
+            status TEXT NOT NULL,
+            started TEXT,
+            finished TEXT,
+            seconds REAL,
+            answers INTEGER,
+            llm_calls INTEGER,
+            tokens INTEGER,
+            cost REAL,
+            error TEXT
+        )"""
+    ]
+
+    def statuses(self):
+        rows = self.connection.execute("SELECT assessment, status FROM vendors")
+        return dict(rows.fetchall())
+
+    def start(self, profile):
+        with self.transaction() as connection:
+            connection.execute(
+                """INSERT OR REPLACE INTO vendors (assessment, company, product, url, status, started)
+                VALUES (?, ?, ?, ?, 'running', ?)""",
+                [
+                    assessment_key(profile),
+                    profile["company"],
+                    profile["product"],
+                    profile["url"],
+                    datetime.datetime.now().isoformat(timespec="seconds"),
+                ],
+            )
+
+    def finish(self, profile, status, **results):
+        with self.transaction() as connection:
+            connection.execute(
+                """UPDATE vendors SET status = ?, finished = ?, seconds = ?, answers = ?,
+                llm_calls = ?, tokens = ?, cost = ?, error = ? WHERE assessment = ?""",
+                [
+                    status,
+                    datetime.datetime.now().isoformat(timespec="seconds"),
+                    results.get("seconds"),
+                    results.get("answers"),
+                    results.get("llm_calls"),
+                    results.get("tokens"),
+                    results.get("cost"),
+                    results.get("error"),
+                    assessment_key(profile),
+                ],
+            )
+
+    def rows(self):
+        cursor = self.connection.execute("SELECT * FROM vendors ORDER BY started")
+        columns = [column[0] for column in cursor.description]
+        return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+
+def write_report(directory, name, content):
+    with open(os.path.join(directory, name), "w", encoding="utf-8") as f:
+        f.write(content)
+
+
+def assess_vendor(profile, graph, questions_module, output_dir, reassess=REASSESS):
+    """
+    Assess one vendor and write its reports. The answers are written to report.md and
+    report.jsonl as they arrive. Returns the results recorded in the batch state.
+    """
+    key = assessment_key(profile)
+    vendor_dir = os.path.join(output_dir, key)
+    os.makedirs(vendor_dir, exist_ok=True)
+
+    start = time.perf_counter()
+    questions = questions_module.prepare_questions(profile)
+    answers = []
+    with StreamingReport(vendor_dir, profile) as report:
+        for row in iter_assessment(questions, profile, graph, reassess=reassess):
+            report.write(row)
+            answers.append(row)
+    answers.sort(key=lambda row: [int(n) for n in row["number"].split(".")])
+
+    summary = ask_llm(make_summary_prompt(answers, profile))
+    write_report(vendor_dir, "summary.md", summary_markdown(summary, profile))
+    confidence_report, _ = report_confidence(answers, profile)
+    write_report(vendor_dir, "confidence.md", confidence_report)
+    token_report = calculate_token_counts(profile)
+    write_report(vendor_dir, "tokens.md", token_count_markdown(token_report))
+    write_report(vendor_dir, "latency.md", latency_markdown(calculate_latencies(profile)))
+    # The trace is exported and reported, its spans are not kept for the rest of the batch
+    trace = tracer.find_trace("assessment", assessment=key)
+    if trace:
+        tracer.drop(trace)
+    write_report(
+        vendor_dir,
+        "answers.json",
+        json.dumps(
+            [{**row, "answer": row["answer"].model_dump()} for row in answers],
+            indent=2,
+            ensure_ascii=False,
+        ),
+    )
+
+    usage = token_ledger.totals(group_by="model", assessment=key)
+    return {
+        "seconds": time.perf_counter() - start,
+        "answers": len(answers),
+        "llm_calls": sum(u["calls"] for u in usage.values()),
+        "tokens": sum(u["total"] for u in usage.values()),
+        "cost": token_report["total_costs"],
+    }
+
+
+def run_batch(
+    profiles,
+    questions="sample",
+    output_dir=BATCH_OUTPUT,
+    max_workers=MAX_CONCURRENT_VENDORS,
+    retry_failed=True,
+    reassess=REASSESS,
+):
+    """
+    Assess several vendors concurrently, writing the reports of each vendor in its own directory.
+
+    The download, search and answer caches are shared by all the vendors, and the LLM calls and
+    page fetches are limited globally. A vendor that fails doesn't stop the others. Vendors already
+    done in output_dir are skipped, so an interrupted batch resumes where it stopped.
+
+    :param profiles: List of profiles with company, product and url
+    :param questions: Name of the question set, from QUESTION_SETS
+    :param retry_failed: Assess again the vendors that failed in a previous run (default: True)
+    :param reassess: Only ask again the cached answers whose sources changed, see perform_assessment
+    :return: Batch summary, as returned by batch_summary
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    state = BatchState(os.path.join(output_dir, "batch.sqlite"))
+    questions_module = importlib.import_module(QUESTION_SETS[questions])
+    graph = build_graph()
+
+    statuses = state.statuses()
+    skipped = {"done"} if retry_failed else {"done", "failed"}
+    todo = []
+    for profile in profiles:
+        key = assessment_key(profile)
+        if statuses.get(key) in skipped:
+            print(f"* Skipping {key}, already {statuses[key]}")
+        elif key not in [assessment_key(p) for p in todo]:
+            todo.append(profile)
+
+    def assess(profile):
+        state.start(profile)
+        try:
+            results = assess_vendor(
+                profile, graph, questions_module, output_dir, reassess
+            )
+        except Exception as e:
+            print(f"! Assessment of {assessment_key(profile)} failed: {e}")
+            state.finish(profile, "failed", error=traceback.format_exc())
+            return
+        state.finish(profile, "done", **results)
+        print(f"* Assessment of {assessment_key(profile)} done in {results['seconds']:0.1f}s")
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        # Each vendor runs in its own context, keeping its token ledger assessment and trace
+        futures = [
+            executor.submit(contextvars.copy_context().run, assess, profile)
+            for profile in todo
+        ]
+        for future in as_completed(futures):
+            future.result()
+
+    summary = batch_summary(state.rows(), time.perf_counter() - start, todo)
+    write_report(output_dir, "batch_summary.md", batch_summary_markdown(summary))
+    write_report(output_dir, "batch_summary.json", json.dumps(summary, indent=2))
+    return summary
+
+
+def batch_summary(rows, wall_time, assessed):
+    """
+    Costs of a batch over all the vendors recorded in its state, and throughput of this run
+
+    :param assessed: Profiles assessed by this run, the others were done by previous runs
+    """
+    done = [row for row in rows if row["status"] == "done"]
+    keys = {assessment_key(profile) for profile in assessed}
+    done_now = [row for row in done if row["assessment"] in keys]
+    total_cost = sum(row["cost"] or 0 for row in done)
+    return {
+        "vendors": len(rows),
+        "done": len(done),
+        "failed": len([row for row in rows if row["status"] == "failed"]),
+        "wall_time": wall_time,
+        "assessed": len(done_now),
+        "vendors_per_hour": len(done_now) / wall_time * 3600 if wall_time else 0,
+        "total_cost": total_cost,
+        "cost_per_vendor": total_cost / len(done) if done else 0,
+        "llm_calls": sum(row["llm_calls"] or 0 for row in done),
+        "tokens": sum(row["tokens"] or 0 for row in done),
+        "rows": rows,
+    }
+
+
+def batch_summary_markdown(summary):
+    report = f"""# Batch Summary
+* Vendors: {summary['vendors']} ({summary['done']} done, {summary['failed']} failed)
+* This run: {summary['assessed']} vendors assessed in {summary['wall_time']:0.1f}s ({summary['vendors_per_hour']:0.1f} vendors per hour)
+* Total costs: {summary['total_cost']:0.2f}$ ({summary['cost_per_vendor']:0.2f}$ per vendor)
+* LLM calls: {summary['llm_calls']}
+* Tokens: {summary['tokens']}
+
+| Vendor | Status | Time (s) | Answers | LLM calls | Tokens | Cost |
+|---|---|---|---|---|---|---|
+"""
+    for row in summary["rows"]:
+        vendor = f"{row['company']} {row['product']}".strip()
+        if row["status"] != "done":
+            report += f"| {vendor} | {row['status']} | | | | | |\n"
+            continue
+        report += f"| {vendor} | {row['status']} | {row['seconds']:0.1f} | {row['answers']} | {row['llm_calls']} | {row['tokens']} | {row['cost']:0.2f}$ |\n"
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Assess a batch of vendors")
+    parser.add_argument("profiles", help="CSV, JSON or JSON lines file of company, product and url")
+    parser.add_argument("--questions", choices=list(QUESTION_SETS), default="sample")
+    parser.add_argument("--output", default=BATCH_OUTPUT)
+    parser.add_argument("--workers", type=int, default=MAX_CONCURRENT_VENDORS)
+    parser.add_argument(
+        "--skip-failed",
+        action="store_true",
+        help="Don't assess again the vendors that failed in a previous run",
+    )
+    parser.add_argument(
+        "--reassess",
+        action="store_true",
+        default=REASSESS,
+        help="Only ask again the cached answers whose sources changed, expired or have a low confidence",
+    )
+    args = parser.parse_args()
+
+    summary = run_batch(
+        load_profiles(args.profiles),
+        questions=args.questions,
+        output_dir=args.output,
+        max_workers=args.workers,
+        retry_failed=not args.skip_failed,
+        reassess=args.reassess,
+    )
+    print(batch_summary_markdown(summary))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,594 @@
+import os
+import re
+import sys
+import glob
+import json
+import time
+import shutil
+import hashlib
+import difflib
+import argparse
+import datetime
+import resource
+import tempfile
+import threading
+import subprocess
+import multiprocessing
+from queue import Empty
+from typing import ClassVar
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+
+# The benchmarks never call the APIs, but the modules check that the keys are set when
+# imported. This must run before constants is imported, also in the spawned processes.
+for name in ["OPENAI_API_KEY", "GOOGLE_API_KEY", "GOOGLE_SEARCH_ENGINE_ID"]:
+    os.environ.setdefault(name, "benchmark")
+
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, HumanMessage, ToolMessage
+from langchain_core.outputs import ChatGeneration, ChatResult
+
+from constants import QUESTION_SETS, PROMPT_CACHE_MIN_TOKENS
+from extract_code import EXTRACTORS, available_extractors, extract_text
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+BENCHMARK_FIXTURES = os.path.join(BENCHMARK_DIR, "benchmark_fixtures")
+HTML_FIXTURES = os.path.join(BENCHMARK_FIXTURES, "html")
+BENCHMARK_RESULTS = os.path.join(BENCHMARK_DIR, "benchmark_results")
+# Date given to the model, so that the prompts of the benchmark are the same every day
+BENCHMARK_DATE = "2025-01-01"
+
+
+def load_html_fixtures(fixture_dir=HTML_FIXTURES):
+    pages = {}
+    for path in sorted(glob.glob(os.path.join(fixture_dir, "*.html"))):
+        with open(path, "r", encoding="utf-8") as f:
+            pages[os.path.basename(path)] = f.read()
+    return pages
+
+
+def peak_rss_kb():
+    # ru_maxrss is in bytes on macOS, and in kilobytes on Linux
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak // 1024 if sys.platform == "darwin" else peak
+
+
+def process_result(process, queue, poll_interval=1):
+    """
+    Wait for the result a benchmark process puts in the queue.
+    Raises a RuntimeError if the process exits without a result, for example after a crash.
+    """
+    while True:
+        try:
+            return queue.get(timeout=poll_interval)
+        except Empty:
+            if process.exitcode is None:
+                continue
+        # The result may have been put just before the process exited
+        try:
+            return queue.get(timeout=poll_interval)
+        except Empty:
+            raise RuntimeError(
+                f"The benchmark process exited with code {process.exitcode} without a result"
+            ) from None
+
+
+def run_extractor(backend, fixture_dir, repeat, queue):
+    """Run one extractor over the fixtures, in its own process so that its peak RSS can be measured"""
+    pages = load_html_fixtures(fixture_dir)
+    extractor = EXTRACTORS[backend]
+    baseline_rss = peak_rss_kb()
+
+    outputs = {name: extractor(html) for name, html in pages.items()}
+
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for html in pages.values():
+            extractor(html)
+    elapsed = time.perf_counter() - start
+
+    queue.put(
+        {
+            "backend": backend,
+            "pages": len(pages) * repeat,
+            "megabytes": sum(len(html.encode("utf-8")) for html in pages.values())
+            * repeat
+            / 1024
+            / 1024,
+            "seconds": elapsed,
+            "peak_rss_kb": peak_rss_kb(),
+            "peak_rss_increase_kb": peak_rss_kb() - baseline_rss,
+            "outputs": outputs,
+        }
+    )
+
+
+def benchmark_extractors(fixture_dir=HTML_FIXTURES, repeat=20):
+    """
+    Compare the HTML extractors over a corpus of saved pages.
+
+    :param fixture_dir: Directory containing the .html fixtures
+    :param repeat: Number of times each page is extracted
+    :return: List of results per extractor, with throughput, peak RSS and differences with BeautifulSoup
+    """
+    context = multiprocessing.get_context("spawn")
+    results = []
+
+    for backend in available_extractors():
+        queue = context.Queue()
+        process = context.Process(
+            target=run_extractor, args=(backend, fixture_dir, repeat, queue)
+        )
+        process.start()
+        results.append(process_result(process, queue))
+        process.join()
+
+    reference = next(r["outputs"] for r in results if r["backend"] == "bs4")
+    for result in results:
+        result["pages_per_second"] = result["pages"] / result["seconds"]
+        result["megabytes_per_second"] = result["megabytes"] / result["seconds"]
+        result["identical_pages"] = 0
+        result["differing_lines"] = 0
+
+        for name, text in result.pop("outputs").items():
+            if text == reference[name]:
+                result["identical_pages"] += 1
+                continue
+
+            diff = difflib.unified_diff(
+                reference[name].splitlines(), text.splitlines(), lineterm="", n=0
+            )
+            result["differing_lines"] += len(
+                [
+                    line
+                    for line in diff
+                    if line[:1] in "+-" and not line.startswith(("+++", "---"))
+                ]
+            )
+
+        result["total_pages"] = len(reference)
+
+    return results
+
+
+def extract_benchmark_markdown(results):
+    report = """# HTML Extraction Benchmark
+
+| Backend | Pages/s | MB/s | Peak RSS (KB) | RSS increase (KB) | Identical pages | Differing lines |
+|---|---|---|---|---|---|---|
+"""
+    for r in results:
+        report += f"| {r['backend']} | {r['pages_per_second']:0.1f} | {r['megabytes_per_second']:0.2f} | {r['peak_rss_kb']} | {r['peak_rss_increase_kb']} | {r['identical_pages']}/{r['total_pages']} | {r['differing_lines']} |\n"
+    return report
+
+
+class ScriptedChatModel(BaseChatModel):
+    """
+    Deterministic stand-in for the chat models, following the script of a typical question.
+
+    With the agent tools bound, the first call searches google for the question, and the next call
+    answers with the beginning of the search results or local extracts. With the Extractions
+    tool bound, as in find_content, it extracts the first capitalized words of each context.
+    Each call waits `latency` seconds, to simulate the API.
+
+    The system prompt and tools of the agent calls are recorded in `prefixes`, to check that
+    they form the same prefix for every question, as needed by the provider prompt caching.
+    Like the provider, calls starting with messages already sent report them as cached input,
+    from PROMPT_CACHE_MIN_TOKENS tokens.
+    """
+
+    model: str = "gpt-4o"
+    latency: float = 0.0
+    tool_names: list = []
+    prefixes: ClassVar[set] = set()
+    # Hashes of the prompts already sent, and of each of their leading messages
+    prompt_cache: ClassVar[set] = set()
+
+    @property
+    def _llm_type(self):
+        return "scripted"
+
+    def bind_tools(self, tools, **kwargs):
+        names = [getattr(t, "name", getattr(t, "__name__", "")) for t in tools]
+        return self.model_copy(update={"tool_names": names})
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        time.sleep(self.latency)
+
+        if "Extractions" in self.tool_names:
+            message = self.extraction_message(messages)
+        else:
+            ScriptedChatModel.prefixes.add(
+                (messages[0].type, str(messages[0].content), tuple(self.tool_names))
+            )
+            message = self.agent_message(messages)
+
+        input_tokens = sum(len(str(m.content)) for m in messages) // 4
+        output_tokens = len(str(message.content) + str(message.tool_calls)) // 4
+        message.usage_metadata = {
+            "input_tokens": input_tokens,
+            "output_tokens": output_tokens,
+            "total_tokens": input_tokens + output_tokens,
+            "input_token_details": {"cache_read": self.cache_read(messages)},
+        }
+        message.response_metadata = {"model_name": self.model}
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    def cache_read(self, messages):
+        """Tokens of the longest run of leading messages already sent with the same tools"""
+        prefix = hashlib.sha256(json.dumps(self.tool_names).encode("utf-8"))
+        tokens = 0
+        cached = 0
+        for m in messages:
+            prefix.update(f"{m.type}\n{m.content}\n{getattr(m, 'tool_calls', '')}".encode("utf-8"))
+            tokens += len(str(m.content)) // 4
+            digest = prefix.hexdigest()
+            if digest in ScriptedChatModel.prompt_cache and tokens >= PROMPT_CACHE_MIN_TOKENS:
+                cached = tokens
+            ScriptedChatModel.prompt_cache.add(digest)
+        return cached
+
+    def extraction_message(self, messages):
+        contexts = re.split(r"\nContext \d+\. ", str(messages[0].content))[1:]
+        extractions = []
+        for i, context in enumerate(contexts):
+            words = []
+            for word in re.findall(r"\b[A-Z][a-z]{3,}\b", context.split("\n", 1)[-1]):
+                if word not in words:
+                    words.append(word)
+            extractions.append({"context": i + 1, "items": words[:3]})
+        return AIMessage(
+            content="",
+            tool_calls=[
+                {
+                    "name": "Extractions",
+                    "args": {"extractions": extractions},
+                    "id": f"extractions_{len(messages)}",
+                }
+            ],
+        )
+
+    def agent_message(self, messages):
+        question = next(
+            (
+                str(m.content)
+                for m in messages
+                if isinstance(m, HumanMessage) and "Question:" in str(m.content)
+            ),
+            "",
+        )
+        question = question.split("Question:", 1)[1].split("\n", 1)[0].strip()
+        sources = [
+            str(m.content)
+            for m in messages
+            if isinstance(m, ToolMessage)
+            or (isinstance(m, HumanMessage) and "Extract:" in str(m.content))
+        ]
+
+        if not sources:
+            return AIMessage(
+                content="",
+                tool_calls=[
+                    {
+                        "name": "search_google",
+                        "args": {"query": question},
+                        "id": f"search_{len(messages)}",
+                    }
+                ],
+            )
+
+        source = sources[-1]
+        url = re.search(r"URL: (\S+)", source)
+        extract = source.split("Extract:", 1)[-1].strip()[:300]
+        return AIMessage(
+            content="",
+            tool_calls=[
+                {
+                    "name": "search_response",
+                    "args": {
+                        "title": question[:60],
+                        "found": 0.75 if url else 0,
+                        "answer": extract or "Not found",
+                        "extract": extract or "Not Found",
+                        "url": url.group(1) if url else "",
+                        "search_queries": [question],
+                    },
+                    "id": f"response_{len(messages)}",
+                }
+            ],
+        )
+
+
+class FixtureSearch:
+    """Stand-in for google_search, ranking the HTML fixtures served locally with BM25"""
+
+    def __init__(self, base_url, fixture_dir=HTML_FIXTURES):
+        from retrieval_code import terms_from_text
+
+        self.pages = []
+        for name, html in load_html_fixtures(fixture_dir).items():
+            self.pages.append(
+                {
+                    "title": name,
+                    "link": f"{base_url}/{name}",
+                    "terms": terms_from_text(extract_text(html)),
+                }
+            )
+        self.calls = 0
+
+    def __call__(self, query, num_results=3, **kwargs):
+        from retrieval_code import bm25_scores, terms_from_text
+
+        self.calls += 1
+        scores = bm25_scores([page["terms"] for page in self.pages], terms_from_text(query))
+        ranking = sorted(range(len(self.pages)), key=lambda i: -scores[i])
+        return [
+            {"title": self.pages[i]["title"], "link": self.pages[i]["link"]}
+            for i in ranking[:num_results]
+        ]
+
+
+def serve_fixtures(fixture_dir=HTML_FIXTURES):
+    """Serve the fixtures on a local HTTP server, counting the requests"""
+
+    class FixtureHandler(SimpleHTTPRequestHandler):
+        requests = 0
+
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, directory=fixture_dir, **kwargs)
+
+        def do_GET(self):
+            FixtureHandler.requests += 1
+            super().do_GET()
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FixtureHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, FixtureHandler
+
+
+def run_assessment(question_set, llm_latency, fixture_dir, queue):
+    """
+    Run an assessment end to end in its own process and working directory, so that the
+    caches start empty and the peak RSS can be measured.
+    """
+    work_dir = tempfile.mkdtemp(prefix="benchmark_")
+    os.chdir(work_dir)
+
+    import llm_code
+    from http_code import host_rate_limiter
+    from token_code import token_ledger
+    from trace_code import tracer
+
+    questions_module = __import__(QUESTION_SETS[question_set])
+
+    server, handler = serve_fixtures(fixture_dir)
+    base_url = f"http://127.0.0.1:{server.server_address[1]}"
+    # The local server is not rate limited, to measure the code rather than the politeness delays
+    host_rate_limiter.host_limits = {"127.0.0.1": {"rate": 1000, "burst": 1000}}
+
+    llm_code.llm = ScriptedChatModel(model=llm_code.MODEL_NAME, latency=llm_latency)
+    llm_code.small_llm = ScriptedChatModel(
+        model=llm_code.SMALL_MODEL_NAME, latency=llm_latency
+    )
+    search = FixtureSearch(base_url, fixture_dir)
+    llm_code.google_search = search
+
+    profile = {
+        "company": "Example Cloud",
+        "product": "Workflow",
+        "url": "http://127.0.0.1/",
+        "date": BENCHMARK_DATE,
+    }
+    questions = questions_module.prepare_questions(profile)
+    prefix_tokens = llm_code.prompt_prefix_tokens(
+        profile, llm_code.extract_domain(profile["url"])
+    )
+    baseline_rss = peak_rss_kb()
+
+    start = time.perf_counter()
+    graph = llm_code.build_graph()
+    ScriptedChatModel.prefixes.clear()
+    ScriptedChatModel.prompt_cache.clear()
+    answers = llm_code.perform_assessment(questions, profile, graph)
+    elapsed = time.perf_counter() - start
+
+    # Every agent call of the assessment must start with the same system prompt and tools
+    prefixes = ScriptedChatModel.prefixes
+    assert len(prefixes) == 1, f"{len(prefixes)} different prompt prefixes in the agent calls"
+    assert next(iter(prefixes))[0] == "system", "The agent calls don't start with the system prompt"
+
+    usage = token_ledger.totals(
+        group_by="model", assessment=llm_code.assessment_key(profile)
+    )
+    # Page tokens returned by each search, within SEARCH_TOKEN_BUDGET
+    trace = tracer.find_trace("assessment", assessment=llm_code.assessment_key(profile))
+    search_tokens = [
+        s["attributes"]["tokens"]
+        for s in tracer.trace_spans(trace)
+        if s["name"] == "tool.search_google" and "tokens" in s["attributes"]
+    ]
+    server.shutdown()
+    os.chdir(BENCHMARK_DIR)
+    shutil.rmtree(work_dir, ignore_errors=True)
+
+    queue.put(
+        {
+            "questions": question_set,
+            "answers": len(answers),
+            "llm_latency": llm_latency,
+            "seconds": elapsed,
+            "llm_calls": sum(u["calls"] for u in usage.values()),
+            "tokens": sum(u["total"] for u in usage.values()),
+            "cached_tokens": sum(u["cached_input"] for u in usage.values()),
+            "prefix_tokens": prefix_tokens,
+            "searches": search.calls,
+            "search_tokens_per_call": sum(search_tokens) / max(1, len(search_tokens)),
+            "search_tokens_max": max(search_tokens, default=0),
+            "pages_fetched": handler.requests,
+            "peak_rss_kb": peak_rss_kb(),
+            "peak_rss_increase_kb": peak_rss_kb() - baseline_rss,
+        }
+    )
+
+
+def benchmark_assessments(
+    question_sets=("sample", "complete"), llm_latency=0.2, fixture_dir=HTML_FIXTURES
+):
+    """
+    Run perform_assessment offline: the real graph and scheduler, with a scripted chat model,
+    a search over the fixtures and a local HTTP server serving them.
+
+    :param question_sets: Names of the question sets to run, from QUESTION_SETS
+    :param llm_latency: Seconds waited by each simulated LLM call
+    :return: List of results per question set
+    """
+    context = multiprocessing.get_context("spawn")
+    results = []
+    for question_set in question_sets:
+        queue = context.Queue()
+        process = context.Process(
+            target=run_assessment, args=(question_set, llm_latency, fixture_dir, queue)
+        )
+        process.start()
+        results.append(process_result(process, queue))
+        process.join()
+    return results
+
+
+def assessment_benchmark_markdown(results):
+    report = """# Offline Assessment Benchmark
+
+| Questions | Answers | Wall time (s) | LLM calls | Tokens | Cached tokens | Searches | Tokens per search (max) | Pages fetched | Peak RSS (KB) |
+|---|---|---|---|---|---|---|---|---|---|
+"""
+    for r in results:
+        report += f"| {r['questions']} | {r['answers']} | {r['seconds']:0.2f} | {r['llm_calls']} | {r['tokens']} | {r['cached_tokens']} | {r['searches']} | {r['search_tokens_per_call']:0.0f} ({r['search_tokens_max']}) | {r['pages_fetched']} | {r['peak_rss_kb']} |\n"
+    prefix_tokens = results[0]["prefix_tokens"] if results else 0
+    report += f"\nPrompt prefix shared by the questions: {prefix_tokens} tokens. The provider caches prompts from {PROMPT_CACHE_MIN_TOKENS} tokens.\n"
+    return report
+
+
+def current_commit():
+    """Return the short hash of the current commit, with a "-dirty" suffix for uncommitted changes"""
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=BENCHMARK_DIR,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+        status = subprocess.run(
+            ["git", "status", "--porcelain", "--untracked-files=no"],
+            cwd=BENCHMARK_DIR,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+    return f"{commit}-dirty" if status else commit
+
+
+def save_benchmark_results(name, results, results_dir=BENCHMARK_RESULTS):
+    """Save the results of a benchmark under the current commit, to compare them between commits"""
+    commit = current_commit()
+    os.makedirs(results_dir, exist_ok=True)
+    path = os.path.join(results_dir, f"{name}_{commit}.json")
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(
+            {
+                "benchmark": name,
+                "commit": commit,
+                "date": datetime.datetime.now().isoformat(timespec="seconds"),
+                "results": results,
+            },
+            f,
+            indent=2,
+        )
+    return path
+
+
+def load_benchmark_results(name, commit, results_dir=BENCHMARK_RESULTS):
+    with open(
+        os.path.join(results_dir, f"{name}_{commit}.json"), "r", encoding="utf-8"
+    ) as f:
+        return json.load(f)
+
+
+def compare_markdown(before, after, key="questions"):
+    """Compare the numeric metrics of two saved runs of the same benchmark"""
+    report = f"# Benchmark {after['benchmark']}: {before['commit']} -> {after['commit']}\n"
+    previous = {r[key]: r for r in before["results"]}
+    for result in after["results"]:
+        if result[key] not in previous:
+            continue
+        report += f"""
+## {result[key]}
+
+| Metric | {before['commit']} | {after['commit']} | Change |
+|---|---|---|---|
+"""
+        for metric, value in result.items():
+            old = previous[result[key]].get(metric)
+            if metric == key or not isinstance(value, (int, float)) or old is None:
+                continue
+            change = f"{(value - old) / old * 100:+0.1f}%" if old else "-"
+            report += f"| {metric} | {old:0.6g} | {value:0.6g} | {change} |\n"
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Performance benchmarks")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    extract_parser = subparsers.add_parser(
+        "extract", help="Compare the HTML extractors on saved pages"
+    )
+    extract_parser.add_argument("--fixtures", default=HTML_FIXTURES)
+    extract_parser.add_argument("--repeat", type=int, default=20)
+
+    assessment_parser = subparsers.add_parser(
+        "assessment",
+        help="Run assessments offline with a scripted LLM, a fixture search and a local web server",
+    )
+    assessment_parser.add_argument(
+        "--questions", choices=list(QUESTION_SETS), nargs="+", default=list(QUESTION_SETS)
+    )
+    assessment_parser.add_argument("--fixtures", default=HTML_FIXTURES)
+    assessment_parser.add_argument(
+        "--llm-latency", type=float, default=0.2, help="Seconds per simulated LLM call"
+    )
+    assessment_parser.add_argument(
+        "--no-save", action="store_true", help="Don't save the results in benchmark_results"
+    )
+
+    compare_parser = subparsers.add_parser(
+        "compare", help="Compare the saved results of a benchmark between two commits"
+    )
+    compare_parser.add_argument("before", help="Commit of the reference results")
+    compare_parser.add_argument("after", nargs="?", help="Default: current commit")
+    compare_parser.add_argument("--name", default="assessment")
+
+    args = parser.parse_args()
+
+    if args.benchmark == "extract":
+        results = benchmark_extractors(args.fixtures, args.repeat)
+        print(extract_benchmark_markdown(results))
+
+    elif args.benchmark == "assessment":
+        results = benchmark_assessments(args.questions, args.llm_latency, args.fixtures)
+        print(assessment_benchmark_markdown(results))
+        if not args.no_save:
+            print(f"* Results saved to {save_benchmark_results('assessment', results)}")
+
+    elif args.benchmark == "compare":
+        before = load_benchmark_results(args.name, args.before)
+        after = load_benchmark_results(args.name, args.after or current_commit())
+        print(compare_markdown(before, after))
+
+
+if __name__ == "__main__":
+    main()
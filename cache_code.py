@@ -0,0 +1,795 @@
+import os
+import json
+import time
+import zlib
+import hashlib
+import sqlite3
+import datetime
+import tempfile
+import threading
+
+from constants import (
+    ANSWER_CACHE,
+    DOWNLOAD_CACHE,
+    DOWNLOAD_CACHE_MAX_SIZE,
+    SEARCH_CACHE,
+    SEARCH_CACHE_TTL,
+    LLM_CACHE,
+    LLM_CACHE_TTL,
+    LLM_CACHE_MAX_SIZE,
+)
+from retrieval_code import registered_domain
+
+
+def connect_sqlite(path, check_same_thread=True):
+    """
+    Open a SQLite database in WAL mode, so that readers don't block writers and
+    several processes can share it.
+    """
+    directory = os.path.dirname(path)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory, exist_ok=True)
+
+    connection = sqlite3.connect(
+        path, timeout=30, isolation_level=None, check_same_thread=check_same_thread
+    )
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("PRAGMA synchronous=NORMAL")
+    connection.execute("PRAGMA busy_timeout=30000")
+    return connection
+
+
+class SQLiteStore:
+    """Base class keeping one SQLite connection per thread"""
+
+    schema = []
+
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+
+    @property
+    def connection(self):
+        if not hasattr(self.local, "connection"):
+            connection = connect_sqlite(self.path)
+            for statement in self.schema:
+                connection.execute(statement)
+            self.migrate(connection)
+            self.local.connection = connection
+        return self.local.connection
+
+    def migrate(self, connection):
+        """Update the tables created by previous versions, when a connection is opened"""
+
+    def transaction(self):
+        return Transaction(self.connection)
+
+
+class Transaction:
+    """Write transaction, taking the write lock immediately to avoid deadlocks between processes"""
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    def __enter__(self):
+        self.connection.execute("BEGIN IMMEDIATE")
+        return self.connection
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.connection.execute("COMMIT")
+        else:
+            self.connection.execute("ROLLBACK")
+        return False
+
+
+class AnswerStore(SQLiteStore):
+    """
+    Answers of the assessments, indexed by (company, product, question).
+
+    The company and product keys are the cleaned names used in the legacy
+    assessment_answers_<company>_<product>.json files.
+    """
+
+    schema = [
+        """CREATE TABLE IF NOT EXISTS answers (
+            company_key TEXT NOT NULL,
+            product_key TEXT NOT NULL,
+            question TEXT NOT NULL,
+            company TEXT,
+            product TEXT,
+            url TEXT,
+            domain TEXT,
+            label TEXT,
+            followup INTEGER,
+            answer TEXT NOT NULL,
+            timestamp TEXT,
+            PRIMARY KEY (company_key, product_key, question)
+        )""",
+        # Pages cited by each answer, with the hash of their text when the answer was saved
+        """CREATE TABLE IF NOT EXISTS sources (
+            company_key TEXT NOT NULL,
+            product_key TEXT NOT NULL,
+            question TEXT NOT NULL,
+            url TEXT NOT NULL,
+            hash TEXT,
+            PRIMARY KEY (company_key, product_key, question, url)
+        )""",
+        """CREATE TABLE IF NOT EXISTS imports (
+            path TEXT PRIMARY KEY,
+            timestamp TEXT
+        )""",
+    ]
+
+    def __init__(self, path=ANSWER_CACHE):
+        super().__init__(path)
+
+    def for_product(self, company_key, product_key):
+        return ProductAnswers(self, company_key, product_key)
+
+    def get_many(self, company_key, product_key, questions):
+        """Return a dictionary of the answers found for the questions"""
+        answers = {}
+        questions = list(questions)
+        # Stay under the SQLite limit of variables per statement
+        for i in range(0, len(questions), 500):
+            batch = questions[i : i + 500]
+            rows = self.connection.execute(
+                f"""SELECT question, answer FROM answers
+                WHERE company_key = ? AND product_key = ? AND question IN ({",".join("?" * len(batch))})""",
+                [company_key, product_key] + batch,
+            )
+            for question, answer in rows:
+                answers[question] = json.loads(answer)
+        return answers
+
+    def get_evidence(self, company_key, product_key, questions):
+        """
+        Return a dictionary of the timestamp and sources of the answers found for the questions.
+        The sources are a dictionary of the hash of each cited URL.
+        """
+        evidence = {}
+        questions = list(questions)
+        for i in range(0, len(questions), 500):
+            batch = questions[i : i + 500]
+            placeholders = ",".join("?" * len(batch))
+            rows = self.connection.execute(
+                f"""SELECT question, timestamp FROM answers
+                WHERE company_key = ? AND product_key = ? AND question IN ({placeholders})""",
+                [company_key, product_key] + batch,
+            )
+            for question, timestamp in rows:
+                evidence[question] = {"timestamp": timestamp, "sources": {}}
+
+            rows = self.connection.execute(
+                f"""SELECT question, url, hash FROM sources
+                WHERE company_key = ? AND product_key = ? AND question IN ({placeholders})""",
+                [company_key, product_key] + batch,
+            )
+            for question, url, digest in rows:
+                if question in evidence:
+                    evidence[question]["sources"][url] = digest
+        return evidence
+
+    def put_many(self, company_key, product_key, rows, replace=False):
+        """
+        Save a batch of answers in a single transaction.
+        Questions that already have an answer are left untouched, unless replace is True.
+        """
+        with self.transaction() as connection:
+            self.insert_answers(connection, company_key, product_key, rows, replace)
+
+    def insert_answers(self, connection, company_key, product_key, rows, replace=False):
+        if replace:
+            connection.executemany(
+                """DELETE FROM sources
+                WHERE company_key = ? AND product_key = ? AND question = ?""",
+                [(company_key, product_key, row["question"]) for row in rows],
+            )
+
+        connection.executemany(
+            f"""INSERT OR {"REPLACE" if replace else "IGNORE"} INTO answers
+            (company_key, product_key, question, company, product, url, domain, label, followup, answer, timestamp)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+            [
+                (
+                    company_key,
+                    product_key,
+                    row["question"],
+                    row.get("company"),
+                    row.get("product"),
+                    row.get("url"),
+                    row.get("domain"),
+                    row.get("label"),
+                    1 if row.get("followup") else 0,
+                    json.dumps(row["answer"], ensure_ascii=False),
+                    row.get("timestamp") or datetime.datetime.now().isoformat(),
+                )
+                for row in rows
+            ],
+        )
+        connection.executemany(
+            """INSERT OR IGNORE INTO sources (company_key, product_key, question, url, hash)
+            VALUES (?, ?, ?, ?, ?)""",
+            [
+                (company_key, product_key, row["question"], url, digest)
+                for row in rows
+                for url, digest in row.get("sources", {}).items()
+            ],
+        )
+
+    def import_json(self, company_key, product_key, json_path):
+        """
+        Import a legacy JSON answer cache, once.
+
+        :return: Number of answers read from the file, 0 if it was already imported or doesn't exist
+        """
+        path = os.path.abspath(json_path)
+        if not os.path.exists(path):
+            return 0
+
+        imported = self.connection.execute(
+            "SELECT 1 FROM imports WHERE path = ?", [path]
+        ).fetchone()
+        if imported:
+            return 0
+
+        with open(path, "r", encoding="utf-8") as f:
+            rows = json.load(f)
+
+        with self.transaction() as connection:
+            self.insert_answers(connection, company_key, product_key, rows)
+            connection.execute(
+                "INSERT OR IGNORE INTO imports (path, timestamp) VALUES (?, ?)",
+                [path, datetime.datetime.now().isoformat()],
+            )
+
+        print(f"* Imported {len(rows)} answers from {json_path}")
+        return len(rows)
+
+
+class ProductAnswers:
+    """View of the AnswerStore limited to one company and product"""
+
+    def __init__(self, store, company_key, product_key):
+        self.store = store
+        self.company_key = company_key
+        self.product_key = product_key
+
+    def get_many(self, questions):
+        return self.store.get_many(self.company_key, self.product_key, questions)
+
+    def get_evidence(self, questions):
+        return self.store.get_evidence(self.company_key, self.product_key, questions)
+
+    def put_many(self, rows, replace=False):
+        self.store.put_many(self.company_key, self.product_key, rows, replace)
+
+    def import_json(self, json_path):
+        return self.store.import_json(self.company_key, self.product_key, json_path)
+
+
+class DownloadCache(SQLiteStore):
+    """
+    Cache of downloaded pages, safe to share between threads and processes.
+
+    Bodies are compressed and stored in directories sharded by the MD5 of the URL,
+    and written atomically. A SQLite index keeps the metadata of each entry, so
+    freshness checks don't touch the files, and the least recently used entries
+    are evicted when the total size goes over max_size bytes.
+
+    The ETag and Last-Modified headers of each page are kept, so that expired entries
+    can be revalidated with a conditional request instead of being downloaded again.
+    """
+
+    schema = [
+        """CREATE TABLE IF NOT EXISTS entries (
+            key TEXT PRIMARY KEY,
+            url TEXT NOT NULL,
+            domain TEXT,
+            content_type TEXT,
+            size INTEGER NOT NULL,
+            created REAL NOT NULL,
+            accessed REAL NOT NULL
+        )""",
+        "CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed)",
+        """CREATE TABLE IF NOT EXISTS validators (
+            key TEXT PRIMARY KEY,
+            etag TEXT,
+            last_modified TEXT
+        )""",
+        # Running total of the size of the entries, updated with them in the same transactions
+        """CREATE TABLE IF NOT EXISTS total_size (
+            id INTEGER PRIMARY KEY CHECK (id = 0),
+            size INTEGER NOT NULL
+        )""",
+    ]
+
+    def migrate(self, connection):
+        # Entries stored before the registered domain of the URLs was kept
+        columns = [row[1] for row in connection.execute("PRAGMA table_info(entries)")]
+        if "domain" not in columns:
+            try:
+                connection.execute("ALTER TABLE entries ADD COLUMN domain TEXT")
+            except sqlite3.OperationalError:
+                # Added by another process in the meantime
+                pass
+        connection.execute(
+            "CREATE INDEX IF NOT EXISTS entries_domain ON entries (domain, created)"
+        )
+        # Caches created before the running total start from the sum of their entries
+        connection.execute(
+            """INSERT OR IGNORE INTO total_size (id, size)
+            SELECT 0, COALESCE(SUM(size), 0) FROM entries"""
+        )
+
+        rows = connection.execute(
+            "SELECT key, url FROM entries WHERE domain IS NULL"
+        ).fetchall()
+        if rows:
+            with Transaction(connection):
+                connection.executemany(
+                    "UPDATE entries SET domain = ? WHERE key = ?",
+                    [(registered_domain(url), key) for key, url in rows],
+                )
+
+    # Outcomes of the lookups counted by stats()
+    outcomes = ["hits", "revalidated", "changed", "misses"]
+
+    # Last access times are only updated when older than this, to limit writes
+    access_resolution = 60
+
+    def __init__(self, cache_dir=DOWNLOAD_CACHE, max_size=DOWNLOAD_CACHE_MAX_SIZE):
+        super().__init__(os.path.join(cache_dir, "index.sqlite"))
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.counters = {outcome: 0 for outcome in self.outcomes}
+        self.counters_lock = threading.Lock()
+
+    def key(self, url):
+        return hashlib.md5(url.encode()).hexdigest()
+
+    def body_path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key[2:4], key + ".z")
+
+    def get(self, url, max_age=None, include_expired=False):
+        """
+        Return the cached entry of the URL as a dictionary, or None if missing or older than max_age seconds.
+
+        With include_expired, entries older than max_age are returned with "expired" set to True,
+        to be revalidated with their "etag" and "last_modified" validators.
+        """
+        key = self.key(url)
+        row = self.connection.execute(
+            """SELECT url, content_type, created, accessed, etag, last_modified
+            FROM entries LEFT JOIN validators USING (key) WHERE key = ?""",
+            [key],
+        ).fetchone()
+        if not row:
+            return None
+
+        url, content_type, created, accessed, etag, last_modified = row
+        now = time.time()
+        expired = max_age is not None and now - created > max_age
+        if expired and not include_expired:
+            return None
+
+        try:
+            with open(self.body_path(key), "rb") as f:
+                content = zlib.decompress(f.read()).decode("utf-8")
+        except (OSError, zlib.error):
+            # Evicted by another process, or never completely written
+            return None
+
+        if now - accessed > self.access_resolution:
+            with self.transaction() as connection:
+                connection.execute(
+                    "UPDATE entries SET accessed = ? WHERE key = ?", [now, key]
+                )
+
+        return {
+            "url": url,
+            "content": content,
+            "content_type": content_type,
+            "timestamp": created,
+            "expired": expired,
+            "etag": etag,
+            "last_modified": last_modified,
+        }
+
+    def put(self, url, content, content_type, etag=None, last_modified=None):
+        """
+        Store the content of the URL and its validators, then evict old entries if the cache is too large
+        """
+        key = self.key(url)
+        path = self.body_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        body = zlib.compress(content.encode("utf-8"))
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(body)
+            os.replace(tmp_path, path)
+        except OSError:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+        now = time.time()
+        with self.transaction() as connection:
+            previous = connection.execute(
+                "SELECT size FROM entries WHERE key = ?", [key]
+            ).fetchone()
+            connection.execute(
+                "UPDATE total_size SET size = size + ? WHERE id = 0",
+                [len(body) - (previous[0] if previous else 0)],
+            )
+            connection.execute(
+                """INSERT OR REPLACE INTO entries (key, url, domain, content_type, size, created, accessed)
+                VALUES (?, ?, ?, ?, ?, ?, ?)""",
+                [key, url, registered_domain(url), content_type, len(body), now, now],
+            )
+            self.set_validators(connection, key, etag, last_modified)
+
+        self.evict()
+
+    def revalidate(self, url, etag=None, last_modified=None):
+        """
+        Mark the entry of the URL as fresh, after the server answered that the page didn't change.
+        Validators sent with the answer replace the stored ones.
+        """
+        key = self.key(url)
+        now = time.time()
+        with self.transaction() as connection:
+            connection.execute(
+                "UPDATE entries SET created = ?, accessed = ? WHERE key = ?",
+                [now, now, key],
+            )
+            if etag or last_modified:
+                self.set_validators(connection, key, etag, last_modified)
+
+    def set_validators(self, connection, key, etag, last_modified):
+        if etag or last_modified:
+            connection.execute(
+                "INSERT OR REPLACE INTO validators (key, etag, last_modified) VALUES (?, ?, ?)",
+                [key, etag, last_modified],
+            )
+        else:
+            connection.execute("DELETE FROM validators WHERE key = ?", [key])
+
+    def count(self, outcome):
+        """Count the outcome of a lookup, one of the outcomes counted by stats()"""
+        with self.counters_lock:
+            self.counters[outcome] += 1
+
+    def stats(self):
+        """
+        Return the number of lookups per outcome, the hit rate, and the revalidation rate:
+        the share of conditional requests answered with 304 Not Modified
+        """
+        with self.counters_lock:
+            stats = dict(self.counters)
+        lookups = sum(stats.values())
+        conditional = stats["revalidated"] + stats["changed"]
+        stats["hit_rate"] = (stats["hits"] + stats["revalidated"]) / lookups if lookups else 0
+        stats["revalidation_rate"] = stats["revalidated"] / conditional if conditional else 0
+        return stats
+
+    def urls(self, domain=None, since=None):
+        """
+        Return the URLs in the cache, optionally only those of a registered domain,
+        and those stored or revalidated after the time since
+        """
+        conditions = []
+        parameters = []
+        if domain is not None:
+            conditions.append("domain = ?")
+            parameters.append(domain)
+        if since is not None:
+            conditions.append("created > ?")
+            parameters.append(since)
+
+        query = "SELECT url FROM entries"
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        return [row[0] for row in self.connection.execute(query, parameters)]
+
+    def total_size(self, connection=None):
+        connection = connection or self.connection
+        return connection.execute(
+            "SELECT size FROM total_size WHERE id = 0"
+        ).fetchone()[0]
+
+    def evict(self):
+        """Remove the least recently used entries until the cache is under 90% of max_size"""
+        if not self.max_size or self.total_size() <= self.max_size:
+            return 0
+
+        target = self.max_size * 0.9
+        evicted = []
+        with self.transaction() as connection:
+            total = self.total_size(connection)
+            removed = 0
+            rows = connection.execute(
+                "SELECT key, size FROM entries ORDER BY accessed"
+            )
+            for key, size in rows:
+                if total - removed <= target:
+                    break
+                evicted.append(key)
+                removed += size
+
+            connection.execute(
+                "UPDATE total_size SET size = size - ? WHERE id = 0", [removed]
+            )
+            connection.executemany(
+                "DELETE FROM entries WHERE key = ?", [(key,) for key in evicted]
+            )
+            connection.executemany(
+                "DELETE FROM validators WHERE key = ?", [(key,) for key in evicted]
+            )
+
+        for key in evicted:
+            try:
+                os.remove(self.body_path(key))
+            except OSError:
+                pass
+
+        return len(evicted)
+
+
+download_caches = {}
+download_caches_lock = threading.Lock()
+
+
+def get_download_cache(cache_dir=DOWNLOAD_CACHE):
+    """Return the download cache of the directory, shared by the whole process"""
+    with download_caches_lock:
+        if cache_dir not in download_caches:
+            download_caches[cache_dir] = DownloadCache(cache_dir)
+        return download_caches[cache_dir]
+
+
+def normalize_query(query):
+    """
+    Normalize a search query so that near-identical queries share the same cache entry.
+
+    Case and whitespace are folded, and site: clauses are sorted, without the ORs joining them.
+    """
+    tokens = query.casefold().split()
+    sites = sorted(set(t for t in tokens if t.startswith("site:")))
+
+    terms = []
+    for i, token in enumerate(tokens):
+        if token.startswith("site:"):
+            continue
+        if token == "or":
+            previous_token = tokens[i - 1] if i > 0 else ""
+            next_token = tokens[i + 1] if i + 1 < len(tokens) else ""
+            if previous_token.startswith("site:") or next_token.startswith("site:"):
+                continue
+        terms.append(token)
+
+    return " ".join(terms + sites)
+
+
+class SearchCache(SQLiteStore):
+    """Cache of search results, keyed by the normalized query and the number of results"""
+
+    schema = [
+        """CREATE TABLE IF NOT EXISTS searches (
+            key TEXT PRIMARY KEY,
+            query TEXT NOT NULL,
+            num INTEGER NOT NULL,
+            results TEXT NOT NULL,
+            created REAL NOT NULL
+        )""",
+    ]
+
+    def __init__(self, cache_dir=SEARCH_CACHE, ttl=SEARCH_CACHE_TTL):
+        super().__init__(os.path.join(cache_dir, "search.sqlite"))
+        self.ttl = ttl
+        self.counters = {"hits": 0, "misses": 0}
+        self.counters_lock = threading.Lock()
+
+    def key(self, query, num):
+        return f"{normalize_query(query)}|num={num}"
+
+    def get(self, query, num):
+        """Return the cached results of the query, or None if missing or older than the TTL"""
+        row = self.connection.execute(
+            "SELECT results, created FROM searches WHERE key = ?",
+            [self.key(query, num)],
+        ).fetchone()
+
+        found = row is not None and time.time() - row[1] <= self.ttl
+        with self.counters_lock:
+            self.counters["hits" if found else "misses"] += 1
+
+        return json.loads(row[0]) if found else None
+
+    def put(self, query, num, results):
+        with self.transaction() as connection:
+            connection.execute(
+                """INSERT OR REPLACE INTO searches (key, query, num, results, created)
+                VALUES (?, ?, ?, ?, ?)""",
+                [
+                    self.key(query, num),
+                    query,
+                    num,
+                    json.dumps(results, ensure_ascii=False),
+                    time.time(),
+                ],
+            )
+
+    def stats(self):
+        """Return the number of hits and misses, and the hit rate"""
+        with self.counters_lock:
+            stats = dict(self.counters)
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = stats["hits"] / lookups if lookups else 0
+        return stats
+
+
+class LLMCache(SQLiteStore):
+    """
+    Cache of LLM responses, keyed by a hash of everything sent to the model.
+
+    Responses are stored compressed. Entries older than the TTL are ignored, and when the
+    total size goes over max_size bytes, the expired entries then the least recently used
+    ones are evicted.
+    """
+
+    schema = [
+        """CREATE TABLE IF NOT EXISTS responses (
+            key TEXT PRIMARY KEY,
+            model TEXT,
+            response BLOB NOT NULL,
+            size INTEGER NOT NULL,
+            created REAL NOT NULL,
+            accessed REAL NOT NULL,
+            hits INTEGER NOT NULL DEFAULT 0
+        )""",
+        "CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)",
+        # Running total of the size of the responses, updated with them in the same transactions
+        """CREATE TABLE IF NOT EXISTS total_size (
+            id INTEGER PRIMARY KEY CHECK (id = 0),
+            size INTEGER NOT NULL
+        )""",
+        # Date given to the model in the prompts of the last recording of each assessment
+        """CREATE TABLE IF NOT EXISTS recordings (
+            assessment TEXT PRIMARY KEY,
+            date TEXT NOT NULL
+        )""",
+    ]
+
+    def migrate(self, connection):
+        # Caches created before the running total start from the sum of their responses
+        connection.execute(
+            """INSERT OR IGNORE INTO total_size (id, size)
+            SELECT 0, COALESCE(SUM(size), 0) FROM responses"""
+        )
+
+    # Last access times and hit counts are only written when the access time is older than this
+    access_resolution = 60
+
+    def __init__(self, path=LLM_CACHE, ttl=LLM_CACHE_TTL, max_size=LLM_CACHE_MAX_SIZE):
+        super().__init__(path)
+        self.ttl = ttl
+        self.max_size = max_size
+        self.counters = {"hits": 0, "misses": 0}
+        # Hits of each response not written yet
+        self.pending_hits = {}
+        self.counters_lock = threading.Lock()
+
+    def get(self, key):
+        """Return the cached response as a string, or None if missing or older than the TTL"""
+        row = self.connection.execute(
+            "SELECT response, created, accessed FROM responses WHERE key = ?", [key]
+        ).fetchone()
+
+        now = time.time()
+        found = row is not None and (not self.ttl or now - row[1] <= self.ttl)
+        with self.counters_lock:
+            self.counters["hits" if found else "misses"] += 1
+            if not found:
+                return None
+            hits = self.pending_hits.get(key, 0) + 1
+            self.pending_hits[key] = hits
+            if now - row[2] > self.access_resolution:
+                del self.pending_hits[key]
+            else:
+                hits = 0
+
+        if hits:
+            with self.transaction() as connection:
+                connection.execute(
+                    "UPDATE responses SET accessed = ?, hits = hits + ? WHERE key = ?",
+                    [now, hits, key],
+                )
+        return zlib.decompress(row[0]).decode("utf-8")
+
+    def put(self, key, model, response):
+        """Store a response, then evict old entries if the cache is too large"""
+        body = zlib.compress(response.encode("utf-8"))
+        now = time.time()
+        with self.transaction() as connection:
+            previous = connection.execute(
+                "SELECT size FROM responses WHERE key = ?", [key]
+            ).fetchone()
+            connection.execute(
+                "UPDATE total_size SET size = size + ? WHERE id = 0",
+                [len(body) - (previous[0] if previous else 0)],
+            )
+            connection.execute(
+                """INSERT OR REPLACE INTO responses (key, model, response, size, created, accessed)
+                VALUES (?, ?, ?, ?, ?, ?)""",
+                [key, model, body, len(body), now, now],
+            )
+        self.evict()
+
+    def total_size(self, connection=None):
+        connection = connection or self.connection
+        return connection.execute(
+            "SELECT size FROM total_size WHERE id = 0"
+        ).fetchone()[0]
+
+    def recording_date(self, assessment):
+        """Return the date of the prompts recorded for the assessment, or None"""
+        row = self.connection.execute(
+            "SELECT date FROM recordings WHERE assessment = ?", [assessment]
+        ).fetchone()
+        return row[0] if row else None
+
+    def set_recording_date(self, assessment, date):
+        with self.transaction() as connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO recordings (assessment, date) VALUES (?, ?)",
+                [assessment, date],
+            )
+
+    def evict(self):
+        """
+        When the cache is over max_size, remove the expired entries, then the least recently
+        used ones until under 90% of max_size
+        """
+        if not self.max_size or self.total_size() <= self.max_size:
+            return 0
+
+        target = self.max_size * 0.9
+        expired_before = time.time() - self.ttl if self.ttl else 0
+        with self.transaction() as connection:
+            total = self.total_size(connection)
+            rows = connection.execute(
+                "SELECT key, size, created FROM responses ORDER BY accessed"
+            ).fetchall()
+            evicted = [key for key, size, created in rows if created < expired_before]
+            removed = sum(size for key, size, created in rows if created < expired_before)
+            for key, size, created in rows:
+                if total - removed <= target:
+                    break
+                if created >= expired_before:
+                    evicted.append(key)
+                    removed += size
+
+            connection.execute(
+                "UPDATE total_size SET size = size - ? WHERE id = 0", [removed]
+            )
+            connection.executemany(
+                "DELETE FROM responses WHERE key = ?", [(key,) for key in evicted]
+            )
+        return len(evicted)
+
+    def stats(self):
+        """Return the number of hits and misses, and the hit rate"""
+        with self.counters_lock:
+            stats = dict(self.counters)
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = stats["hits"] / lookups if lookups else 0
+        return stats
+
+
+search_cache = SearchCache()
+answer_store = AnswerStore()
+llm_cache = LLMCache()
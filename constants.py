@@ -13,16 +13,105 @@ GOOGLE_SEARCH_ENGINE_ID = os.environ.get("GOOGLE_SEARCH_ENGINE_ID", None)
 OPENAI_API_KEY = os.environ.get("OPENAI_API_KEY", None)
 MODEL_NAME = os.environ.get("MODEL_NAME", "gpt-4o")
 SMALL_MODEL_NAME = os.environ.get("SMALL_MODEL_NAME", "gpt-4o-mini")
+# Agent turns run first with the small model, escalating to the large model when the small one
+# returns no valid tool call, or an answer with a "found" score below CASCADE_MIN_FOUND
+MODEL_CASCADE = os.environ.get("MODEL_CASCADE", "false").lower() in ["1", "true", "yes"]
+CASCADE_MIN_FOUND = float(os.environ.get("CASCADE_MIN_FOUND", 0.75))
+# Extractions of lists from answers (find_content) requested within EXTRACTION_BATCH_WINDOW seconds
+# of each other are sent as one request, of up to EXTRACTION_BATCH_SIZE answers.
+# Invalid extractions are retried EXTRACTION_SMALL_RETRIES times on the small model before the large one.
+EXTRACTION_BATCH_WINDOW = float(os.environ.get("EXTRACTION_BATCH_WINDOW", 0.3))
+EXTRACTION_BATCH_SIZE = int(os.environ.get("EXTRACTION_BATCH_SIZE", 4))
+EXTRACTION_SMALL_RETRIES = int(os.environ.get("EXTRACTION_SMALL_RETRIES", 1))
+# Seconds a request waits for the batch it joined before giving up, as a failed extraction
+EXTRACTION_TIMEOUT = int(os.environ.get("EXTRACTION_TIMEOUT", 300))
 
+ANSWER_CACHE = "assessment_answers.sqlite"
+# Checkpoints of the graph runs, to resume the questions interrupted by a crash. Empty to disable.
+CHECKPOINTS = os.environ.get("CHECKPOINTS", "checkpoints.sqlite")
+# Re-assessment: cached answers are only asked again when a page they cite changed,
+# when they are older than REASSESS_MAX_AGE, or when their confidence is under REASSESS_MIN_FOUND
+REASSESS = os.environ.get("REASSESS", "false").lower() in ["1", "true", "yes"]
+REASSESS_MAX_AGE = int(os.environ.get("REASSESS_MAX_AGE_DAYS", 730)) * 24 * 3600
+REASSESS_MIN_FOUND = float(os.environ.get("REASSESS_MIN_FOUND", 0.75))
 SEARCH_CACHE = "cache_search"
+LOCAL_INDEX = "cache_index"
+LOCAL_INDEX_CHUNK_CHARS = 1200
+LOCAL_INDEX_RESULTS = 5
+# Minimum cosine similarity of the best local chunk to skip searching Google first
+LOCAL_INDEX_MIN_SCORE = float(os.environ.get("LOCAL_INDEX_MIN_SCORE", 0.15))
+SEARCH_CACHE_TTL = int(os.environ.get("SEARCH_CACHE_TTL_DAYS", 7)) * 24 * 3600
 DOWNLOAD_CACHE = "cache_downloads"
+DOWNLOAD_CACHE_MAX_SIZE = int(os.environ.get("DOWNLOAD_CACHE_MAX_SIZE_MB", 2048)) * 1024 * 1024
+# Cache of the LLM responses, keyed by the model, parameters, tools and messages of each call.
+# "off" (default), "on" to reuse and store responses, or "replay" to only use stored responses
+# and fail on any other call, for deterministic offline runs.
+LLM_CACHE_MODE = os.environ.get("LLM_CACHE_MODE", "off").lower()
+# Date given to the model as today (YYYY-MM-DD), part of the prompts. Empty for the current date,
+# or in "replay" mode for the date the calls of the assessment were recorded.
+ASSESSMENT_DATE = os.environ.get("ASSESSMENT_DATE", "")
+LLM_CACHE = "cache_llm.sqlite"
+LLM_CACHE_TTL = int(os.environ.get("LLM_CACHE_TTL_DAYS", 30)) * 24 * 3600
+LLM_CACHE_MAX_SIZE = int(os.environ.get("LLM_CACHE_MAX_SIZE_MB", 512)) * 1024 * 1024
+
+# "lxml" for the C parser, or "bs4" for BeautifulSoup with the pure Python html.parser
+HTML_EXTRACTOR = os.environ.get("HTML_EXTRACTOR", "lxml")
 
 SAFETY_TOKEN_LIMIT = 20000
+# Maximum number of page tokens returned by one search, selected by relevance in chunks of CHUNK_TOKENS.
+# 6000 tokens keep the ~23 best chunks of the pages, where equal shares of SAFETY_TOKEN_LIMIT kept 20000.
+SEARCH_TOKEN_BUDGET = int(os.environ.get("SEARCH_TOKEN_BUDGET", 6000))
+CHUNK_TOKENS = 256
+# Previous answers given as context to a question: the most relevant ones, within a budget of tokens
+CONTEXT_TOP_K = int(os.environ.get("CONTEXT_TOP_K", 5))
+CONTEXT_TOKEN_BUDGET = int(os.environ.get("CONTEXT_TOKEN_BUDGET", 2000))
+MAX_CONCURRENT_QUESTIONS = int(os.environ.get("MAX_CONCURRENT_QUESTIONS", 4))
+MAX_CONCURRENT_FOLLOWUPS = int(os.environ.get("MAX_CONCURRENT_FOLLOWUPS", 4))
+MAX_CONCURRENT_DOWNLOADS = int(os.environ.get("MAX_CONCURRENT_DOWNLOADS", 16))
+SEARCH_DOWNLOAD_DEADLINE = int(os.environ.get("SEARCH_DOWNLOAD_DEADLINE", 30))
+# Limits shared by all the assessments of the process: LLM calls in flight and pages being fetched
+MAX_CONCURRENT_LLM_CALLS = int(os.environ.get("MAX_CONCURRENT_LLM_CALLS", 8))
+MAX_CONCURRENT_FETCHES = int(os.environ.get("MAX_CONCURRENT_FETCHES", MAX_CONCURRENT_DOWNLOADS))
+# Number of vendors assessed at the same time by batch_code, and directory of their reports
+MAX_CONCURRENT_VENDORS = int(os.environ.get("MAX_CONCURRENT_VENDORS", 2))
+BATCH_OUTPUT = os.environ.get("BATCH_OUTPUT", "batch_output")
+# Modules of the question sets, each providing prepare_questions(profile)
+QUESTION_SETS = {
+    "sample": "questions_code_sample",
+    "complete": "questions_code_complete",
+}
+
+# Requests per second and burst size allowed per host when downloading pages.
+# HOST_RATE_LIMITS overrides the default for a domain and its subdomains.
+DEFAULT_HOST_RATE_LIMIT = {"rate": 0.5, "burst": 2}
+HOST_RATE_LIMITS = {
+    # "example.com": {"rate": 0.2, "burst": 1},
+}
+MAX_RETRY_AFTER = 120
+
+# Number of hosts kept in the connection pool, and connections kept alive per host
+HTTP_POOL_CONNECTIONS = int(os.environ.get("HTTP_POOL_CONNECTIONS", 32))
+HTTP_POOL_MAXSIZE = int(os.environ.get("HTTP_POOL_MAXSIZE", MAX_CONCURRENT_DOWNLOADS))
+# Prices in dollars per million tokens. Cached input tokens are read from the provider prompt cache.
+# The provider only caches prompts from PROMPT_CACHE_MIN_TOKENS tokens (1024 for OpenAI), so the
+# first call of each question is only cached when the prefix shared by the questions is that long.
+PROMPT_CACHE_MIN_TOKENS = 1024
 LLM_MODEL_PRICES = {
-    "gpt-4o": {"input": 5, "output": 15},
-    "gpt-4o-mini": {"input": 0.15, "output": 0.6},
+    "gpt-4o": {"input": 5, "cached_input": 2.5, "output": 15},
+    "gpt-4o-mini": {"input": 0.15, "cached_input": 0.075, "output": 0.6},
 }
 
+# Traces of the stages of each assessment, saved as JSON lines ("jsonl") or Chrome trace ("chrome").
+# An empty TRACE_DIR disables the export.
+TRACE_DIR = os.environ.get("TRACE_DIR", "traces")
+TRACE_FORMAT = os.environ.get("TRACE_FORMAT", "jsonl")
+
+# Budgets per question and per assessment, in tokens and dollars. 0 means no limit.
+QUESTION_TOKEN_BUDGET = int(os.environ.get("QUESTION_TOKEN_BUDGET", 0))
+QUESTION_COST_BUDGET = float(os.environ.get("QUESTION_COST_BUDGET", 0))
+ASSESSMENT_TOKEN_BUDGET = int(os.environ.get("ASSESSMENT_TOKEN_BUDGET", 0))
+ASSESSMENT_COST_BUDGET = float(os.environ.get("ASSESSMENT_COST_BUDGET", 0))
+
 if not GOOGLE_API_KEY:
     print("! GOOGLE_API_KEY not set.", file=sys.stderr)
 if not GOOGLE_SEARCH_ENGINE_ID:
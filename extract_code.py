@@ -0,0 +1,73 @@
+from bs4 import BeautifulSoup
+
+from constants import HTML_EXTRACTOR
+
+try:
+    from lxml import etree
+except ImportError:
+    etree = None
+
+
+def clean_lines(text):
+    """Remove blank lines and surrounding spaces, and split multi-headlines in a line each"""
+
+    # Break into lines and remove leading and trailing space on each
+    lines = (line.strip() for line in text.splitlines())
+
+    # Break multi-headlines into a line each
+    chunks = (phrase.strip() for line in lines for phrase in line.split("  "))
+
+    # Drop blank lines
+    return "\n".join(chunk for chunk in chunks if chunk)
+
+
+def extract_text_bs4(html):
+    """Extract the text of a page with BeautifulSoup and the pure Python html.parser"""
+    soup = BeautifulSoup(html, "html.parser")
+
+    # Remove script and style elements
+    for script in soup(["script", "style"]):
+        script.decompose()
+
+    return clean_lines(soup.get_text())
+
+
+def extract_text_lxml(html):
+    """Extract the text of a page with the libxml2 HTML parser, giving the same text as extract_text_bs4"""
+    parser = etree.HTMLParser(remove_comments=True, remove_pis=True)
+    root = etree.fromstring(html, parser)
+    if root is None:
+        return ""
+
+    # Remove script and style elements, but keep the text following them
+    etree.strip_elements(root, "script", "style", with_tail=False)
+
+    return clean_lines("".join(root.itertext()))
+
+
+EXTRACTORS = {
+    "lxml": extract_text_lxml,
+    "bs4": extract_text_bs4,
+}
+
+
+def available_extractors():
+    return [name for name in EXTRACTORS if name != "lxml" or etree is not None]
+
+
+def extract_text(html, backend=HTML_EXTRACTOR):
+    """
+    Extract the visible text of an HTML page.
+
+    :param html: HTML content of the page
+    :param backend: "lxml" (default when installed) or "bs4". BeautifulSoup is used as
+        the fallback when lxml is not installed or can't parse the page.
+    :return: Text of the page, one block per line
+    """
+    if backend == "lxml" and etree is not None:
+        try:
+            return extract_text_lxml(html)
+        except (ValueError, etree.LxmlError) as e:
+            print(f"  ! lxml failed to parse the page, using BeautifulSoup: {e}")
+
+    return extract_text_bs4(html)
@@ -0,0 +1,247 @@
+import asyncio
+import threading
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+
+import httplib2
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from googleapiclient.discovery import build
+
+from constants import (
+    DEFAULT_HOST_RATE_LIMIT,
+    HOST_RATE_LIMITS,
+    HTTP_POOL_CONNECTIONS,
+    HTTP_POOL_MAXSIZE,
+    GOOGLE_API_KEY,
+)
+
+connection_stats = {
+    "requests": 0,
+    "connections": 0,
+    "search_services": 0,
+    "search_clients": 0,
+}
+connection_stats_lock = threading.Lock()
+
+
+def parse_retry_after(value, default=60):
+    """
+    Convert the value of a Retry-After header to a number of seconds.
+
+    :param value: Header value, either a number of seconds or an HTTP date
+    :param default: Value returned if the header is missing or invalid (default: 60)
+    :return: Number of seconds to wait
+    """
+
+    if not value:
+        return default
+
+    try:
+        return max(0, int(value))
+    except ValueError:
+        pass
+
+    try:
+        retry_date = parsedate_to_datetime(value)
+        if retry_date.tzinfo is None:
+            retry_date = retry_date.replace(tzinfo=timezone.utc)
+        return max(0, (retry_date - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return default
+
+
+class HostRateLimiter:
+    """
+    Token bucket rate limiter keeping one bucket per host.
+
+    Each host gets `rate` requests per second, with bursts of up to `burst` requests.
+    Requests to different hosts never wait on each other. The limiter can be shared
+    between threads, and between asyncio tasks with acquire_async.
+    """
+
+    def __init__(self, default_limit=DEFAULT_HOST_RATE_LIMIT, host_limits=None):
+        self.default_limit = default_limit
+        self.host_limits = host_limits if host_limits is not None else HOST_RATE_LIMITS
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def limit_for(self, host):
+        """Return the limit configured for the host or its closest parent domain"""
+        host = (host or "").lower()
+        parts = host.split(".")
+        for i in range(len(parts)):
+            domain = ".".join(parts[i:])
+            if domain in self.host_limits:
+                return self.host_limits[domain]
+        return self.default_limit
+
+    def bucket_for(self, host, now):
+        """Return the bucket of the host, creating it if needed. The lock must be held."""
+        if host not in self.buckets:
+            limit = self.limit_for(host)
+            self.buckets[host] = {
+                "rate": limit["rate"],
+                "burst": limit["burst"],
+                "tokens": limit["burst"],
+                "updated": now,
+                "blocked_until": 0,
+            }
+        return self.buckets[host]
+
+    def reserve(self, host, max_delay=None):
+        """
+        Take a token from the bucket of the host, and return how long to wait before using it.
+
+        :param max_delay: Longest acceptable wait in seconds. When the wait would be longer,
+                          no token is taken and None is returned (default: None, no limit)
+        """
+        with self.lock:
+            now = time.monotonic()
+            bucket = self.bucket_for(host, now)
+
+            elapsed = now - bucket["updated"]
+            bucket["tokens"] = min(
+                bucket["burst"], bucket["tokens"] + elapsed * bucket["rate"]
+            )
+            bucket["updated"] = now
+
+            delay = 0
+            if bucket["tokens"] < 1:
+                delay = (1 - bucket["tokens"]) / bucket["rate"]
+
+            # Requests queued while the host is blocked are spread after the block
+            delay += max(0, bucket["blocked_until"] - now)
+            if max_delay is not None and delay > max_delay:
+                return None
+
+            bucket["tokens"] -= 1
+            return delay
+
+    def acquire(self, host, max_delay=None):
+        """
+        Block the current thread until a request to the host is allowed.
+
+        :return: Seconds waited, or None without waiting when the wait would be longer than max_delay
+        """
+        delay = self.reserve(host, max_delay)
+        if delay:
+            time.sleep(delay)
+        return delay
+
+    async def acquire_async(self, host):
+        """Wait in the current asyncio task until a request to the host is allowed"""
+        delay = self.reserve(host)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        return delay
+
+    def defer(self, host, seconds):
+        """Prevent any request to the host for the next seconds, for example after a Retry-After"""
+        with self.lock:
+            now = time.monotonic()
+            bucket = self.bucket_for(host, now)
+            bucket["blocked_until"] = max(bucket["blocked_until"], now + seconds)
+
+
+host_rate_limiter = HostRateLimiter()
+
+
+def increment_connection_stat(name):
+    with connection_stats_lock:
+        connection_stats[name] += 1
+
+
+def get_connection_stats():
+    """
+    Return the connection counters of the shared session.
+
+    "reused" is the number of requests that were sent on an already open connection.
+    """
+    with connection_stats_lock:
+        stats = dict(connection_stats)
+    stats["reused"] = max(0, stats["requests"] - stats["connections"])
+    return stats
+
+
+class CountingHTTPConnectionPool(HTTPConnectionPool):
+    def _new_conn(self):
+        increment_connection_stat("connections")
+        return super()._new_conn()
+
+
+class CountingHTTPSConnectionPool(HTTPSConnectionPool):
+    def _new_conn(self):
+        increment_connection_stat("connections")
+        return super()._new_conn()
+
+
+class PooledHTTPAdapter(HTTPAdapter):
+    """HTTP adapter keeping connections alive, and counting new connections and requests"""
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": CountingHTTPConnectionPool,
+            "https": CountingHTTPSConnectionPool,
+        }
+
+    def send(self, request, **kwargs):
+        increment_connection_stat("requests")
+        return super().send(request, **kwargs)
+
+
+session = None
+session_lock = threading.Lock()
+
+
+def get_session():
+    """
+    Return the requests session shared by all the threads of the process.
+
+    Connections are kept alive in pools of HTTP_POOL_MAXSIZE connections per host,
+    for up to HTTP_POOL_CONNECTIONS hosts.
+    """
+    global session
+
+    with session_lock:
+        if session is None:
+            adapter = PooledHTTPAdapter(
+                pool_connections=HTTP_POOL_CONNECTIONS,
+                pool_maxsize=HTTP_POOL_MAXSIZE,
+            )
+            session = requests.Session()
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+        return session
+
+
+search_service = None
+search_service_lock = threading.Lock()
+search_clients = threading.local()
+
+
+def get_search_service():
+    """Return the Custom Search service, built once per process"""
+    global search_service
+
+    with search_service_lock:
+        if search_service is None:
+            search_service = build("customsearch", "v1", developerKey=GOOGLE_API_KEY)
+            increment_connection_stat("search_services")
+        return search_service
+
+
+def execute_search_request(request):
+    """
+    Execute a Custom Search request.
+
+    The service object is shared, but httplib2 connections are not thread-safe, so each
+    thread keeps its own keep-alive connection to the API.
+    """
+    if not hasattr(search_clients, "http"):
+        search_clients.http = httplib2.Http(timeout=10)
+        increment_connection_stat("search_clients")
+    return request.execute(http=search_clients.http)
@@ -1,37 +1,92 @@
-import os
-import json
 import datetime
 import re
+import json
+import time
+import hashlib
+import threading
+import contextvars
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 
 from pydantic import BaseModel, Field
 from typing import Literal, Union, List
 
 from langchain_openai import ChatOpenAI
 from langchain_core.tools import tool
-from langchain_core.messages import AIMessage
-import tiktoken
+from langchain_core.utils.function_calling import convert_to_openai_tool
+from langchain_core.messages import (
+    AIMessage,
+    convert_to_messages,
+    messages_to_dict,
+    messages_from_dict,
+)
 
 from langgraph.graph import StateGraph, END, MessagesState
 from langgraph.prebuilt import ToolNode
+from langgraph.checkpoint.sqlite import SqliteSaver
+from langgraph.checkpoint.serde.jsonplus import JsonPlusSerializer
 
 from tld import get_tld
 from urllib.parse import urlparse
 
 from constants import (
     SAFETY_TOKEN_LIMIT,
+    SEARCH_TOKEN_BUDGET,
+    SEARCH_DOWNLOAD_DEADLINE,
+    LOCAL_INDEX_RESULTS,
+    LOCAL_INDEX_MIN_SCORE,
     OPENAI_API_KEY,
     MODEL_NAME,
     SMALL_MODEL_NAME,
+    MODEL_CASCADE,
+    CASCADE_MIN_FOUND,
+    EXTRACTION_BATCH_WINDOW,
+    EXTRACTION_BATCH_SIZE,
+    EXTRACTION_SMALL_RETRIES,
+    EXTRACTION_TIMEOUT,
+    MAX_CONCURRENT_QUESTIONS,
+    MAX_CONCURRENT_FOLLOWUPS,
+    MAX_CONCURRENT_LLM_CALLS,
+    LLM_CACHE_MODE,
+    CHECKPOINTS,
+    REASSESS,
+    REASSESS_MAX_AGE,
+    REASSESS_MIN_FOUND,
+    PROMPT_CACHE_MIN_TOKENS,
+    ASSESSMENT_DATE,
 )
 
-from search_code import google_search, download_content, sanitize_text
+from search_code import (
+    google_search,
+    download_content,
+    download_contents,
+    sanitize_text,
+    content_hash,
+)
 
 from prompt_code import update_system_prompt, create_context
+from token_code import (
+    tokenizer,
+    get_tokenizer,
+    token_ledger,
+    current_question,
+    current_assessment,
+)
+from cache_code import answer_store, get_download_cache, llm_cache, connect_sqlite
+from retrieval_code import select_chunks, get_local_index
+from trace_code import tracer, span, traced, current_span
 
 
 llm = ChatOpenAI(model=MODEL_NAME, temperature=0, api_key=OPENAI_API_KEY)
 small_llm = ChatOpenAI(model=SMALL_MODEL_NAME, temperature=0, api_key=OPENAI_API_KEY)
-token_counters = {}
+
+# Number of questions of the current assessment that run at the same time
+concurrent_questions = contextvars.ContextVar(
+    "concurrent_questions", default=MAX_CONCURRENT_QUESTIONS
+)
+
+# Limits the LLM calls in flight across all the questions and assessments of the process
+llm_call_slots = threading.BoundedSemaphore(MAX_CONCURRENT_LLM_CALLS)
 
 
 class Profile(dict):
@@ -40,6 +95,7 @@ class Profile(dict):
     company: str = ""  # Field(description="Official company name")
     product: str = ""  # Field(description="Official product name")
     url: str = ""  # Field(description="URL leading to the product description")
+    date: str = ""  # Date of the assessment, set once when the assessment starts
 
 
 class SearchResponse(BaseModel):
@@ -69,6 +125,11 @@ class AgentState(MessagesState):
     """Final structured response from the agent"""
 
     final_response: SearchResponse = Field(description="Final response to the user")
+    question: str
+    domain: str
+    prompt_cache_key: str
+    budget_exhausted: str
+    model_tier: str
 
 
 @tool
@@ -85,6 +146,7 @@ def search_response(
 
 
 @tool
+@traced("tool.search_google")
 def search_google(query: str, domains: List[str] = None, result_count: int = 3) -> str:
     """Use this to search google.
     The query string is what you are searching for.
@@ -117,129 +179,517 @@ def search_google(query: str, domains: List[str] = None, result_count: int = 3)
 
     nb_results = 5
     results = []
-    for result in clean_search_results[:nb_results]:
-        snippet = download_content(result.get("link"))
-
-        if snippet and num_tokens_from_string(snippet) < SAFETY_TOKEN_LIMIT:
+    snippets = download_contents(
+        [result.get("link") for result in clean_search_results[:nb_results]],
+        deadline=SEARCH_DOWNLOAD_DEADLINE,
+    )
+    candidates = []
+    for result, snippet in zip(clean_search_results[:nb_results], snippets):
+        if snippet:
             result["title"] = sanitize_text(result.get("title"))
             result["snippet"] = sanitize_text(snippet)
+            candidates.append(result)
+        else:
+            print(f"  * Skipping (empty) {result.get('link')}")
+
+    # Encode all the snippets once. Pages over the limit stop being encoded early.
+    with span("tokenize", pages=len(candidates)):
+        candidate_tokens = tokenizer.encode_batch(
+            [r["snippet"] for r in candidates], stop_after=SAFETY_TOKEN_LIMIT
+        )
+
+    tokens = []
+    for result, snippet_tokens in zip(candidates, candidate_tokens):
+        if len(snippet_tokens) < SAFETY_TOKEN_LIMIT:
             results.append(result)
+            tokens.append(snippet_tokens)
         else:
-            print(f"  * Skipping (empty or unsafe) {result.get('link')}")
+            print(f"  * Skipping (unsafe) {result.get('link')}")
 
     if len(results) == 0:
         return "No results found"
 
     # calculate the total length of the snippets
-    lenghts = [num_tokens_from_string(r["snippet"]) for r in results]
+    lenghts = [len(t) for t in tokens]
 
-    limit = SAFETY_TOKEN_LIMIT
-    if sum(lenghts) > SAFETY_TOKEN_LIMIT:
-        limit = min(sum(lenghts) // len(results), SAFETY_TOKEN_LIMIT)
+    # Over the budget, only the chunks of the pages the most relevant to the query are kept
+    selections = None
+    kept_tokens = sum(lenghts)
+    if sum(lenghts) > SEARCH_TOKEN_BUDGET:
+        with span("select_chunks", tokens=sum(lenghts)):
+            selections = select_chunks(tokens, query, SEARCH_TOKEN_BUDGET, tokenizer)
+        kept_tokens = sum(end - start for ranges in selections for start, end in ranges)
+    current_span.get()["attributes"]["tokens"] = kept_tokens
 
     for i, result in enumerate(results):
         title = result.get("title", "")
         snippet = result.get("snippet", "")
 
-        if lenghts[i] > limit:
-            snippet = truncate_to_tokens(snippet, limit)
-            print(f"    ! truncated to {limit} tokens")
+        if selections is None:
+            answers.append(
+                f"URL: {result.get('link')}\nTitle: {title}\nExtract: {(snippet)}"
+            )
+            continue
+
+        if not selections[i]:
+            print(f"  * Skipping (not relevant) {result.get('link')}")
+            continue
+
+        kept = ", ".join([f"{start}-{end}" for start, end in selections[i]])
+        print(f"    ! kept tokens {kept} of {lenghts[i]} from {result.get('link')}")
+        snippet = "\n[...]\n".join(
+            [tokenizer.decode(tokens[i][start:end]) for start, end in selections[i]]
+        )
 
         answers.append(
-            f"URL: {result.get('link')}\nTitle: {title}\nExtract: {(snippet)}"
+            f"URL: {result.get('link')}\nTitle: {title}\nKept tokens: {kept} of {lenghts[i]}\nExtract: {(snippet)}"
         )
 
+    if len(answers) == 0:
+        return "No results found"
+
     stringified = "\n---\n".join(answers)
     return stringified
 
 
 def num_tokens_from_string(string: str, encoding_name: str = "cl100k_base") -> int:
     """Returns the number of tokens in a text string."""
-    encoding = tiktoken.get_encoding(encoding_name)
-    num_tokens = len(encoding.encode(string))
-    return num_tokens
+    return get_tokenizer(encoding_name).count(string)
 
 
 # function that truncates to x tokens
 def truncate_to_tokens(string, tokens):
-    encoding = tiktoken.get_encoding("cl100k_base")
-    return encoding.decode(encoding.encode(string)[:tokens])
+    return tokenizer.truncate(string, tokens)
+
+
+def assessment_key(profile):
+    """Identify the assessment of a profile in the token ledger"""
+    clean_company = clean_string(profile.get("company", ""))
+    clean_product = clean_string(profile.get("product", ""))
+    return f"{clean_company}_{clean_product}"
 
 
-def get_token_counts():
-    return token_counters
+def get_token_counts(profile=None):
+    """Return the token usage per model of the assessment of the profile, or of the last assessment"""
+    assessment = assessment_key(profile) if profile else token_ledger.default_assessment
+    return token_ledger.totals(group_by="model", assessment=assessment)
 
 
-def count_tokens(response):
+def count_tokens(response, node=None, question=None):
     model = response.response_metadata.get("model_name", "unknown")
-    if model not in token_counters:
-        token_counters[model] = {
-            "total": 0,
-            "output": 0,
-            "input": 0,
-            "calls": 0,
-        }
+    input_details = response.usage_metadata.get("input_token_details") or {}
+
+    token_ledger.record(
+        model,
+        response.usage_metadata["input_tokens"],
+        input_details.get("cache_read", 0) or 0,
+        response.usage_metadata["output_tokens"],
+        response.usage_metadata["total_tokens"],
+        node=node,
+        question=question,
+    )
 
-    token_counters[model]["total"] += response.usage_metadata["total_tokens"]
-    token_counters[model]["output"] += response.usage_metadata["output_tokens"]
-    token_counters[model]["input"] += response.usage_metadata["input_tokens"]
-    token_counters[model]["calls"] += 1
 
+class LLMCacheMiss(Exception):
+    """Raised in replay mode when a call is missing from the LLM response cache"""
 
-def reset_token_counts():
-    token_counters = {}
 
+def llm_cache_key(model, input, kwargs):
+    """
+    Hash everything that determines the response of a call: the class and parameters of the
+    model, the bound tools and options, the call options and the full list of messages.
+    """
+    base = getattr(model, "bound", model)
+    bound_kwargs = getattr(model, "kwargs", {})
+    messages = messages_to_dict(
+        convert_to_messages(input if isinstance(input, list) else [("human", input)])
+    )
+    # Message ids are random, and assigned by the graph when the messages are added to the state
+    for message in messages:
+        message["data"].pop("id", None)
+
+    payload = {
+        "class": type(base).__name__,
+        "model": getattr(base, "model_name", None) or getattr(base, "model", None),
+        "parameters": base._identifying_params,
+        "bound": bound_kwargs,
+        "options": kwargs,
+        "messages": messages,
+    }
+    serialized = json.dumps(payload, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(serialized.encode("utf-8")).hexdigest()
 
-# function that extracts the content of a json code block from a string
-def extract_json_block(text):
-    start = text.find("```json")
-    if start == -1:
-        return None
-    end = text.find("```", start + 7)
-    if end == -1:
-        return None
-    try:
-        return json.loads(text[start + 7 : end])
-    except Exception as e:
-        print("Error parsing JSON block:", e)
-        return None
 
+def invoke_llm(model, input, node=None, question=None, mode=None, **kwargs):
+    """
+    Call a chat model, counting its tokens, within the global limit of LLM calls.
 
-def find_content(parameter, context):
+    With the LLM response cache enabled, identical calls are answered from the cache and
+    counted as calls without cost. In "replay" mode, calls missing from the cache raise LLMCacheMiss.
+    """
+    mode = mode or LLM_CACHE_MODE
+    key = None
+    if mode in ["on", "replay"]:
+        key = llm_cache_key(model, input, kwargs)
+        cached = llm_cache.get(key)
+        if cached is not None:
+            response = messages_from_dict([json.loads(cached)])[0]
+            input_details = response.usage_metadata.get("input_token_details") or {}
+            token_ledger.record_cache_hit(
+                response.response_metadata.get("model_name", "unknown"),
+                response.usage_metadata["input_tokens"],
+                input_details.get("cache_read", 0) or 0,
+                response.usage_metadata["output_tokens"],
+                node=node,
+                question=question,
+            )
+            parent = current_span.get()
+            if parent is not None:
+                parent["attributes"]["cached"] = True
+            return response
+        if mode == "replay":
+            raise LLMCacheMiss(f"No cached response for the {node} call {key}")
+
+    with llm_call_slots:
+        response = model.invoke(input, **kwargs)
+    count_tokens(response, node=node, question=question)
+
+    if key is not None:
+        llm_cache.put(
+            key,
+            response.response_metadata.get("model_name", "unknown"),
+            json.dumps(messages_to_dict([response])[0], ensure_ascii=False),
+        )
+    return response
+
+
+def reset_token_counts(profile):
+    token_ledger.start_assessment(assessment_key(profile))
+
+
+class Extraction(BaseModel):
+    """Items listed in one of the contexts"""
+
+    context: int = Field(description="Number of the context")
+    items: List[str] = Field(
+        description="Items mentioned in the context, each as a short name. Empty if none"
+    )
+
+
+class Extractions(BaseModel):
+    """Items mentioned in each of the contexts"""
 
-    question = f"""In the following context, list all {parameter} mentioned. Return the list as an array of strings. If none, return an empty array.
+    extractions: List[Extraction] = Field(description="One extraction per context")
 
-Context: 
+
+def extraction_prompt(requests):
+    prompt = "For each of the following contexts, list all the requested items mentioned in the context. Return one extraction per context, with an empty list of items if none are mentioned.\n"
+    for i, (parameter, context) in enumerate(requests):
+        prompt += f"""
+Context {i + 1}. Items: {parameter}
 {context}
 """
+    return prompt
 
-    try:
-        output = small_llm.invoke(input=question)
-        count_tokens(output)
-        return extract_json_block(output.content)
-    except:
-        print("! FAILED:", output)
-        print("Trying again with a bigger model")
 
-        output = llm.invoke(input=question)
-        count_tokens(output)
-        return extract_json_block(output.content)
+def parse_extractions(output, count):
+    """
+    Validate the Extractions tool call of a model output.
+
+    :return: List of the items of each of the count contexts, in order
+    :raise ValueError: If the output has no valid extraction for every context
+    """
+    tool_calls = [t for t in output.tool_calls if t["name"] == "Extractions"]
+    if not tool_calls:
+        raise ValueError("no Extractions tool call")
+
+    extractions = Extractions.model_validate(tool_calls[0]["args"]).extractions
+    items = {e.context: e.items for e in extractions}
+    missing = [i for i in range(1, count + 1) if i not in items]
+    if missing:
+        raise ValueError(f"no extraction for the contexts {missing}")
+
+    return [
+        list(dict.fromkeys(item.strip() for item in items[i] if item.strip()))
+        for i in range(1, count + 1)
+    ]
+
+
+def extract_entities(requests, small_retries=EXTRACTION_SMALL_RETRIES):
+    """
+    Extract lists of items from several contexts with a single tool-constrained request.
+
+    The output is validated locally. Invalid outputs are retried on the small model with the
+    validation error, then once on the large model.
+
+    :param requests: List of (parameter, context), where parameter describes the items to list
+    :return: List of the items found in each context, or None for all if every attempt failed
+    """
+    prompt = extraction_prompt(requests)
+    messages = [("human", prompt)]
+    attempts = [small_llm] * (1 + max(0, small_retries)) + [llm]
+
+    for attempt, model in enumerate(attempts):
+        try:
+            with span("llm.find_content", contexts=len(requests)):
+                output = invoke_llm(
+                    model.bind_tools([Extractions], tool_choice="Extractions"),
+                    messages,
+                    node="find_content",
+                )
+            return parse_extractions(output, len(requests))
+        except LLMCacheMiss:
+            raise
+        except Exception as e:
+            error = str(e)
+            print(f"! Invalid extraction (attempt {attempt + 1}/{len(attempts)}): {error}")
+
+        if model is small_llm and attempts[attempt + 1] is llm:
+            token_ledger.record_escalation(SMALL_MODEL_NAME, f"invalid extraction: {error}")
+        messages = [
+            ("human", prompt),
+            ("human", f"The previous extraction was invalid: {error}. Call Extractions again."),
+        ]
+
+    return [None] * len(requests)
+
+
+class ExtractionBatcher:
+    """
+    Group the extractions requested at about the same time into a single request.
+
+    The first caller waits up to `window` seconds for others, or until `max_size` requests are
+    pending, then sends the batch from its own thread while the others wait for their result,
+    for up to `timeout` seconds, after which they give up and return None like a failed
+    extraction. When the questions run one at a time, no request can join
+    and the first caller sends its request without waiting.
+    Batches never mix the requests of different assessments, to keep the token ledger accurate.
+
+    When the LLM cache is used, each request is sent alone: the contexts grouped in a batch
+    depend on the timing of the threads, so batched prompts could not be replayed.
+    """
+
+    def __init__(
+        self,
+        window=EXTRACTION_BATCH_WINDOW,
+        max_size=EXTRACTION_BATCH_SIZE,
+        timeout=EXTRACTION_TIMEOUT,
+    ):
+        self.window = window
+        self.max_size = max(1, max_size)
+        self.timeout = timeout
+        self.condition = threading.Condition()
+        self.pending = {}
+
+    def extract(self, parameter, context):
+        if LLM_CACHE_MODE in ["on", "replay"]:
+            try:
+                return extract_entities([(parameter, context)])[0]
+            except LLMCacheMiss:
+                raise
+            except Exception as e:
+                print(f"! Extraction failed: {e}")
+                return None
+
+        assessment = current_assessment.get()
+        request = {
+            "request": (parameter, context),
+            "done": threading.Event(),
+            "result": None,
+            "error": None,
+        }
+
+        with self.condition:
+            batch = self.pending.setdefault(assessment, [])
+            batch.append(request)
+            leader = len(batch) == 1
+            if len(batch) >= self.max_size:
+                self.condition.notify_all()
+
+        if not leader:
+            if not request["done"].wait(self.timeout):
+                print(f"! Extraction of {parameter} not done after {self.timeout}s")
+                return None
+            if request["error"]:
+                raise request["error"]
+            return request["result"]
+
+        window = self.window if concurrent_questions.get() > 1 else 0
+        deadline = time.monotonic() + window
+        with self.condition:
+            while len(self.pending[assessment]) < self.max_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+            batch = self.pending.pop(assessment)
+
+        error = None
+        results = [None] * len(batch)
+        try:
+            results = extract_entities([r["request"] for r in batch])
+        except LLMCacheMiss as e:
+            error = e
+        except Exception as e:
+            print(f"! Extraction failed: {e}")
+        finally:
+            # The others are always released, even if this thread is interrupted
+            for r, result in zip(batch, results):
+                r["result"] = result
+                r["error"] = error
+                r["done"].set()
+        if error:
+            raise error
+        return request["result"]
+
+
+extraction_batcher = ExtractionBatcher()
+
 
+@traced("find_content")
+def find_content(parameter, context):
+    """
+    List the items described by parameter mentioned in the context, for example the
+    sub-processors mentioned in an answer. Returns a list of strings, or None on failure.
+    """
+    return extraction_batcher.extract(parameter, context)
+
+
+checkpointers = {}
+checkpointers_lock = threading.Lock()
+
+
+def get_checkpointer(path=CHECKPOINTS):
+    """Return the SQLite checkpointer of the graph runs stored in path, shared by the whole process"""
+    with checkpointers_lock:
+        if path not in checkpointers:
+            # The final responses stored in the state are allowed to be restored
+            serde = JsonPlusSerializer(
+                allowed_msgpack_modules=[
+                    (__name__, "SearchResponse"),
+                    (__name__, "DefeatResponse"),
+                ]
+            )
+            checkpointers[path] = SqliteSaver(
+                connect_sqlite(path, check_same_thread=False), serde=serde
+            )
+        return checkpointers[path]
+
+
+def build_graph(cascade=MODEL_CASCADE, checkpoints=CHECKPOINTS):
+    """
+    Build the agent graph.
 
-def build_graph():
+    :param cascade: Run the agent turns with the small model first, and escalate to the large
+                    model when its answer is not good enough (default: MODEL_CASCADE)
+    :param checkpoints: SQLite file where each step of the runs is saved, so that an interrupted
+                        question resumes from its last step. Empty to disable (default: CHECKPOINTS)
+    """
     tools = [search_google, search_response]
+    tool_names = [t.name for t in tools]
     model_with_response_tool = llm.bind_tools(tools, tool_choice="any")
+    small_model_with_response_tool = small_llm.bind_tools(tools, tool_choice="any")
+
+    def local_search(state: AgentState):
+        """Look for the answer in the pages already downloaded from the vendor domain."""
+        domain = state.get("domain")
+        question = state.get("question")
+        if not domain or not question:
+            return {}
+
+        with span("local_search", domain=domain):
+            index = get_local_index(domain)
+            index.sync(get_download_cache())
+            hits = index.search(question, k=LOCAL_INDEX_RESULTS)
+
+        if not hits or hits[0]["score"] < LOCAL_INDEX_MIN_SCORE:
+            return {}
+
+        print(f"  * Found {len(hits)} local extracts (best score {hits[0]['score']:0.2f})")
+        extracts = "\n---\n".join(
+            [f"URL: {hit['url']}\nExtract: {hit['text']}" for hit in hits]
+        )
+        return {
+            "messages": [
+                (
+                    "human",
+                    f"Extracts of pages from {domain} downloaded earlier. If they answer the question, use them. Otherwise, search google.\n\n{extracts}",
+                )
+            ]
+        }
 
-    def call_model(state: AgentState):
-        """Call the model with the response tool."""
+    def invoke_model(model, state, kwargs, tier):
         try:
-            response = model_with_response_tool.invoke(state["messages"])
-            count_tokens(response)
+            with span("llm.agent", tier=tier):
+                return invoke_llm(
+                    model,
+                    state["messages"],
+                    node="agent",
+                    question=state.get("question"),
+                    **kwargs,
+                )
+        except LLMCacheMiss:
+            raise
         except Exception as e:
             print(f"! Error in call_model: {str(e)}")
+            return None
+
+    def escalation_reason(response):
+        """Return why the response of the small model must be escalated, or None if it is good enough"""
+        if response is None:
+            return "model call failed"
+        if response.invalid_tool_calls or not response.tool_calls:
+            return "no valid tool call"
+
+        tool_call = response.tool_calls[0]
+        if tool_call["name"] not in tool_names:
+            return f"unknown tool {tool_call['name']}"
+        if tool_call["name"] == "search_response":
+            try:
+                found = float(tool_call["args"].get("found", 0))
+            except (TypeError, ValueError):
+                return "invalid found score"
+            if found < CASCADE_MIN_FOUND:
+                return f"found {found} below {CASCADE_MIN_FOUND}"
+        return None
+
+    def call_model(state: AgentState):
+        """Call the model with the response tool."""
+        # Calls sharing the same prompt prefix are routed to the same provider cache
+        kwargs = {}
+        if state.get("prompt_cache_key"):
+            kwargs["prompt_cache_key"] = state["prompt_cache_key"]
+
+        exhausted = token_ledger.budget_exhausted(question=state.get("question"))
+        if exhausted:
+            print(f"! {exhausted}")
+            return {
+                "messages": [AIMessage(content=exhausted)],
+                "budget_exhausted": exhausted,
+            }
+
+        # Once escalated, the following turns of the question stay on the large model
+        tier = state.get("model_tier") or ("small" if cascade else "large")
+        if tier == "small":
+            response = invoke_model(small_model_with_response_tool, state, kwargs, tier)
+            reason = escalation_reason(response)
+            if not reason:
+                return {"messages": [response], "model_tier": tier}
+
+            model = (
+                response.response_metadata.get("model_name", SMALL_MODEL_NAME)
+                if response is not None
+                else SMALL_MODEL_NAME
+            )
+            print(f"  * Escalating to the large model: {reason}")
+            token_ledger.record_escalation(model, reason, question=state.get("question"))
+            tier = "large"
+
+        response = invoke_model(model_with_response_tool, state, kwargs, tier)
+        if response is None:
             response = AIMessage(content="Response not found.")
 
-        return {"messages": [response]}
+        return {"messages": [response], "model_tier": tier}
 
     def respond(state: AgentState):
         """Respond to the user with the final answer."""
@@ -263,13 +713,17 @@ def build_graph():
     def give_up(state: AgentState):
         """Tell the graph to give up."""
         print("! Giving up")
-        return {"final_response": DefeatResponse(answer="No answer found")}
+        answer = state.get("budget_exhausted") or "No answer found"
+        return {"final_response": DefeatResponse(answer=answer)}
 
     def should_continue(state: AgentState) -> str:
         """Check if the agent should continue or respond to the user."""
         messages = state["messages"]
         last_message = messages[-1]
 
+        if state.get("budget_exhausted"):
+            return "giveup"
+
         attempts = [m for m in messages if hasattr(m, "tool_calls")]
         if len(attempts) > 3 or len(messages) > 20:
             print("! Too many attempts, giving up", len(attempts), len(messages))
@@ -287,14 +741,16 @@ def build_graph():
     workflow = StateGraph(AgentState)
 
     # Define the two nodes we will cycle between
+    workflow.add_node("local_search", local_search)
     workflow.add_node("agent", call_model)
     workflow.add_node("tools", ToolNode(tools))
     workflow.add_node("respond", respond)
     workflow.add_node("giveup", give_up)
 
-    # Set the entrypoint as `agent`
-    # This means that this node is the first one called
-    workflow.set_entry_point("agent")
+    # Set the entrypoint as `local_search`
+    # This means that this node is the first one called, before `agent`
+    workflow.set_entry_point("local_search")
+    workflow.add_edge("local_search", "agent")
 
     # We now add a conditional edge
     workflow.add_conditional_edges(
@@ -311,27 +767,64 @@ def build_graph():
     workflow.add_edge("respond", END)
     workflow.add_edge("giveup", END)
 
-    graph = workflow.compile()
+    graph = workflow.compile(
+        checkpointer=get_checkpointer(checkpoints) if checkpoints else None
+    )
 
     return graph
 
 
+def question_thread_id(profile, question):
+    """Identify the checkpoints of a question, the same across runs of the assessment"""
+    digest = hashlib.sha1(question.encode("utf-8")).hexdigest()[:16]
+    return f"{assessment_key(profile)}:{digest}"
+
+
+def run_checkpointed(graph, initial_state, config):
+    """Run the graph on the thread of the config, resuming the run interrupted on this thread if any"""
+    snapshot = graph.get_state(config)
+    if snapshot.next:
+        print(f"  * Resuming from the checkpoint before {', '.join(snapshot.next)}")
+        return graph.invoke(None, config=config)
+    if snapshot.values.get("final_response"):
+        # The run finished, but its answer was not saved before the interruption
+        print("  * Reusing the answer of an interrupted run")
+        return snapshot.values
+    if snapshot.values:
+        graph.checkpointer.delete_thread(config["configurable"]["thread_id"])
+    return graph.invoke(input=initial_state, config=config)
+
+
+def release_checkpoints(graph, profile, questions):
+    """Delete the checkpoints of questions whose answer is saved, or that must be asked again"""
+    if not getattr(graph, "checkpointer", None):
+        return
+    for question in questions:
+        graph.checkpointer.delete_thread(question_thread_id(profile, question))
+
+
 def find_answer_to_question(graph, question, previous_answers, profile, domain):
     if not question.get("main", None):
         print("! No query provided")
         return None
 
+    # The system prompt is the same for all the questions of an assessment, so that
+    # it forms a stable prefix with the tool schemas for provider-side prompt caching.
+    # Everything specific to the question comes after it.
     system_prompt = update_system_prompt(profile, domain)
-    context = create_context(previous_answers)
     goal = question.get("goal", "Answer the question")
     main = question.get("main")
+    with span("context"):
+        context = create_context(
+            previous_answers, question=main, dependencies=question.get("depends_on")
+        )
     expected = question.get("expected")
     full_query = f"Goal: {goal}\nQuestion: {main}"
     if expected:
         full_query += f"\nExpected: {expected}"
 
     if len(previous_answers) > 0:
-        full_query = f"Previous answers:\n{context}\n\n{full_query}"
+        full_query = f"{full_query}\n\nPrevious answers:\n{context}"
 
     print(f"* Q. {question.get('main', '')}")
 
@@ -339,56 +832,193 @@ def find_answer_to_question(graph, question, previous_answers, profile, domain):
         "messages": [
             ("system", system_prompt),
             ("human", full_query),
-        ]
+        ],
+        "question": main,
+        "domain": domain,
+        "prompt_cache_key": f"{clean_string(profile.get('company', ''))}_{clean_string(profile.get('product', ''))}",
     }
 
-    result = graph.invoke(input=initial_state, config={"recursion_limit": 25})
+    config = {"recursion_limit": 25}
+    token = current_question.set(main)
+    try:
+        with span("graph"):
+            if getattr(graph, "checkpointer", None):
+                config["configurable"] = {"thread_id": question_thread_id(profile, main)}
+                result = run_checkpointed(graph, initial_state, config)
+            else:
+                result = graph.invoke(input=initial_state, config=config)
+    finally:
+        current_question.reset(token)
     answer = result["final_response"]
 
     return answer
 
 
+def prompt_prefix_tokens(profile, domain):
+    """
+    Number of tokens of the prefix shared by the first agent call of every question of an
+    assessment: the schemas of the agent tools and the system prompt. The later calls of a
+    question also share the question and the results of its tool calls.
+    The provider serializes the tool schemas in its own format, so this is an estimate.
+    """
+    tools = [convert_to_openai_tool(t) for t in [search_google, search_response]]
+    return tokenizer.count(json.dumps(tools)) + tokenizer.count(
+        update_system_prompt(profile, domain)
+    )
+
+
 def save_answer_to_cache(
-    question, answer, profile, domain, answer_cache, label, followup
+    question, answer, profile, domain, answer_cache, label, followup, replace=False
 ):
-    all_answers = []
+    save_answers_to_cache(
+        [
+            {
+                "question": question,
+                "answer": answer,
+                "label": label,
+                "followup": followup,
+            }
+        ],
+        profile,
+        domain,
+        answer_cache,
+        replace,
+    )
 
-    if os.path.exists(answer_cache):
-        with open(answer_cache, "r", encoding="utf-8") as f:
-            all_answers = json.load(f)
 
-    if question in [a["question"] for a in all_answers]:
-        return
+def answer_sources(answer):
+    """
+    Return the hash of the text of each page cited by the answer, from the download cache.
+    Pages missing from the cache are not downloaded, and have a None hash.
+    """
+    urls = re.findall(r"https?://[^\s,;<>()\[\]]+", answer.url or "")
+    cache = get_download_cache()
+    hashes = {}
+    for url in dict.fromkeys(urls):
+        entry = cache.get(url)
+        hashes[url] = content_hash(entry["content"]) if entry else None
+    return hashes
 
-    all_answers.append(
-        {
-            "company": profile.get("company"),
-            "product": profile.get("product"),
-            "url": profile.get("url"),
-            "domain": domain,
-            "question": question,
-            "label": label,
-            "followup": followup,
-            "answer": answer.dict(),
-            "timestamp": datetime.datetime.now().isoformat(),
-        }
-    )
 
-    with open(answer_cache, "w", encoding="utf-8") as f:
-        json.dump(all_answers, f, indent=2, ensure_ascii=False)
+def save_answers_to_cache(answers, profile, domain, answer_cache, replace=False):
+    """
+    Save a batch of answers to the cache with a single transaction, with the hash of the
+    pages they cite. Existing answers are only overwritten when replace is True.
+    """
+    timestamp = datetime.datetime.now().isoformat()
+    sources = [answer_sources(answer["answer"]) for answer in answers]
+
+    answer_cache.put_many(
+        [
+            {
+                "company": profile.get("company"),
+                "product": profile.get("product"),
+                "url": profile.get("url"),
+                "domain": domain,
+                "question": answer["question"],
+                "label": answer["label"],
+                "followup": answer["followup"],
+                "answer": answer["answer"].dict(),
+                "sources": hashes,
+                "timestamp": timestamp,
+            }
+            for answer, hashes in zip(answers, sources)
+        ],
+        replace,
+    )
 
 
 def load_answer_from_cache(question, answer_cache):
-    answers = []
-    if os.path.exists(answer_cache):
-        with open(answer_cache, "r", encoding="utf-8") as f:
-            answers = json.load(f)
+    return load_answers_from_cache([question], answer_cache).get(question)
+
+
+def load_answers_from_cache(questions, answer_cache):
+    """Return a dictionary of the cached answers for the questions"""
+    existings = answer_cache.get_many(questions)
+
+    return {
+        question: SearchResponse(**answer) for question, answer in existings.items()
+    }
+
+
+class Reassessment:
+    """
+    Choose the cached answers asked again by a re-assessment, and record the status of each
+    answer: "unchanged" when the cached answer is kept, "refreshed" when it is asked again,
+    or "new" when the question was never answered.
+
+    A cached answer is asked again when its confidence is under min_found, when it is older
+    than max_age seconds, or when the text of a page it cites changed or is no longer
+    available. Each cited page is downloaded again once per assessment.
+    """
 
-    existings = [a for a in answers if a["question"] == question]
-    if len(existings) > 0:
-        return SearchResponse(**existings[0]["answer"])
+    def __init__(self, answer_cache, max_age=REASSESS_MAX_AGE, min_found=REASSESS_MIN_FOUND):
+        self.answer_cache = answer_cache
+        self.max_age = max_age
+        self.min_found = min_found
+        self.lock = threading.Lock()
+        self.url_locks = {}
+        self.hashes = {}
+        self.statuses = {}
+
+    def current_hash(self, url):
+        """Hash of the page downloaded again, bypassing the download cache"""
+        with self.lock:
+            url_lock = self.url_locks.setdefault(url, threading.Lock())
+        with url_lock:
+            if url not in self.hashes:
+                self.hashes[url] = content_hash(download_content(url, cache_duration=0))
+            return self.hashes[url]
+
+    def refresh_reason(self, answer, evidence):
+        """Return why a cached answer must be asked again, or None to keep it"""
+        if answer.found < self.min_found:
+            return f"low confidence ({answer.found})"
+        if not evidence or not evidence["sources"]:
+            return "no recorded sources"
+
+        if self.max_age:
+            try:
+                saved = datetime.datetime.fromisoformat(evidence["timestamp"])
+            except (TypeError, ValueError):
+                return "unknown age"
+            if (datetime.datetime.now() - saved).total_seconds() > self.max_age:
+                return f"older than {self.max_age // 86400} days"
+
+        for url, digest in evidence["sources"].items():
+            if digest is None:
+                return f"source not cached when answered: {url}"
+            current = self.current_hash(url)
+            if current is None:
+                return f"source unavailable: {url}"
+            if current != digest:
+                return f"source changed: {url}"
+        return None
 
-    return None
+    def keep(self, cached):
+        """
+        Record the status of cached answers, and return those that don't need to be asked again.
+
+        :param cached: Dictionary of the cached answers of the questions
+        """
+        evidence = self.answer_cache.get_evidence(list(cached))
+        kept = {}
+        for question, answer in cached.items():
+            reason = self.refresh_reason(answer, evidence.get(question))
+            with self.lock:
+                if reason:
+                    self.statuses[question] = {"status": "refreshed", "reason": reason}
+                else:
+                    self.statuses[question] = {"status": "unchanged"}
+            if reason:
+                print(f"  * Refreshing ({reason}): {question}")
+            else:
+                kept[question] = answer
+        return kept
+
+    def status_of(self, question):
+        with self.lock:
+            return dict(self.statuses.get(question, {"status": "new"}))
 
 
 def clean_string(text):
@@ -399,39 +1029,137 @@ def clean_string(text):
     return cleaned.lower()
 
 
-def answer_all_questions(
-    questions,
+def index_of_question(answers, q):
+    for i, a in enumerate(answers):
+        if a["question"] == q:
+            return i
+    return -1
+
+
+def question_dependencies(questions):
+    """
+    Map each question index to the indices of the questions it depends on.
+
+    Questions can be given an optional "id", and list the ids of earlier questions
+    they need in "depends_on". A dependency must point to an earlier question so the
+    report order stays the same as the order of the questions.
+    """
+    ids = {}
+    for i, question in enumerate(questions):
+        if question.get("id"):
+            ids[question["id"]] = i
+
+    dependencies = {}
+    for i, question in enumerate(questions):
+        dependencies[i] = []
+        for dependency in question.get("depends_on", []):
+            if dependency not in ids:
+                raise ValueError(
+                    f"Unknown dependency '{dependency}' for question: {question.get('main')}"
+                )
+            if ids[dependency] >= i:
+                raise ValueError(
+                    f"Dependency '{dependency}' must be asked before question: {question.get('main')}"
+                )
+            dependencies[i].append(ids[dependency])
+
+    return dependencies
+
+
+def answer_followups(
+    followups,
     graph,
+    previous_answers,
     profile,
     domain,
+    answer_cache,
+    label,
+    question_id=None,
+    max_workers=MAX_CONCURRENT_FOLLOWUPS,
+    reassessment=None,
 ):
-    print(
-        f"Searching the internet for answers about {profile.get('company')} - {profile.get('product')}"
-    )
-    answers = []
-    clean_company = clean_string(profile.get("company", ""))
-    clean_product = clean_string(profile.get("product", ""))
-    f_company_product = f"{clean_company}_{clean_product}"
+    """
+    Answer a batch of follow-up questions in parallel.
 
-    answer_cache = f"assessment_answers_{f_company_product}.json"
+    The answers are returned in the same order as the follow-ups, and the new
+    answers are saved to the cache with a single write once the batch is done.
+    """
+    cached = load_answers_from_cache(followups, answer_cache)
+    if reassessment:
+        cached = reassessment.keep(cached)
+
+    def answer_followup(followup):
+        with span("question", question=followup, followup=True) as question_span:
+            question_span["attributes"]["cached"] = followup in cached
+            if followup in cached:
+                return cached[followup]
+
+            return find_answer_to_question(
+                graph,
+                {
+                    "goal": "This is a follow up question",
+                    "main": followup,
+                    "depends_on": [question_id] if question_id else [],
+                },
+                previous_answers,
+                profile,
+                domain,
+            )
+
+    # Each follow-up runs in a copy of the current context, to keep the assessment of the token ledger
+    contexts = [contextvars.copy_context() for _ in followups]
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        followup_answers = list(
+            executor.map(
+                lambda context, followup: context.run(answer_followup, followup),
+                contexts,
+                followups,
+            )
+        )
+
+    new_answers = [
+        {
+            "question": followup,
+            "answer": followup_answer,
+            "label": label,
+            "followup": True,
+        }
+        for followup, followup_answer in zip(followups, followup_answers)
+        if followup not in cached and type(followup_answer) == SearchResponse
+    ]
+    if new_answers:
+        save_answers_to_cache(
+            new_answers, profile, domain, answer_cache, replace=bool(reassessment)
+        )
+    # Until the answers are saved, the checkpoints allow resuming the follow-ups after a crash
+    release_checkpoints(
+        graph, profile, [followup for followup in followups if followup not in cached]
+    )
 
-    j = 0
-    k = 0
+    return followup_answers
 
-    def index_of_question(answers, q):
-        for i, a in enumerate(answers):
-            if a["question"] == q:
-                return i
-        return -1
 
-    for i, question in enumerate(questions):
-        label = question.get("label", "General")
-        k = 0
+def answer_question(
+    question, graph, previous_answers, profile, domain, answer_cache, reassessment=None
+):
+    """
+    Answer a question and its follow-ups, returning the rows to add to the answers.
+    In a re-assessment, the rows also have the status of each answer.
+    """
+    label = question.get("label", "General")
+    question_id = question.get("id", question["main"])
+    answers = []
 
+    with span("question", question=question["main"]) as question_span:
         answer = load_answer_from_cache(question["main"], answer_cache)
+        if answer and reassessment:
+            answer = reassessment.keep({question["main"]: answer}).get(question["main"])
+        question_span["attributes"]["cached"] = bool(answer)
 
         if not answer:
-            answer = find_answer_to_question(graph, question, answers, profile, domain)
+            answer = find_answer_to_question(
+                graph, question, previous_answers, profile, domain
+            )
             if type(answer) == SearchResponse:
                 save_answer_to_cache(
                     question["main"],
@@ -441,66 +1169,205 @@ def answer_all_questions(
                     answer_cache,
                     label,
                     False,
+                    replace=bool(reassessment),
                 )
+            release_checkpoints(graph, profile, [question["main"]])
 
-        idx = index_of_question(answers, question["main"])
-        if idx == -1:
-            answers.append(
-                {
-                    "question": question["main"],
-                    "answer": answer,
-                    "label": label,
-                    "followup": False,
-                }
-            )
+    answers.append(
+        {
+            "question": question["main"],
+            "question_id": question_id,
+            "answer": answer,
+            "label": label,
+            "followup": False,
+        }
+    )
+    if reassessment:
+        answers[-1].update(reassessment.status_of(question["main"]))
 
-        if question.get("function") and type(answer) == SearchResponse:
-            result = question["function"](
-                question.get("parameter", "listed items"), answer.answer
+    if question.get("function") and type(answer) == SearchResponse:
+        result = question["function"](
+            question.get("parameter", "listed items"), answer.answer
+        )
+        if type(result) == list:
+            followups = []
+            for followup in question.get("followup", []):
+                for r in result:
+                    modified_followup = str(followup).replace("PLACEHOLDER", r)
+                    if modified_followup not in followups:
+                        followups.append(modified_followup)
+
+            followup_answers = answer_followups(
+                followups,
+                graph,
+                previous_answers + answers,
+                profile,
+                domain,
+                answer_cache,
+                label,
+                question_id,
+                reassessment=reassessment,
             )
-            if type(result) == list:
-                for followup in question.get("followup", []):
-                    for r in result:
-                        k += 1
-                        modified_followup = str(followup).replace("PLACEHOLDER", r)
-                        followup_answer = load_answer_from_cache(
-                            modified_followup, answer_cache
-                        )
-
-                        if not followup_answer:
-                            followup_answer = find_answer_to_question(
-                                graph,
-                                {
-                                    "goal": "This is a follow up question",
-                                    "main": modified_followup,
-                                },
-                                answers,
-                                profile,
-                                domain,
-                            )
-
-                            if type(followup_answer) == SearchResponse:
-                                save_answer_to_cache(
-                                    modified_followup,
-                                    followup_answer,
-                                    profile,
-                                    domain,
-                                    answer_cache,
-                                    label,
-                                    True,
-                                )
-
-                        idx = index_of_question(answers, modified_followup)
-
-                        if idx == -1:
-                            answers.append(
-                                {
-                                    "question": modified_followup,
-                                    "answer": followup_answer,
-                                    "label": label,
-                                    "followup": True,
-                                }
-                            )
+
+            for modified_followup, followup_answer in zip(
+                followups, followup_answers
+            ):
+                if index_of_question(answers, modified_followup) == -1:
+                    answers.append(
+                        {
+                            "question": modified_followup,
+                            "question_id": question_id,
+                            "answer": followup_answer,
+                            "label": label,
+                            "followup": True,
+                        }
+                    )
+                    if reassessment:
+                        answers[-1].update(reassessment.status_of(modified_followup))
+
+    return answers
+
+
+def iter_question_answers(
+    questions,
+    graph,
+    profile,
+    domain,
+    max_workers=MAX_CONCURRENT_QUESTIONS,
+    reassess=False,
+):
+    """
+    Answer the questions, yielding (index of the question, rows) as soon as each question
+    and its follow-ups are answered. See answer_all_questions for the scheduling.
+
+    The rows of a question are only kept while a question still to be asked depends on
+    them, or for the whole run with max_workers=1.
+    """
+    print(
+        f"Searching the internet for answers about {profile.get('company')} - {profile.get('product')}"
+    )
+    clean_company = clean_string(profile.get("company", ""))
+    clean_product = clean_string(profile.get("product", ""))
+    f_company_product = f"{clean_company}_{clean_product}"
+
+    # The date is fixed for the whole assessment, to keep the system prompt identical
+    if not profile.get("date"):
+        profile = Profile({**profile, "date": assessment_date(profile)})
+    if LLM_CACHE_MODE == "on":
+        llm_cache.set_recording_date(assessment_key(profile), profile["date"])
+    prefix_tokens = prompt_prefix_tokens(profile, domain)
+    if prefix_tokens < PROMPT_CACHE_MIN_TOKENS:
+        print(
+            f"* The prompt prefix shared by the questions has {prefix_tokens} tokens, under the "
+            f"{PROMPT_CACHE_MIN_TOKENS} cached by the provider: only the later calls of each question are cached"
+        )
+
+    answer_cache = answer_store.for_product(clean_company, clean_product)
+    # Answers cached by previous versions are imported once
+    answer_cache.import_json(f"assessment_answers_{f_company_product}.json")
+    reassessment = Reassessment(answer_cache) if reassess else None
+
+    dependencies = question_dependencies(questions)
+    results = {}
+    statuses = []
+
+    def previous_answers_for(i):
+        if max_workers <= 1:
+            indices = range(i)
+        else:
+            indices = dependencies[i]
+        return [row for j in indices for row in results[j]]
+
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        pending = set(range(len(questions)))
+        running = {}
+
+        while pending or running:
+            for i in sorted(pending):
+                if max_workers <= 1 and running:
+                    break
+                if all(j in results for j in dependencies[i]):
+                    context = contextvars.copy_context()
+                    context.run(concurrent_questions.set, max_workers)
+                    future = executor.submit(
+                        context.run,
+                        answer_question,
+                        questions[i],
+                        graph,
+                        previous_answers_for(i),
+                        profile,
+                        domain,
+                        answer_cache,
+                        reassessment,
+                    )
+                    running[future] = i
+                    pending.remove(i)
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                i = running.pop(future)
+                results[i] = future.result()
+                statuses.extend(row.get("status") for row in results[i])
+                yield i, results[i]
+
+            if max_workers > 1:
+                needed = {j for i in pending for j in dependencies[i]}
+                results = {j: rows for j, rows in results.items() if j in needed}
+
+    if reassessment:
+        print(
+            f"* Re-assessment: {statuses.count('unchanged')} unchanged, "
+            f"{statuses.count('refreshed')} refreshed, {statuses.count('new')} new answers"
+        )
+
+
+def assessment_date(profile):
+    """
+    Date given to the model as today: the date of the profile, else ASSESSMENT_DATE, else
+    in replay mode the date the calls of the assessment were recorded, else the current date.
+    The date is part of the system prompt, so a replay needs the date of the recording.
+    """
+    if profile.get("date"):
+        return profile["date"]
+    if ASSESSMENT_DATE:
+        return ASSESSMENT_DATE
+    if LLM_CACHE_MODE == "replay":
+        recorded = llm_cache.recording_date(assessment_key(profile))
+        if recorded:
+            return recorded
+    return datetime.datetime.now().strftime("%Y-%m-%d")
+
+
+def answer_all_questions(
+    questions,
+    graph,
+    profile,
+    domain,
+    max_workers=MAX_CONCURRENT_QUESTIONS,
+    reassess=False,
+):
+    """
+    Answer all the questions, running independent questions concurrently.
+
+    With max_workers=1, questions are asked one after another and each question
+    receives every previous answer as context. Otherwise, questions only receive the
+    answers of the questions listed in their "depends_on", and are started as soon
+    as these are answered. The answers are always returned in the order of the questions.
+
+    With reassess, cached answers are only asked again when their sources changed, they
+    expired or their confidence is low (see Reassessment), and each row has a status.
+    """
+    results = dict(
+        iter_question_answers(
+            questions, graph, profile, domain, max_workers=max_workers, reassess=reassess
+        )
+    )
+
+    answers = []
+    for i in range(len(questions)):
+        for row in results[i]:
+            if index_of_question(answers, row["question"]) == -1:
+                answers.append(row)
 
     return answers
 
@@ -526,16 +1393,69 @@ def extract_domain(url):
         return domain.split("www.")[-1]
 
 
-def perform_assessment(questions, profile, graph):
-    reset_token_counts()
+@contextmanager
+def assessment_run(profile):
+    """Reset the token counts of the assessment of the profile, and trace it until the end of the block"""
+    reset_token_counts(profile)
+
+    key = assessment_key(profile)
+    with tracer.start_trace("assessment", assessment=key) as root:
+        yield
+
+    path = tracer.export(root["trace"], key)
+    if path:
+        print(f"* Trace saved to {path}")
+
 
+def perform_assessment(
+    questions, profile, graph, max_workers=MAX_CONCURRENT_QUESTIONS, reassess=REASSESS
+):
+    """
+    Answer the questions about the product of the profile, reusing the cached answers.
+
+    :param reassess: Ask again the cached answers whose cited pages changed, that expired,
+                     or whose confidence is low, and mark each answer as "unchanged",
+                     "refreshed" or "new" (default: REASSESS)
+    """
     domain = extract_domain(profile.get("url"))
-    answers = answer_all_questions(questions, graph, profile, domain)
+    with assessment_run(profile):
+        answers = answer_all_questions(
+            questions, graph, profile, domain, max_workers=max_workers, reassess=reassess
+        )
 
     return answers
 
 
+def iter_assessment(
+    questions, profile, graph, max_workers=MAX_CONCURRENT_QUESTIONS, reassess=REASSESS
+):
+    """
+    Variant of perform_assessment yielding each answer as soon as its question is done, so
+    that the answers can be shown or written while the assessment runs.
+
+    The answers of a question and its follow-ups are yielded together, in the order the
+    questions finish. Each row has a "number" giving its place in the report: "3" for the
+    third question, "3.1" for its first follow-up.
+    """
+    domain = extract_domain(profile.get("url"))
+    with assessment_run(profile):
+        seen = set()
+        for i, rows in iter_question_answers(
+            questions, graph, profile, domain, max_workers=max_workers, reassess=reassess
+        ):
+            followups = 0
+            for row in rows:
+                if row["question"] in seen:
+                    continue
+                seen.add(row["question"])
+                number = str(i + 1)
+                if row["followup"]:
+                    followups += 1
+                    number += f".{followups}"
+                yield {**row, "number": number}
+
+
+@traced("llm.ask")
 def ask_llm(prompt):
-    output = llm.invoke(input=prompt)
-    count_tokens(output)
+    output = invoke_llm(llm, prompt, node="ask_llm")
     return output.content
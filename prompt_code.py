@@ -1,9 +1,13 @@
 import json
 import datetime
 
+from constants import CONTEXT_TOP_K, CONTEXT_TOKEN_BUDGET
+from token_code import tokenizer
+from retrieval_code import bm25_scores, terms_from_text
+
 
 def update_system_prompt(profile, domain):
-    today = datetime.datetime.now().strftime("%Y-%m-%d")
+    today = profile.get("date") or datetime.datetime.now().strftime("%Y-%m-%d")
     system_prompt = f"""
 You are an expert at extracting compliance-related answers from web page content. You are supporting a security team to retrieve information about SaaS providers and their services. 
 
@@ -34,20 +38,67 @@ Official company domain: {domain}
 
 
 # transform previous answers into a string that can be inserted in the system prompt as context
-def create_context(answers):
+def create_context(
+    answers,
+    question=None,
+    dependencies=None,
+    top_k=CONTEXT_TOP_K,
+    budget=CONTEXT_TOKEN_BUDGET,
+):
+    """
+    Without a question, every answer is included. With a question, only the answers of the
+    questions it depends on, and the top_k answers the most relevant to it, are included,
+    within a budget of tokens.
+    """
     context = ""
     if len(answers) == 0:
         return "No previous answers"
 
-    for row in answers:
-        context += f"Q: {row['question']}\nA: {row['answer'].answer}\n\n"
+    if question is None:
+        for row in answers:
+            context += f"Q: {row['question']}\nA: {row['answer'].answer}\n\n"
+        return context
+
+    entries = [f"Q: {row['question']}\nA: {row['answer'].answer}\n\n" for row in answers]
+    lengths = [len(t) for t in tokenizer.encode_batch(entries)]
+
+    dependencies = dependencies or []
+    required = [i for i, row in enumerate(answers) if row.get("question_id") in dependencies]
+    others = [i for i in range(len(answers)) if i not in required]
+    scores = bm25_scores(
+        [terms_from_text(entries[i]) for i in others], terms_from_text(question)
+    )
+    relevant = [
+        i
+        for score, i in sorted(zip(scores, others), key=lambda x: (-x[0], x[1]))
+        if score > 0
+    ][:top_k]
+
+    selected = []
+    used = 0
+    for i in required + relevant:
+        if used + lengths[i] > budget:
+            continue
+        selected.append(i)
+        used += lengths[i]
+
+    saved = sum(lengths) - used
+    print(f"  * Context: {len(selected)}/{len(answers)} answers, {used} tokens ({saved} saved)")
+
+    if not selected:
+        return "No relevant previous answers"
+
+    for i in sorted(selected):
+        context += entries[i]
     return context
 
 
 def make_summary_prompt(answers, profile):
     context = ""
     for answer in answers:
-        context += f"\nQ: {answer['question']}\nA: {answer.get('answer').answer}\nConfidence in the answer: {answer.get('answer').found * 100}%\n\n"
+        # Questions the agent gave up on have no confidence score
+        confidence = getattr(answer.get("answer"), "found", 0)
+        context += f"\nQ: {answer['question']}\nA: {answer.get('answer').answer}\nConfidence in the answer: {confidence * 100}%\n\n"
 
     summary_prompt = f"""You are an expert at writing executive summary for security assessment for SaaS products.
 
@@ -8,6 +8,7 @@ def prepare_questions(profile):
     return [
         {
             "goal": "The team performing the assessment isn't necessarily aware of what this service is doing. This question will tell them what the product is supposed to do, how it is supposed to be used, and what kind of data it is supposed to process.",
+            "id": "purpose",
             "main": f"What is the purpose of '{product}' by '{company}'? Which problem is it promising to solve? Why would a customer consider using it?",
             "expected": "A brief description",
         },
@@ -18,11 +19,13 @@ def prepare_questions(profile):
         },
         {
             "goal": "The team needs to understand the key features of the service to assess the risks associated with it. This question will help the team understand what the service is supposed to do.",
+            "id": "features",
             "main": f"What are the key features of {company} {product}?",
             "expected": "A list of features",
         },
         {
             "goal": f"The team can evaluate the potential inherent risks associated with a product based on its category. Pick your answer(s) from the following list, separate multiple categories with a comma, and only list the categories: Cloud monitoring, Cloud provider, Collaboration, Customer support, Data analytics, Data storage and processing, Document management, Employee management, Engineering, Finance and payments, Identity provider, IT, Marketing, Office operations, Other, Password management, Product and design, Professional services, Recruiting, Sales, Security, Version control. If the service doesn't fit one of these categories, answer: Other.",
+            "depends_on": ["purpose", "features"],
             "main": f"What category of product is {company} {product} in?",
             "expected": "A list of categories",
         },
@@ -33,6 +36,7 @@ def prepare_questions(profile):
         },
         {
             "goal": "Where the service is hosted can have an impact on the data privacy and security of the service. This question will help the team understand where the service is hosted, and if there could be any legal or public image implications.",
+            "id": "cloud_providers",
             "main": f"Which Cloud Service Providers is {company} {product} using?",
             "label": "Cloud Service Providers",
             "function": find_content,
@@ -43,6 +47,7 @@ def prepare_questions(profile):
         },
         {
             "goal": "Where the service is hosted can have an impact on the data privacy and security of the service. This question will help the team understand where the service is hosted, and if there could be any legal or public image implications.",
+            "depends_on": ["cloud_providers"],
             "main": f"Based on official documentation and Cloud Service Providers used, in which countries is {company} {product} hosted?",
             "label": "Cloud Service Providers",
             "expected": "A list of countries",
@@ -81,6 +86,7 @@ def prepare_questions(profile):
         },
         {
             "goal": "Privacy laws require us to disclose how personal data is going to be used. This question will help the team understand how data will be used.",
+            "id": "third_parties",
             "main": f"Based on the privacy policy, is data going to be sent to third parties? If so, will the data be anonymized or pseudonymized before being sent?",
             "label": "Privacy",
             "expected": "A brief description",
@@ -99,6 +105,7 @@ def prepare_questions(profile):
         },
         {
             "goal": "Sub-contractors should stop using any data sent to them if we decide to stop using the service. This question will help the team understand if the data will be returned or deleted if we decide to stop using the service.",
+            "depends_on": ["third_parties"],
             "main": f"Based on the privacy policy, if we decided to stop using {company}, will our data sent to partners be returned or deleted?",
             "label": "Privacy",
             "expected": "A brief description",
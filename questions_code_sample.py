@@ -6,6 +6,7 @@ def prepare_questions(profile):
     return [
         {
             "goal": "The team performing the assessment isn't necessarily aware of what this service is doing. This question will tell them what the product is supposed to do, how it is supposed to be used, and what kind of data it is supposed to process.",
+            "id": "purpose",
             "main": f"What is the purpose of '{product}' by '{company}'? Which problem is it promising to solve? Why would a customer consider using it?",
             "expected": "A brief description",
         },
@@ -16,11 +17,13 @@ def prepare_questions(profile):
         },
         {
             "goal": "The team needs to understand the key features of the service to assess the risks associated with it. This question will help the team understand what the service is supposed to do.",
+            "id": "features",
             "main": f"What are the key features of {company} {product}?",
             "expected": "A list of features",
         },
         {
             "goal": f"The team can evaluate the potential inherent risks associated with a product based on its category. Pick your answer(s) from the following list, separate multiple categories with a comma, and only list the categories: Cloud monitoring, Cloud provider, Collaboration, Customer support, Data analytics, Data storage and processing, Document management, Employee management, Engineering, Finance and payments, Identity provider, IT, Marketing, Office operations, Other, Password management, Product and design, Professional services, Recruiting, Sales, Security, Version control.",
+            "depends_on": ["purpose", "features"],
             "main": f"What category of product is {company} {product} in?",
             "expected": "A list of categories",
         },
@@ -2,12 +2,13 @@ import os
 import datetime
 import json
 
-import requests
 from requests.exceptions import RequestException
 from urllib.parse import quote_plus
 
-from llm_code import extract_domain, get_token_counts
-from constants import LLM_MODEL_PRICES
+from llm_code import extract_domain, get_token_counts, assessment_key
+from token_code import model_price, token_ledger
+from trace_code import tracer
+from http_code import get_session
 
 
 def summary_markdown(summary, profile):
@@ -25,52 +26,130 @@ def summary_markdown(summary, profile):
     )
 
 
-# Function that takes the answers and produce a report in markdown
-def report_markdown(answers, profile):
-
+def report_header(profile):
     today = datetime.datetime.now().strftime("%Y-%m-%d")
-    full_report = f"""# Report for {profile.get('company')} {profile.get('product')} ({today})
+    return f"""# Report for {profile.get('company')} {profile.get('product')} ({today})
 
 URL: {profile.get('url')}
     
 ## Answers
 """
-    j = 0
-    k = 0
-    for i, answer in enumerate(answers):
-        if not answer.get("followup", False):
-            k = 0
-            full_report += f"""
-###  {1+i-j} ({answer['label']}) {answer['question']}
-Answer ({answer['answer'].found *100}% confidence): {answer['answer'].answer}
+
+
+def answer_markdown(answer, number):
+    """Section of an answer in the report, numbered "3" for a question or "3.1" for a follow-up"""
+    followup = answer.get("followup", False)
+    section = f"""
+{'####' if followup else '###'}  {number} ({answer['label']}) {answer['question']}
+Answer ({getattr(answer['answer'], 'found', 0) * 100}% confidence): {answer['answer'].answer}
 """
-            if "url" in answer["answer"]:
-                full_report += f"""
+    if answer.get("status"):
+        section += answer_status_markdown(answer)
+    if "url" in answer["answer"]:
+        spacing = "\n" if followup else ""
+        section += f"""{spacing}
 [Read more]({answer['answer'].url}) {answer['answer'].url}
 """
-        else:
-            j += 1
-            k += 1
-            full_report += f"""
-####  {1+i-j}.{k} ({answer['label']}) {answer['question']}
-Answer ({answer['answer'].found * 100}% confidence): {answer['answer'].answer}
+    return section
+
+
+# Function that takes the answers and produce a report in markdown
+def report_markdown(answers, profile):
+    sections = [report_header(profile)]
+    statuses = [answer["status"] for answer in answers if answer.get("status")]
+    if statuses:
+        sections.append(
+            f"""
+Re-assessment: {statuses.count('unchanged')} unchanged, {statuses.count('refreshed')} refreshed, {statuses.count('new')} new answers
 """
-            if "url" in answer["answer"]:
-                full_report += f"""
+        )
 
-[Read more]({answer['answer'].url}) {answer['answer'].url}
+    question = 0
+    followup = 0
+    for answer in answers:
+        if not answer.get("followup", False):
+            question += 1
+            followup = 0
+            sections.append(answer_markdown(answer, question))
+        else:
+            followup += 1
+            sections.append(answer_markdown(answer, f"{question}.{followup}"))
+    return "".join(sections)
+
+
+class StreamingReport:
+    """
+    Report written while the assessment runs, from the rows yielded by iter_assessment.
+
+    Each answer is appended to the Markdown report and to a JSON lines file as soon as it
+    arrives, so the progress is visible on disk. Only the position of each section is kept
+    in memory: when the report is closed, the Markdown sections are rewritten in the order
+    of their numbers.
+    """
+
+    def __init__(self, directory, profile, name="report"):
+        os.makedirs(directory, exist_ok=True)
+        self.markdown_path = os.path.join(directory, f"{name}.md")
+        self.jsonl_path = os.path.join(directory, f"{name}.jsonl")
+        # The Markdown file is written in binary, so that the positions are byte offsets
+        self.markdown = open(self.markdown_path, "wb")
+        self.jsonl = open(self.jsonl_path, "w", encoding="utf-8")
+        self.markdown.write(report_header(profile).encode("utf-8"))
+        self.header_size = self.markdown.tell()
+        self.sections = []
+
+    def write(self, answer):
+        start = self.markdown.tell()
+        self.markdown.write(answer_markdown(answer, answer["number"]).encode("utf-8"))
+        order = tuple(int(n) for n in answer["number"].split("."))
+        self.sections.append((order, start, self.markdown.tell()))
+        self.jsonl.write(
+            json.dumps(
+                {**answer, "answer": answer["answer"].model_dump()}, ensure_ascii=False
+            )
+            + "\n"
+        )
+        self.markdown.flush()
+        self.jsonl.flush()
+
+    def close(self):
+        self.jsonl.close()
+        self.markdown.close()
+
+        tmp_path = self.markdown_path + ".tmp"
+        with open(self.markdown_path, "rb") as source, open(tmp_path, "wb") as target:
+            target.write(source.read(self.header_size))
+            for _, start, end in sorted(self.sections):
+                source.seek(start)
+                target.write(source.read(end - start))
+        os.replace(tmp_path, self.markdown_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+
+def answer_status_markdown(answer):
+    """Status of an answer in a re-assessment, with the reason it was refreshed"""
+    status = answer["status"].capitalize()
+    if answer.get("reason"):
+        status += f" ({answer['reason']})"
+    return f"""
+Status: {status}
 """
-    return full_report
 
 
 def request_for_improvement(answer, profile):
     """
-    This code will perform a requests.get to domain/compliance.txt and provide the question that couldn't be answered as a parameter.
+    This code will perform a GET request to domain/compliance.txt and provide the question that couldn't be answered as a parameter.
     """
 
     domain = extract_domain(profile["url"])
 
-    if domain not in answer["answer"].url:
+    if domain not in getattr(answer["answer"], "url", ""):
         print("* This answer is not from the vendor's website")
         return None
 
@@ -96,7 +175,9 @@ def request_for_improvement(answer, profile):
         )
         print(f"Requesting '{url}?{encoded_parameters}'")
 
-        response = requests.get(url, params=parameters)
+        response = get_session().get(
+            url, params=parameters, headers=headers, timeout=10
+        )
 
         if domain not in requested_improvements:
             requested_improvements[domain] = []
@@ -110,24 +191,9 @@ def request_for_improvement(answer, profile):
         return None
 
 
-def model_price(model):
-    # example: gpt-4o-2024-05-13
-    sections = model.split("-")
-
-    for i in range(len(sections) - 1, 0, -1):
-        model_name = "-".join(sections[:i])
-        if model_name in LLM_MODEL_PRICES:
-            break
-
-    if model_name not in LLM_MODEL_PRICES:
-        model_name = list(LLM_MODEL_PRICES.keys())[0]
-
-    return LLM_MODEL_PRICES[model_name]
-
-
 def calculate_token_counts(profile):
     today = datetime.datetime.now().strftime("%Y-%m-%d")
-    token_report = get_token_counts()
+    token_report = get_token_counts(profile)
 
     current_token_report = {
         "company": profile["company"],
@@ -139,7 +205,12 @@ def calculate_token_counts(profile):
     }
     for model in token_report.keys():
         price = model_price(model)
-        price_input = price["input"] * token_report[model]["input"] / 1000000
+        cached_input = token_report[model].get("cached_input", 0)
+        uncached_input = token_report[model]["input"] - cached_input
+        price_cached_input = (
+            price.get("cached_input", price["input"]) * cached_input / 1000000
+        )
+        price_input = price["input"] * uncached_input / 1000000 + price_cached_input
         price_output = price["output"] * token_report[model]["output"] / 1000000
         total_price = price_input + price_output
         current_token_report["total_costs"] += total_price
@@ -150,12 +221,36 @@ def calculate_token_counts(profile):
                 "calls": token_report[model]["calls"],
                 "input": token_report[model]["input"],
                 "input_price": price_input,
+                "cached_input": cached_input,
+                "cached_input_price": price_cached_input,
                 "output": token_report[model]["output"],
                 "output_price": price_output,
                 "total": token_report[model]["total"],
                 "total_price": total_price,
+                "escalations": token_report[model].get("escalations", 0),
+                "cache_hits": token_report[model].get("cache_hits", 0),
+                "saved_cost": token_report[model].get("saved_cost", 0),
             }
         )
+
+    questions = token_ledger.totals(
+        group_by="question", assessment=assessment_key(profile)
+    )
+    current_token_report["questions"] = [
+        {
+            "question": question or "(outside of a question)",
+            "calls": usage["calls"],
+            "total": usage["total"],
+            "cost": usage["cost"],
+            "escalations": usage.get("escalations", 0),
+        }
+        for question, usage in sorted(
+            questions.items(), key=lambda item: -item[1]["cost"]
+        )
+    ]
+    current_token_report["escalations"] = token_ledger.escalations_of(
+        assessment_key(profile)
+    )
     return current_token_report
 
 
@@ -170,11 +265,118 @@ def token_count_markdown(current_token_report):
 * Total calls: {model['calls']}
 * Total tokens: {model['total']} ({model['total_price']:0.2f}$)
 * Input tokens: {model['input']} ({model['input_price']:0.2f}$)
+* Cached input tokens: {model['cached_input']} ({model['cached_input_price']:0.2f}$)
 * Output tokens: {model['output']} ({model['output_price']:0.2f}$)
 """
+        if model.get("cache_hits"):
+            token_report_markdown += f"* Calls answered by the LLM response cache: {model['cache_hits']} ({model['saved_cost']:0.2f}$ saved)\n"
+        if model.get("escalations"):
+            token_report_markdown += f"* Calls escalated to the large model: {model['escalations']}\n"
+    if token_report.get("questions"):
+        token_report_markdown += """
+## Questions
+
+| Question | Calls | Tokens | Cost | Escalations |
+|---|---|---|---|---|
+"""
+        for question in token_report["questions"]:
+            text = question["question"].replace("|", "\\|").replace("\n", " ")
+            token_report_markdown += f"| {text} | {question['calls']} | {question['total']} | {question['cost']:0.4f}$ | {question.get('escalations', 0)} |\n"
+    if token_report.get("escalations"):
+        token_report_markdown += """
+## Escalations to the large model
+
+| Question | Model | Reason |
+|---|---|---|
+"""
+        for escalation in token_report["escalations"]:
+            text = (escalation["question"] or "").replace("|", "\\|").replace("\n", " ")
+            token_report_markdown += f"| {text} | {escalation['model']} | {escalation['reason']} |\n"
     return token_report_markdown
 
 
+def percentile(values, p):
+    """Return the p-th percentile of sorted values, with linear interpolation"""
+    if not values:
+        return 0
+    position = (len(values) - 1) * p / 100
+    lower = int(position)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+
+def calculate_latencies(profile):
+    """
+    Latency of each traced stage of the last assessment of the profile.
+
+    :return: Dictionary with the wall time of the assessment, per stage the number of
+             spans, total seconds, and p50, p95, p99 and max seconds, and the number of
+             downloads per outcome of the download cache
+    """
+    trace = tracer.find_trace("assessment", assessment=assessment_key(profile))
+    spans = tracer.trace_spans(trace) if trace else []
+
+    durations = {}
+    downloads = {"hits": 0, "revalidated": 0, "changed": 0, "misses": 0}
+    for span in spans:
+        if span["parent"] is None:
+            continue
+        name = span["name"]
+        if span["attributes"].get("cached"):
+            name += " (cached)"
+        elif span["attributes"].get("cache") == "revalidated":
+            name += " (revalidated)"
+        elif span["attributes"].get("deferred"):
+            name += " (deferred)"
+        durations.setdefault(name, []).append(span["duration"])
+        if span["name"] == "download" and span["attributes"].get("cache") in downloads:
+            downloads[span["attributes"]["cache"]] += 1
+
+    conditional = downloads["revalidated"] + downloads["changed"]
+    downloads["revalidation_rate"] = downloads["revalidated"] / conditional if conditional else 0
+
+    stages = []
+    for name, values in durations.items():
+        values.sort()
+        stages.append(
+            {
+                "stage": name,
+                "count": len(values),
+                "total": sum(values),
+                "p50": percentile(values, 50),
+                "p95": percentile(values, 95),
+                "p99": percentile(values, 99),
+                "max": values[-1],
+            }
+        )
+    stages.sort(key=lambda stage: -stage["total"])
+
+    return {
+        "company": profile["company"],
+        "product": profile["product"],
+        "wall_time": sum(s["duration"] for s in spans if s["parent"] is None),
+        "stages": stages,
+        "downloads": downloads,
+    }
+
+
+def latency_markdown(latency_report):
+    downloads = latency_report["downloads"]
+    report = f"""# Latency Report
+* Total execution time: {latency_report['wall_time']:0.1f}s
+* Downloads: {downloads['hits']} from the cache, {downloads['revalidated']} revalidated (304 Not Modified), {downloads['changed']} changed, {downloads['misses']} not cached
+* Revalidation hit rate: {downloads['revalidation_rate']*100:0.0f}% of the expired pages didn't change
+
+Stages overlap: questions, downloads and follow-ups run concurrently, so the totals add up to more than the execution time.
+
+| Stage | Count | Total (s) | p50 (s) | p95 (s) | p99 (s) | Max (s) |
+|---|---|---|---|---|---|---|
+"""
+    for stage in latency_report["stages"]:
+        report += f"| {stage['stage']} | {stage['count']} | {stage['total']:0.2f} | {stage['p50']:0.3f} | {stage['p95']:0.3f} | {stage['p99']:0.3f} | {stage['max']:0.3f} |\n"
+    return report
+
+
 def report_confidence(answers, profile):
     trusts = []
     confidences = []
@@ -182,12 +384,14 @@ def report_confidence(answers, profile):
     domain = extract_domain(profile.get("url"))
 
     for i, answer in enumerate(answers):
-        confidence = answer.get("answer").found
+        # Questions the agent gave up on have no confidence score nor URL
+        confidence = getattr(answer.get("answer"), "found", 0)
         confidences.append(confidence)
-        if domain in answer["answer"].url:
-            trusts.append(answer["answer"].url)
+        url = getattr(answer.get("answer"), "url", "")
+        if domain in url:
+            trusts.append(url)
 
-        if answer.get("answer").found < 0.5:
+        if confidence < 0.5:
             improvements.append(answer)
 
     report = f"""# Confidence Report
@@ -199,7 +403,8 @@ Answers with low confidence scores:
 
 """
     for i, answer in enumerate(answers):
-        if answer.get("answer").found < 0.5:
-            report += f"""{i+1}. ({answer.get('answer').found * 100:.0f}% confidence) {answer['question']}\n"""
+        confidence = getattr(answer.get("answer"), "found", 0)
+        if confidence < 0.5:
+            report += f"""{i+1}. ({confidence * 100:.0f}% confidence) {answer['question']}\n"""
 
     return report, improvements
@@ -0,0 +1,344 @@
+import os
+import re
+import math
+import json
+import zlib
+import hashlib
+import time
+import tempfile
+import threading
+from collections import Counter
+from urllib.parse import urlparse
+
+import numpy as np
+from tld import get_fld
+
+from constants import CHUNK_TOKENS, LOCAL_INDEX, LOCAL_INDEX_CHUNK_CHARS
+
+TERM_PATTERN = re.compile(r"\w+")
+
+# Frequent words ignored by the local index, as they dilute the similarity of short questions
+STOP_WORDS = set(
+    "a an and are as at be by can do does for from how if in is it its of on or so that the their "
+    "there these this to was what when where which who why will with".split()
+)
+
+
+def terms_from_text(text):
+    """Split a text in lowercase terms used for lexical scoring"""
+    return TERM_PATTERN.findall(text.casefold())
+
+
+def bm25_scores(documents, query, k1=1.5, b=0.75):
+    """
+    Score documents against a query with Okapi BM25.
+
+    :param documents: List of documents, each a list of terms
+    :param query: List of query terms
+    :return: List of scores, in the order of the documents
+    """
+    if not documents:
+        return []
+
+    average_length = sum(len(d) for d in documents) / len(documents) or 1
+    document_frequencies = Counter()
+    for document in documents:
+        document_frequencies.update(set(document))
+
+    query_terms = set(query)
+    idf = {}
+    for term in query_terms:
+        df = document_frequencies.get(term, 0)
+        idf[term] = math.log(1 + (len(documents) - df + 0.5) / (df + 0.5))
+
+    scores = []
+    for document in documents:
+        frequencies = Counter(t for t in document if t in query_terms)
+        score = 0
+        for term, frequency in frequencies.items():
+            norm = k1 * (1 - b + b * len(document) / average_length)
+            score += idf[term] * frequency * (k1 + 1) / (frequency + norm)
+        scores.append(score)
+
+    return scores
+
+
+def chunk_ranges(token_count, chunk_size=CHUNK_TOKENS):
+    """Split a number of tokens in (start, end) ranges of chunk_size tokens"""
+    return [
+        (start, min(start + chunk_size, token_count))
+        for start in range(0, token_count, chunk_size)
+    ]
+
+
+def merge_ranges(ranges):
+    """Merge sorted (start, end) ranges that touch each other"""
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and merged[-1][1] >= start:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def select_chunks(pages_tokens, query, budget, tokenizer, chunk_size=CHUNK_TOKENS):
+    """
+    Select the chunks of several pages the most relevant to the query, within a token budget.
+
+    :param pages_tokens: List of token IDs, one list per page
+    :param query: Text of the query
+    :param budget: Maximum number of tokens selected across all the pages
+    :param tokenizer: Tokenizer used to decode the chunks
+    :return: List of kept (start, end) token ranges per page, merged and in page order
+    """
+    chunks = []
+    for page, tokens in enumerate(pages_tokens):
+        for start, end in chunk_ranges(len(tokens), chunk_size):
+            chunks.append((page, start, end))
+
+    documents = [
+        terms_from_text(tokenizer.decode(pages_tokens[page][start:end]))
+        for page, start, end in chunks
+    ]
+    scores = bm25_scores(documents, terms_from_text(query))
+
+    # Best scores first. For equal scores, the beginning of every page comes first.
+    ranking = sorted(
+        range(len(chunks)), key=lambda i: (-scores[i], chunks[i][1], chunks[i][0])
+    )
+    # Chunks without any query term are only used when no chunk matches
+    if any(score > 0 for score in scores):
+        ranking = [i for i in ranking if scores[i] > 0]
+
+    selected = [[] for _ in pages_tokens]
+    used = 0
+    for i in ranking:
+        page, start, end = chunks[i]
+        if used + end - start > budget:
+            continue
+        selected[page].append((start, end))
+        used += end - start
+
+    return [merge_ranges(ranges) for ranges in selected]
+
+
+def registered_domain(url):
+    """Return the registered domain of a URL, for example 'example.co.uk' for 'https://www.example.co.uk/a'"""
+    domain = get_fld(url, fail_silently=True)
+    if domain:
+        return domain
+    return (urlparse(url).hostname or "").split("www.")[-1]
+
+
+def chunk_text(text, chunk_chars=LOCAL_INDEX_CHUNK_CHARS):
+    """Split a text in chunks of about chunk_chars characters, cut between lines"""
+    chunks = []
+    current = []
+    size = 0
+    for line in text.splitlines():
+        if current and size + len(line) > chunk_chars:
+            chunks.append("\n".join(current))
+            current = []
+            size = 0
+        current.append(line)
+        size += len(line) + 1
+    if current:
+        chunks.append("\n".join(current))
+    return chunks
+
+
+class LocalIndex:
+    """
+    Index of the pages downloaded from one vendor domain, searched with hashed TF-IDF vectors.
+
+    Chunks are stored as sparse vectors of log-scaled term frequencies, hashed in `dimensions`
+    features. IDF weights are computed at query time, so pages can be added incrementally.
+    """
+
+    dimensions = 2**18
+
+    def __init__(self, domain, index_dir=LOCAL_INDEX):
+        self.domain = domain
+        self.path = os.path.join(index_dir, domain)
+        self.lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        self.chunks = []
+        self.pages = {}
+        # Time of the last sync with the download cache
+        self.synced = 0
+        self.indptr = np.zeros(1, dtype=np.int64)
+        self.indices = np.zeros(0, dtype=np.int32)
+        self.values = np.zeros(0, dtype=np.float32)
+
+        if not os.path.exists(self.path + ".npz"):
+            return
+
+        try:
+            with open(self.path + ".json", "r", encoding="utf-8") as f:
+                metadata = json.load(f)
+            arrays = np.load(self.path + ".npz")
+            self.chunks = metadata["chunks"]
+            self.pages = metadata["pages"]
+            self.synced = metadata.get("synced", 0)
+            self.indptr = arrays["indptr"]
+            self.indices = arrays["indices"]
+            self.values = arrays["values"]
+        except (OSError, ValueError, KeyError) as e:
+            print(f"! Failed to load the local index of {self.domain}, rebuilding it: {e}")
+            self.chunks = []
+            self.pages = {}
+            self.synced = 0
+
+    def save(self):
+        directory = os.path.dirname(self.path)
+        os.makedirs(directory, exist_ok=True)
+
+        fd, tmp_npz = tempfile.mkstemp(dir=directory, suffix=".npz")
+        with os.fdopen(fd, "wb") as f:
+            np.savez(f, indptr=self.indptr, indices=self.indices, values=self.values)
+
+        fd, tmp_json = tempfile.mkstemp(dir=directory, suffix=".json")
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(
+                {"chunks": self.chunks, "pages": self.pages, "synced": self.synced},
+                f,
+                ensure_ascii=False,
+            )
+
+        os.replace(tmp_npz, self.path + ".npz")
+        os.replace(tmp_json, self.path + ".json")
+
+    def features(self, terms):
+        """Return the hashed feature of each term, ignoring stop words"""
+        return [
+            zlib.crc32(term.encode("utf-8")) % self.dimensions
+            for term in terms
+            if term not in STOP_WORDS
+        ]
+
+    def add_pages(self, pages):
+        """
+        Add pages to the index. Pages already indexed with the same content are skipped,
+        and pages whose content changed replace their previous chunks.
+
+        :param pages: List of (url, text)
+        :return: Number of pages added
+        """
+        with self.lock:
+            added = 0
+            for url, text in pages:
+                digest = hashlib.md5(text.encode("utf-8")).hexdigest()
+                if self.pages.get(url) == digest:
+                    continue
+                if url in self.pages:
+                    self.remove_page(url)
+
+                indptr = [self.indptr[-1]]
+                indices = []
+                values = []
+                for chunk in chunk_text(text):
+                    counts = Counter(self.features(terms_from_text(chunk)))
+                    if not counts:
+                        continue
+                    features = sorted(counts)
+                    indices.extend(features)
+                    values.extend(1 + math.log(counts[f]) for f in features)
+                    indptr.append(indptr[-1] + len(features))
+                    self.chunks.append({"url": url, "text": chunk})
+
+                self.indptr = np.concatenate(
+                    [self.indptr, np.array(indptr[1:], dtype=np.int64)]
+                )
+                self.indices = np.concatenate(
+                    [self.indices, np.array(indices, dtype=np.int32)]
+                )
+                self.values = np.concatenate(
+                    [self.values, np.array(values, dtype=np.float32)]
+                )
+                self.pages[url] = digest
+                added += 1
+
+            if added:
+                self.save()
+            return added
+
+    def remove_page(self, url):
+        """Remove the chunks of a page. The lock must be held."""
+        alive = np.array([chunk["url"] != url for chunk in self.chunks], dtype=bool)
+        lengths = np.diff(self.indptr)
+        mask = np.repeat(alive, lengths)
+        self.indices = self.indices[mask]
+        self.values = self.values[mask]
+        self.indptr = np.concatenate([[0], np.cumsum(lengths[alive])]).astype(np.int64)
+        self.chunks = [chunk for chunk, keep in zip(self.chunks, alive) if keep]
+        del self.pages[url]
+
+    def sync(self, download_cache):
+        """
+        Add the pages of the domain stored or revalidated in the download cache since the last
+        sync. Pages downloaded again with a different content replace their previous chunks.
+        """
+        start = time.time()
+        pages = []
+        for url in download_cache.urls(self.domain, since=self.synced):
+            entry = download_cache.get(url)
+            if entry and "text/html" in entry.get("content_type", ""):
+                pages.append((url, entry["content"]))
+
+        with self.lock:
+            self.synced = max(self.synced, start)
+        return self.add_pages(pages)
+
+    def search(self, query, k=5):
+        """
+        Return the k chunks the most similar to the query.
+
+        :return: List of dictionaries with the url, text and cosine similarity score of each chunk
+        """
+        with self.lock:
+            if not self.chunks:
+                return []
+
+            document_frequencies = np.bincount(
+                self.indices, minlength=self.dimensions
+            )
+            idf = np.log((1 + len(self.chunks)) / (1 + document_frequencies)) + 1
+
+            weights = self.values * idf[self.indices]
+            norms = np.sqrt(np.add.reduceat(weights**2, self.indptr[:-1]))
+
+            query_vector = np.zeros(self.dimensions, dtype=np.float32)
+            for feature, count in Counter(self.features(terms_from_text(query))).items():
+                query_vector[feature] = (1 + math.log(count)) * idf[feature]
+            query_norm = np.linalg.norm(query_vector)
+            if query_norm == 0:
+                return []
+
+            dots = np.add.reduceat(weights * query_vector[self.indices], self.indptr[:-1])
+            scores = dots / (norms * query_norm)
+
+            best = np.argsort(-scores)[:k]
+            return [
+                {
+                    "url": self.chunks[i]["url"],
+                    "text": self.chunks[i]["text"],
+                    "score": float(scores[i]),
+                }
+                for i in best
+                if scores[i] > 0
+            ]
+
+
+local_indexes = {}
+local_indexes_lock = threading.Lock()
+
+
+def get_local_index(domain):
+    """Return the local index of the vendor domain, shared by the whole process"""
+    with local_indexes_lock:
+        if domain not in local_indexes:
+            local_indexes[domain] = LocalIndex(domain)
+        return local_indexes[domain]
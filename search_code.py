@@ -1,50 +1,90 @@
-import os
-
 import requests
-from bs4 import BeautifulSoup
-import hashlib
-import json
 import re
+import hashlib
 import time
 import unicodedata
 import random
-from datetime import datetime, timedelta
+import heapq
+import itertools
+import threading
+import contextvars
+from datetime import timedelta
+from urllib.parse import urlparse
+from concurrent.futures import Future, ThreadPoolExecutor, wait
 
-from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
 
-from constants import GOOGLE_API_KEY, GOOGLE_SEARCH_ENGINE_ID
+from constants import (
+    GOOGLE_SEARCH_ENGINE_ID,
+    MAX_CONCURRENT_DOWNLOADS,
+    MAX_CONCURRENT_FETCHES,
+    MAX_RETRY_AFTER,
+    DOWNLOAD_CACHE,
+)
+from cache_code import get_download_cache, search_cache
+from extract_code import extract_text
+from trace_code import span, current_span
+from http_code import (
+    host_rate_limiter,
+    parse_retry_after,
+    get_session,
+    get_search_service,
+    execute_search_request,
+)
 
 if not GOOGLE_SEARCH_ENGINE_ID:
     raise ValueError("Please set the GOOGLE_SEARCH_ENGINE_ID environment variable")
 
+# Shared between calls so that a download still running after a deadline
+# doesn't block the caller, and can finish filling the cache in the background
+download_executor = ThreadPoolExecutor(max_workers=MAX_CONCURRENT_DOWNLOADS)
+# Limits the pages being fetched across all the searches and assessments of the process
+fetch_slots = threading.BoundedSemaphore(MAX_CONCURRENT_FETCHES)
+# Returned by fetch_content when the host asked to retry later
+RETRY = object()
+
 
-def google_search(query, num_results=3, max_retries=2, delay=1):
+def google_search(query, num_results=3, max_retries=2, delay=1, use_cache=True):
     """
     Perform a Google search and return the top results with throttling and retry mechanism.
+    Results are cached by normalized query for SEARCH_CACHE_TTL.
 
     :param query: The search query string
     :param num_results: Number of top results to return (default is 3)
     :param max_retries: Maximum number of retries in case of rate limiting (default is 3)
     :param delay: Delay in seconds between retries (default is 1)
+    :param use_cache: Look for the results in the search cache before calling the API (default is True)
     :return: List of dictionaries containing 'title' and 'link' for each result
     """
 
-    service = build("customsearch", "v1", developerKey=GOOGLE_API_KEY)
     num_results = min(max(1, num_results), 10)
 
+    with span("google_search", query=query) as search_span:
+        if use_cache:
+            cached_results = search_cache.get(query, num_results)
+            if cached_results is not None:
+                search_span["attributes"]["cached"] = True
+                return cached_results
+
+        search_span["attributes"]["cached"] = False
+        return search_with_retries(query, num_results, max_retries, delay)
+
+
+def search_with_retries(query, num_results, max_retries, delay):
+    """Call the Custom Search API, retrying with exponential backoff when rate limited"""
+    service = get_search_service()
+
     for attempt in range(max_retries):
         try:
-            res = (
-                service.cse()
-                .list(q=query, cx=GOOGLE_SEARCH_ENGINE_ID, num=num_results)
-                .execute()
+            res = execute_search_request(
+                service.cse().list(q=query, cx=GOOGLE_SEARCH_ENGINE_ID, num=num_results)
             )
 
             results = []
             for item in res.get("items", []):
                 results.append({"title": item["title"], "link": item["link"]})
 
+            search_cache.put(query, num_results, results)
             return results
 
         except HttpError as e:
@@ -109,34 +149,104 @@ def sanitize_text(text):
     return text.strip()
 
 
-def download_content(url, cache_dir="download_cache", cache_duration=30):
+def download_content(
+    url, cache_dir=DOWNLOAD_CACHE, cache_duration=30, retries=1, deadline=None
+):
     """
     Scrape text content from a given URL, removing HTML tags.
-    Uses caching to store and retrieve content.
+    Uses caching to store and retrieve content. Expired pages are revalidated with
+    If-None-Match / If-Modified-Since, and only downloaded again if they changed.
+    Requests are throttled per host by host_rate_limiter, waiting in the current thread.
 
     :param url: The URL to scrape
-    :param cache_dir: Directory to store cache files (default: 'download_cache')
+    :param cache_dir: Directory of the download cache (default: DOWNLOAD_CACHE)
     :param cache_duration: Cache duration in days (default: 30)
+    :param retries: Number of retries when the host answers with a 429 or 503 (default: 1)
+    :param deadline: time.monotonic() after which the page is skipped instead of waiting for its host (default: None)
     :return: Cleaned text content from the URL
     """
 
-    # Create cache directory if it doesn't exist
-    if not os.path.exists(cache_dir):
-        os.makedirs(cache_dir)
+    with span("download", url=url) as download_span:
+        cache, cache_data = lookup_content(url, cache_dir, cache_duration)
+        if download_span["attributes"]["cached"]:
+            return cache_data["content"]
+
+        while True:
+            delay = reserve_fetch(url, deadline)
+            if delay is None:
+                return None
+            if delay > 0:
+                with span("rate_limit_wait", host=urlparse(url).hostname or ""):
+                    time.sleep(delay)
+
+            content = fetch_content(url, cache, cache_data, retries)
+            if content is not RETRY:
+                return content
+            retries -= 1
+
+
+def lookup_content(url, cache_dir, cache_duration):
+    """
+    Look for a page in the download cache, counting a hit in the current download span.
+
+    :return: The download cache, and the entry of the page if it can be used or revalidated, else None
+    """
+    cache = get_download_cache(cache_dir)
+    cache_data = cache.get(
+        url,
+        max_age=timedelta(days=cache_duration).total_seconds(),
+        include_expired=True,
+    )
+    if cache_data and "text/html" not in cache_data.get("content_type", ""):
+        cache_data = None
+
+    download_span = current_span.get()
+    download_span["attributes"]["cached"] = bool(cache_data and not cache_data["expired"])
+    if download_span["attributes"]["cached"]:
+        record_download(cache, "hits")
+    return cache, cache_data
+
+
+def reserve_fetch(url, deadline=None):
+    """
+    Reserve a request to the host of the URL.
 
-    # Generate a filename for the cache based on the URL
-    cache_filename = hashlib.md5(url.encode()).hexdigest() + ".json"
-    cache_path = os.path.join(cache_dir, cache_filename)
+    :return: Seconds to wait before fetching the page, or None when the host doesn't allow
+             it before the deadline, and the page is skipped
+    """
+    host = urlparse(url).hostname or ""
+    max_delay = None if deadline is None else deadline - time.monotonic()
+    delay = host_rate_limiter.reserve(host, max_delay)
+    if delay is None:
+        print(f"  * Rate limit of {host} ends after the deadline, skipping {url}")
+    return delay
 
-    if os.path.exists(cache_path) and os.path.getsize(cache_path) > 0:
-        if datetime.now() - datetime.fromtimestamp(
-            os.path.getmtime(cache_path)
-        ) < timedelta(days=cache_duration):
-            with open(cache_path, "r", encoding="utf-8") as cache_file:
-                cache_data = json.load(cache_file)
-                if "text/html" in cache_data.get("content_type", ""):
-                    return cache_data["content"]
 
+def record_download(cache, outcome):
+    """Count the outcome of a download in the cache stats, and in the current download span"""
+    cache.count(outcome)
+    download_span = current_span.get()
+    if download_span:
+        download_span["attributes"]["cache"] = outcome
+
+
+def content_hash(text):
+    """Hash of the text of a page, used to detect that a page changed. None for a missing page."""
+    if text is None:
+        return None
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def fetch_content(url, cache, cache_data=None, retries=0):
+    """
+    Download a page missing from the cache, extract its text and cache it.
+    The request to the host must already be reserved with reserve_fetch.
+
+    :param cache_data: Expired cache entry of the page. When it has validators, the request
+                       is conditional, and a 304 answer refreshes it without downloading the page.
+    :param retries: Number of retries left when the host answers with a 429 or 503
+    :return: Text of the page, None on failure, or RETRY when the page should be fetched again
+    """
     user_agents = [
         "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36",
         "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/14.0 Safari/605.1.15",
@@ -146,22 +256,45 @@ def download_content(url, cache_dir="download_cache", cache_duration=30):
     ]
 
     headers = {"User-Agent": random.choice(user_agents)}
+    conditional = False
+    if cache_data:
+        if cache_data.get("etag"):
+            headers["If-None-Match"] = cache_data["etag"]
+            conditional = True
+        if cache_data.get("last_modified"):
+            headers["If-Modified-Since"] = cache_data["last_modified"]
+            conditional = True
+
+    host = urlparse(url).hostname or ""
 
     try:
-        time.sleep(random.uniform(1, 3))  # Random delay between 1 and 3 seconds
-        response = requests.get(url, headers=headers, timeout=10)
+        with fetch_slots, span("fetch", host=host):
+            response = get_session().get(url, headers=headers, timeout=10)
         response.encoding = "utf-8"
+
+        if conditional and response.status_code == 304:
+            cache.revalidate(
+                url,
+                etag=response.headers.get("ETag"),
+                last_modified=response.headers.get("Last-Modified"),
+            )
+            record_download(cache, "revalidated")
+            return cache_data["content"]
+
+        if response.status_code in [429, 503]:
+            retry_after = parse_retry_after(response.headers.get("Retry-After"))
+            host_rate_limiter.defer(host, retry_after)
+            if retries > 0 and retry_after <= MAX_RETRY_AFTER:
+                print(f"Rate limited by {host}, retrying after {retry_after} seconds")
+                return RETRY
+
         response.raise_for_status()  # Raise an exception for bad status codes
     except requests.exceptions.Timeout:
         return None
     except requests.exceptions.ConnectionError:
         return None
     except requests.exceptions.RequestException as e:
-        if response.status_code == 429:
-            retry_after = int(response.headers.get("Retry-After", 60))
-            print(f"Rate limited, retrying after {retry_after} seconds")
-            time.sleep(retry_after)
-            return download_content(url, cache_dir="download_cache", cache_duration=30)
+        return None
     except Exception as e:
         return None
 
@@ -169,32 +302,152 @@ def download_content(url, cache_dir="download_cache", cache_duration=30):
     if "text/html" not in content_type:
         return None
 
-    soup = BeautifulSoup(response.text, "html.parser")
+    with span("extract"):
+        text = extract_text(response.text)
 
-    # Remove script and style elements
-    for script in soup(["script", "style"]):
-        script.decompose()
+    # Cache the scraped content
+    cache.put(
+        url,
+        text,
+        content_type,
+        etag=response.headers.get("ETag"),
+        last_modified=response.headers.get("Last-Modified"),
+    )
+    record_download(cache, "changed" if conditional else "misses")
 
-    # Get text
-    text = soup.get_text()
+    return text
 
-    # Break into lines and remove leading and trailing space on each
-    lines = (line.strip() for line in text.splitlines())
 
-    # Break multi-headlines into a line each
-    chunks = (phrase.strip() for line in lines for phrase in line.split("  "))
+class ScheduledDownload:
+    """
+    Download of a page by download_contents.
 
-    # Drop blank lines
-    text = "\n".join(chunk for chunk in chunks if chunk)
+    The cache lookup and the fetch run on download_executor, but the wait for the rate
+    limit of the host is scheduled on download_timer instead of sleeping in a worker, so
+    that the backlog of one host doesn't hold the pool while pages of other hosts wait.
+    """
 
-    # Cache the scraped content
-    cache_data = {
-        "url": url,
-        "timestamp": time.time(),
-        "content": text,
-        "content_type": content_type,
-    }
-    with open(cache_path, "w", encoding="utf-8") as cache_file:
-        json.dump(cache_data, cache_file, ensure_ascii=False, indent=2)
+    def __init__(self, url, deadline, retries=1):
+        self.url = url
+        self.deadline = deadline
+        self.retries = retries
+        self.cache = None
+        self.cache_data = None
+        # Each step runs in a copy of the context of the caller, to be traced under its span
+        self.context = contextvars.copy_context()
+        self.future = Future()
 
-    return text
+    def start(self):
+        self.submit(self.lookup)
+        return self.future
+
+    def submit(self, step):
+        download_executor.submit(self.context.copy().run, self.run, step)
+
+    def run(self, step):
+        try:
+            step()
+        except Exception as e:
+            if not self.future.done():
+                self.future.set_exception(e)
+
+    def lookup(self):
+        # A download not started before the deadline was cancelled
+        if not self.future.set_running_or_notify_cancel():
+            return
+        with span("download", url=self.url) as download_span:
+            self.cache, self.cache_data = lookup_content(
+                self.url, DOWNLOAD_CACHE, cache_duration=30
+            )
+            if download_span["attributes"]["cached"]:
+                self.future.set_result(self.cache_data["content"])
+                return
+            self.schedule_fetch(download_span)
+
+    def schedule_fetch(self, download_span):
+        delay = reserve_fetch(self.url, self.deadline)
+        if delay is None:
+            self.future.set_result(None)
+        elif delay > 0:
+            download_span["attributes"]["deferred"] = delay
+            download_timer.submit_at(time.monotonic() + delay, self.submit, self.fetch)
+        else:
+            self.fetch_now(download_span)
+
+    def fetch(self):
+        with span("download", url=self.url) as download_span:
+            self.fetch_now(download_span)
+
+    def fetch_now(self, download_span):
+        content = fetch_content(self.url, self.cache, self.cache_data, self.retries)
+        if content is RETRY:
+            self.retries -= 1
+            self.schedule_fetch(download_span)
+        else:
+            self.future.set_result(content)
+
+
+class DownloadTimer:
+    """Thread calling functions at a time.monotonic() date, in order"""
+
+    def __init__(self):
+        self.queue = []
+        self.sequence = itertools.count()
+        self.condition = threading.Condition()
+        self.thread = None
+
+    def submit_at(self, date, function, *args):
+        with self.condition:
+            heapq.heappush(self.queue, (date, next(self.sequence), function, args))
+            if self.thread is None:
+                self.thread = threading.Thread(
+                    target=self.run, name="download-timer", daemon=True
+                )
+                self.thread.start()
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.queue or self.queue[0][0] > time.monotonic():
+                    timeout = self.queue[0][0] - time.monotonic() if self.queue else None
+                    self.condition.wait(timeout)
+                _, _, function, args = heapq.heappop(self.queue)
+            try:
+                function(*args)
+            except Exception as e:
+                print(f"! Scheduled download failed: {e}")
+
+
+download_timer = DownloadTimer()
+
+
+def download_contents(urls, deadline=30):
+    """
+    Download the content of several URLs concurrently.
+    Pages whose host doesn't allow a request before the deadline are skipped.
+
+    :param urls: List of URLs to scrape
+    :param deadline: Total time in seconds allowed for all the downloads (default: 30)
+    :return: List of contents in the same order as the URLs. None for pages that failed or didn't finish before the deadline
+    """
+
+    end = time.monotonic() + deadline
+    futures = [ScheduledDownload(url, end).start() for url in urls]
+    done, not_done = wait(futures, timeout=deadline)
+
+    contents = []
+    for url, future in zip(urls, futures):
+        if future in not_done:
+            future.cancel()
+            print(f"  * Deadline reached, skipping {url}")
+            contents.append(None)
+            continue
+
+        try:
+            contents.append(future.result())
+        except Exception as e:
+            print(f"  ! Failed to download {url}: {e}")
+            contents.append(None)
+
+    return contents
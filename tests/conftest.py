@@ -0,0 +1,41 @@
+import os
+import sys
+
+import pytest
+
+# The modules are at the root of the repository, and check their API keys when imported
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+for name in ["OPENAI_API_KEY", "GOOGLE_API_KEY", "GOOGLE_SEARCH_ENGINE_ID"]:
+    os.environ.setdefault(name, "test")
+
+
+class WordEncoding:
+    """Encoding with one token per word, standing in for tiktoken which downloads its encoding"""
+
+    def encode_ordinary(self, text):
+        return text.split()
+
+    def decode(self, tokens):
+        return " ".join(tokens)
+
+
+@pytest.fixture(autouse=True)
+def word_tokenizer(monkeypatch):
+    import token_code
+
+    monkeypatch.setattr(token_code.tokenizer, "loaded_encoding", WordEncoding())
+    return token_code.tokenizer
+
+
+@pytest.fixture
+def stores(tmp_path, monkeypatch):
+    """Run in an empty directory, with empty answer, download and LLM caches"""
+    import cache_code
+    import llm_code
+
+    monkeypatch.chdir(tmp_path)
+    answer_store = cache_code.AnswerStore(str(tmp_path / "answers.sqlite"))
+    monkeypatch.setattr(llm_code, "answer_store", answer_store)
+    monkeypatch.setattr(cache_code, "download_caches", {})
+    monkeypatch.setattr(llm_code, "llm_cache", cache_code.LLMCache(str(tmp_path / "llm.sqlite")))
+    return answer_store
@@ -0,0 +1,57 @@
+import json
+import types
+
+import batch_code
+from llm_code import DefeatResponse, SearchResponse
+
+
+def fake_iter_assessment(questions, profile, graph, reassess=False):
+    yield {
+        "question": "What does it do?",
+        "question_id": "q1",
+        "answer": SearchResponse(
+            title="About",
+            found=0.75,
+            answer="It does things",
+            extract="It does things",
+            url="https://example.com/about",
+            search_queries=[],
+        ),
+        "label": "General",
+        "followup": False,
+        "number": "1",
+    }
+    # Questions the agent gave up on, or stopped by a budget, have no confidence nor URL
+    yield {
+        "question": "Is it certified?",
+        "question_id": "q2",
+        "answer": DefeatResponse(answer="No answer found"),
+        "label": "Compliance",
+        "followup": False,
+        "number": "2",
+    }
+
+
+def test_batch_with_defeated_answer(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    prompts = []
+    monkeypatch.setattr(batch_code, "iter_assessment", fake_iter_assessment)
+    monkeypatch.setattr(batch_code, "ask_llm", lambda prompt: prompts.append(prompt) or "Summary")
+    monkeypatch.setattr(batch_code, "build_graph", lambda: None)
+    monkeypatch.setattr(
+        batch_code.importlib,
+        "import_module",
+        lambda name: types.SimpleNamespace(prepare_questions=lambda profile: []),
+    )
+
+    profile = batch_code.Profile(company="Example", product="Product", url="https://example.com")
+    summary = batch_code.run_batch([profile], output_dir=str(tmp_path / "batch"))
+
+    assert summary["done"] == 1
+    assert summary["failed"] == 0
+    assert "Confidence in the answer: 0%" in prompts[0]
+
+    vendor_dir = tmp_path / "batch" / "example_product"
+    answers = json.loads((vendor_dir / "answers.json").read_text(encoding="utf-8"))
+    assert answers[1]["answer"] == {"answer": "No answer found"}
+    assert "No answer found" in (vendor_dir / "report.md").read_text(encoding="utf-8")
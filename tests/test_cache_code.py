@@ -0,0 +1,194 @@
+import os
+import time
+
+import cache_code
+from cache_code import AnswerStore, DownloadCache, LLMCache, SearchCache, normalize_query
+
+
+def stored_size(cache, table):
+    return cache.connection.execute(f"SELECT COALESCE(SUM(size), 0) FROM {table}").fetchone()[0]
+
+
+def test_answer_store(tmp_path):
+    store = AnswerStore(str(tmp_path / "answers.sqlite"))
+    answers = store.for_product("example", "product")
+    answers.put_many(
+        [
+            {
+                "question": "Q1",
+                "answer": {"answer": "first"},
+                "sources": {"https://example.com/a": "hash-a"},
+            },
+            {"question": "Q2", "answer": {"answer": "second"}, "followup": True},
+        ]
+    )
+
+    # Existing answers are kept, unless replaced
+    answers.put_many([{"question": "Q1", "answer": {"answer": "ignored"}}])
+    assert answers.get_many(["Q1", "Q2", "Q3"]) == {
+        "Q1": {"answer": "first"},
+        "Q2": {"answer": "second"},
+    }
+    assert answers.get_evidence(["Q1"])["Q1"]["sources"] == {"https://example.com/a": "hash-a"}
+
+    answers.put_many(
+        [
+            {
+                "question": "Q1",
+                "answer": {"answer": "replaced"},
+                "sources": {"https://example.com/b": "hash-b"},
+            }
+        ],
+        replace=True,
+    )
+    assert answers.get_many(["Q1"]) == {"Q1": {"answer": "replaced"}}
+    assert answers.get_evidence(["Q1"])["Q1"]["sources"] == {"https://example.com/b": "hash-b"}
+
+    # Products don't see the answers of each other
+    assert store.for_product("other", "product").get_many(["Q1"]) == {}
+
+
+def test_answer_store_imports_legacy_json_once(tmp_path):
+    path = tmp_path / "assessment_answers_example_product.json"
+    path.write_text('[{"question": "Q1", "answer": {"answer": "legacy"}}]', encoding="utf-8")
+    answers = AnswerStore(str(tmp_path / "answers.sqlite")).for_product("example", "product")
+
+    assert answers.import_json(str(path)) == 1
+    assert answers.import_json(str(path)) == 0
+    assert answers.get_many(["Q1"]) == {"Q1": {"answer": "legacy"}}
+
+
+def test_download_cache(tmp_path):
+    cache = DownloadCache(str(tmp_path / "downloads"))
+    cache.put("https://www.example.com/a", "Page A", "text/html", etag='"v1"')
+
+    entry = cache.get("https://www.example.com/a", max_age=60)
+    assert entry["content"] == "Page A"
+    assert entry["etag"] == '"v1"'
+    assert not entry["expired"]
+    assert cache.get("https://www.example.com/missing") is None
+
+    # Expired entries are only returned to be revalidated
+    cache.connection.execute("UPDATE entries SET created = 0")
+    assert cache.get("https://www.example.com/a", max_age=60) is None
+    assert cache.get("https://www.example.com/a", max_age=60, include_expired=True)["expired"]
+
+    cache.revalidate("https://www.example.com/a", etag='"v2"')
+    entry = cache.get("https://www.example.com/a", max_age=60)
+    assert entry["content"] == "Page A"
+    assert entry["etag"] == '"v2"'
+
+
+def test_download_cache_urls_by_domain(tmp_path):
+    cache = DownloadCache(str(tmp_path / "downloads"))
+    cache.put("https://www.example.com/a", "Page A", "text/html")
+    cache.put("https://docs.example.com/b", "Page B", "text/html")
+    cache.put("https://other.org/c", "Page C", "text/html")
+    since = time.time()
+    cache.put("https://example.com/d", "Page D", "text/html")
+
+    assert sorted(cache.urls(domain="example.com")) == [
+        "https://docs.example.com/b",
+        "https://example.com/d",
+        "https://www.example.com/a",
+    ]
+    assert cache.urls(domain="example.com", since=since) == ["https://example.com/d"]
+
+
+def test_download_cache_eviction(tmp_path):
+    cache = DownloadCache(str(tmp_path / "downloads"), max_size=2000)
+    for i in range(10):
+        # Random pages don't compress, so each one takes about 500 bytes
+        cache.put(f"https://example.com/{i}", os.urandom(450).hex(), "text/html")
+        assert cache.total_size() == stored_size(cache, "entries")
+
+    assert cache.total_size() <= 2000
+    assert cache.get("https://example.com/9") is not None
+    # The least recently used pages were evicted with their bodies
+    assert cache.get("https://example.com/0") is None
+    assert not os.path.exists(cache.body_path(cache.key("https://example.com/0")))
+
+
+def test_download_cache_total_of_existing_cache(tmp_path):
+    cache = DownloadCache(str(tmp_path / "downloads"))
+    cache.put("https://example.com/a", "Page A", "text/html")
+    cache.connection.execute("DROP TABLE total_size")
+
+    # A cache created before the running total starts from the sum of its entries
+    reopened = DownloadCache(str(tmp_path / "downloads"))
+    assert reopened.total_size() == stored_size(reopened, "entries") > 0
+
+
+def test_search_cache(tmp_path):
+    cache = SearchCache(str(tmp_path / "search"), ttl=60)
+    results = [{"title": "Security", "link": "https://example.com/security"}]
+    cache.put("Encryption  at rest site:b.com OR site:a.com", 3, results)
+
+    assert normalize_query("encryption at rest site:a.com OR site:b.com") == (
+        "encryption at rest site:a.com site:b.com"
+    )
+    assert cache.get("encryption AT rest site:a.com OR site:b.com", 3) == results
+    # The number of results is part of the key
+    assert cache.get("encryption at rest site:a.com OR site:b.com", 5) is None
+
+    cache.connection.execute("UPDATE searches SET created = 0")
+    assert cache.get("encryption at rest site:a.com OR site:b.com", 3) is None
+    assert cache.stats()["hits"] == 1
+
+
+def test_llm_cache(tmp_path):
+    cache = LLMCache(str(tmp_path / "llm.sqlite"), ttl=60, max_size=0)
+    cache.put("key", "gpt-4o", '{"content": "cached"}')
+
+    assert cache.get("key") == '{"content": "cached"}'
+    assert cache.get("missing") is None
+
+    cache.connection.execute("UPDATE responses SET created = 0")
+    assert cache.get("key") is None
+    assert cache.stats() == {"hits": 1, "misses": 2, "hit_rate": 1 / 3}
+
+
+def test_llm_cache_access_updates_are_limited(tmp_path):
+    cache = LLMCache(str(tmp_path / "llm.sqlite"), ttl=60)
+    cache.put("key", "gpt-4o", "response")
+    cache.connection.execute("UPDATE responses SET accessed = 0")
+
+    for _ in range(3):
+        cache.get("key")
+
+    # Only the first hit was written, the next ones wait for the access time to be old enough
+    row = cache.connection.execute("SELECT accessed, hits FROM responses").fetchone()
+    assert row[0] > 0 and row[1] == 1
+    assert cache.pending_hits == {"key": 2}
+
+
+def test_llm_cache_eviction(tmp_path):
+    cache = LLMCache(str(tmp_path / "llm.sqlite"), ttl=60, max_size=0)
+    cache.put("oldest", "gpt-4o", "a")
+    cache.put("expired", "gpt-4o", os.urandom(1800).hex())
+    cache.put("recent", "gpt-4o", "c")
+    cache.connection.execute("UPDATE responses SET created = 0 WHERE key = 'expired'")
+    assert cache.total_size() == stored_size(cache, "responses")
+
+    cache.max_size = cache.total_size() + 100
+    cache.put("new", "gpt-4o", os.urandom(450).hex())
+
+    # The expired response is enough to get under the limit, the least recently used is kept
+    keys = {row[0] for row in cache.connection.execute("SELECT key FROM responses")}
+    assert keys == {"oldest", "recent", "new"}
+    assert cache.total_size() == stored_size(cache, "responses") <= cache.max_size
+
+
+def test_llm_cache_recording_date(tmp_path):
+    cache = LLMCache(str(tmp_path / "llm.sqlite"))
+    assert cache.recording_date("example_product") is None
+
+    cache.set_recording_date("example_product", "2025-01-01")
+    cache.set_recording_date("example_product", "2025-01-02")
+    assert cache.recording_date("example_product") == "2025-01-02"
+
+
+def test_download_caches_are_shared(tmp_path, monkeypatch):
+    monkeypatch.setattr(cache_code, "download_caches", {})
+    directory = str(tmp_path / "downloads")
+    assert cache_code.get_download_cache(directory) is cache_code.get_download_cache(directory)
@@ -0,0 +1,241 @@
+import time
+import threading
+import contextvars
+
+import pytest
+
+import llm_code
+from benchmark_code import ScriptedChatModel
+from llm_code import SearchResponse
+
+PROFILE = {"company": "Example", "product": "Scheduler", "url": "https://example.com"}
+
+
+def response(text, url=""):
+    return SearchResponse(
+        title=text[:60],
+        found=0.75,
+        answer=text,
+        extract=text,
+        url=url,
+        search_queries=[],
+    )
+
+
+class FakeAgent:
+    """Stand-in for find_answer_to_question, recording when each question runs and its context"""
+
+    def __init__(self, latency=0.05, answers=None):
+        self.latency = latency
+        self.answers = answers or {}
+        self.lock = threading.Lock()
+        self.active = 0
+        self.max_active = 0
+        self.calls = {}
+
+    def __call__(self, graph, question, previous_answers, profile, domain):
+        with self.lock:
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+            start = time.monotonic()
+        time.sleep(self.latency)
+        with self.lock:
+            self.active -= 1
+            self.calls[question["main"]] = {
+                "start": start,
+                "end": time.monotonic(),
+                "previous": [row["question"] for row in previous_answers],
+                "depends_on": question.get("depends_on", []),
+            }
+        return response(self.answers.get(question["main"], f"Answer to {question['main']}"))
+
+
+@pytest.fixture
+def agent(stores, monkeypatch):
+    fake = FakeAgent()
+    monkeypatch.setattr(llm_code, "find_answer_to_question", fake)
+    return fake
+
+
+QUESTIONS = [
+    {"id": "hosting", "main": "Where is it hosted?"},
+    {"id": "sso", "main": "Does it support SSO?"},
+    {"main": "Which hosting region?", "depends_on": ["hosting"]},
+    {"main": "Is SSO enforced on hosted data?", "depends_on": ["hosting", "sso"]},
+]
+
+
+def test_question_dependencies():
+    assert llm_code.question_dependencies(QUESTIONS) == {0: [], 1: [], 2: [0], 3: [0, 1]}
+
+    with pytest.raises(ValueError, match="Unknown dependency"):
+        llm_code.question_dependencies([{"main": "Q", "depends_on": ["missing"]}])
+
+    # A question can't depend on a later question, to keep the order of the report
+    with pytest.raises(ValueError, match="must be asked before"):
+        llm_code.question_dependencies(
+            [{"main": "Q1", "depends_on": ["q2"]}, {"id": "q2", "main": "Q2"}]
+        )
+
+
+def test_concurrent_questions_wait_for_their_dependencies(agent):
+    answers = llm_code.answer_all_questions(
+        QUESTIONS, None, PROFILE, "example.com", max_workers=4
+    )
+
+    assert [row["question"] for row in answers] == [q["main"] for q in QUESTIONS]
+    assert agent.max_active >= 2
+
+    calls = agent.calls
+    hosting, sso, region, enforced = [calls[q["main"]] for q in QUESTIONS]
+    assert region["start"] >= hosting["end"]
+    assert enforced["start"] >= max(hosting["end"], sso["end"])
+    # Questions only get the answers of the questions they depend on
+    assert sso["previous"] == []
+    assert region["previous"] == ["Where is it hosted?"]
+    assert enforced["previous"] == ["Where is it hosted?", "Does it support SSO?"]
+
+
+def test_sequential_questions_get_every_previous_answer(agent):
+    answers = llm_code.answer_all_questions(
+        QUESTIONS, None, PROFILE, "example.com", max_workers=1
+    )
+
+    assert [row["question"] for row in answers] == [q["main"] for q in QUESTIONS]
+    assert agent.max_active == 1
+    assert agent.calls["Is SSO enforced on hosted data?"]["previous"] == [
+        q["main"] for q in QUESTIONS[:3]
+    ]
+
+
+def test_cached_answers_are_not_asked_again(agent):
+    llm_code.answer_all_questions(QUESTIONS, None, PROFILE, "example.com")
+    agent.calls.clear()
+
+    answers = llm_code.answer_all_questions(QUESTIONS, None, PROFILE, "example.com")
+
+    assert agent.calls == {}
+    assert answers[0]["answer"].answer == "Answer to Where is it hosted?"
+
+
+def test_followups_fan_out(agent):
+    question = {
+        "id": "processors",
+        "main": "Which sub-processors are used?",
+        "function": lambda parameter, context: ["Stripe", "Datadog", "Stripe"],
+        "followup": ["Is PLACEHOLDER certified?", "Where does PLACEHOLDER store data?"],
+    }
+
+    answers = llm_code.answer_all_questions([question], None, PROFILE, "example.com")
+
+    followups = [row["question"] for row in answers if row["followup"]]
+    assert followups == [
+        "Is Stripe certified?",
+        "Is Datadog certified?",
+        "Where does Stripe store data?",
+        "Where does Datadog store data?",
+    ]
+    assert all(row["question_id"] == "processors" for row in answers)
+    # The follow-ups run in parallel, with the answer of their question as context
+    assert agent.max_active >= 2
+    for followup in followups:
+        assert agent.calls[followup]["previous"] == ["Which sub-processors are used?"]
+        assert agent.calls[followup]["depends_on"] == ["processors"]
+
+    answer_cache = llm_code.answer_store.for_product("example", "scheduler")
+    assert set(answer_cache.get_many(followups)) == set(followups)
+
+
+class RecordingExtractor:
+    """Stand-in for extract_entities, recording the size of each batch"""
+
+    def __init__(self, latency=0.0, error=None):
+        self.latency = latency
+        self.error = error
+        self.batches = []
+
+    def __call__(self, requests):
+        self.batches.append(len(requests))
+        time.sleep(self.latency)
+        if self.error:
+            raise self.error
+        return [[parameter.upper()] for parameter, context in requests]
+
+
+def extract_concurrently(batcher, parameters):
+    results = {}
+
+    def extract(parameter):
+        llm_code.concurrent_questions.set(len(parameters))
+        results[parameter] = batcher.extract(parameter, f"Context of {parameter}")
+
+    threads = [threading.Thread(target=extract, args=(p,)) for p in parameters]
+    for thread in threads:
+        thread.start()
+        time.sleep(0.01)
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def test_extractions_are_batched(monkeypatch):
+    extractor = RecordingExtractor()
+    monkeypatch.setattr(llm_code, "extract_entities", extractor)
+    batcher = llm_code.ExtractionBatcher(window=1, max_size=3, timeout=5)
+
+    start = time.monotonic()
+    results = extract_concurrently(batcher, ["a", "b", "c"])
+
+    assert results == {"a": ["A"], "b": ["B"], "c": ["C"]}
+    assert extractor.batches == [3]
+    # A full batch is sent without waiting for the end of the window
+    assert time.monotonic() - start < 1
+
+
+def test_sequential_extraction_does_not_wait(monkeypatch):
+    extractor = RecordingExtractor()
+    monkeypatch.setattr(llm_code, "extract_entities", extractor)
+    batcher = llm_code.ExtractionBatcher(window=1, max_size=3, timeout=5)
+
+    def extract():
+        # Set by the scheduler when the questions are asked one at a time
+        llm_code.concurrent_questions.set(1)
+        return batcher.extract("a", "Context")
+
+    start = time.monotonic()
+    assert contextvars.copy_context().run(extract) == ["A"]
+    assert time.monotonic() - start < 0.5
+
+
+def test_failed_extractions_return_none(monkeypatch):
+    monkeypatch.setattr(
+        llm_code, "extract_entities", RecordingExtractor(error=RuntimeError("API down"))
+    )
+    batcher = llm_code.ExtractionBatcher(window=0.2, max_size=3, timeout=5)
+
+    assert extract_concurrently(batcher, ["a", "b"]) == {"a": None, "b": None}
+
+
+def test_extraction_timeout_returns_none(monkeypatch):
+    monkeypatch.setattr(llm_code, "extract_entities", RecordingExtractor(latency=1))
+    batcher = llm_code.ExtractionBatcher(window=0.1, max_size=3, timeout=0.3)
+
+    results = extract_concurrently(batcher, ["a", "b", "c"])
+
+    # The first request sends the batch, the others give up waiting for it
+    assert results == {"a": ["A"], "b": None, "c": None}
+
+
+def test_extract_entities_with_scripted_model(monkeypatch):
+    model = ScriptedChatModel(model="gpt-4o-mini")
+    monkeypatch.setattr(llm_code, "small_llm", model)
+    monkeypatch.setattr(llm_code, "llm", model)
+
+    results = llm_code.extract_entities(
+        [
+            ("sub-processors", "We use Stripe for payments and Datadog for logs."),
+            ("regions", "Data is hosted in Frankfurt."),
+        ]
+    )
+
+    assert results == [["Stripe", "Datadog"], ["Data", "Frankfurt"]]
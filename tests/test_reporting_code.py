@@ -0,0 +1,49 @@
+import pytest
+
+import llm_code
+from benchmark_code import ScriptedChatModel
+from constants import LLM_MODEL_PRICES, PROMPT_CACHE_MIN_TOKENS
+from reporting_code import calculate_token_counts
+
+
+@pytest.fixture
+def scripted_model():
+    ScriptedChatModel.prompt_cache.clear()
+    model = ScriptedChatModel(model="gpt-4o")
+    yield model.bind_tools([llm_code.search_google, llm_code.search_response])
+    ScriptedChatModel.prompt_cache.clear()
+
+
+def test_cached_input_tokens_are_priced(scripted_model):
+    profile = {"company": "Example", "product": "Costs", "url": "https://example.com"}
+    llm_code.reset_token_counts(profile)
+
+    system_prompt = "Stable instructions. " * PROMPT_CACHE_MIN_TOKENS
+    for question in ["Is data encrypted?", "Is there an SSO?"]:
+        llm_code.invoke_llm(
+            scripted_model,
+            [("system", system_prompt), ("human", f"Question: {question}")],
+            node="agent",
+        )
+
+    report = calculate_token_counts(profile)
+    model = report["models"][0]
+    price = LLM_MODEL_PRICES["gpt-4o"]
+    cached = len(system_prompt) // 4
+
+    # Only the second call starts with a prefix already sent
+    assert model["calls"] == 2
+    assert model["cached_input"] == cached
+    assert model["cached_input_price"] == pytest.approx(price["cached_input"] * cached / 1000000)
+    assert model["input_price"] == pytest.approx(
+        price["input"] * (model["input"] - cached) / 1000000
+        + price["cached_input"] * cached / 1000000
+    )
+    assert model["input_price"] < price["input"] * model["input"] / 1000000
+
+
+def test_prompt_cache_needs_a_long_prefix(scripted_model):
+    short = [("system", "Short instructions"), ("human", "Question: Is data encrypted?")]
+    scripted_model.invoke(short)
+    response = scripted_model.invoke(short)
+    assert response.usage_metadata["input_token_details"]["cache_read"] == 0
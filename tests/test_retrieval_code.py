@@ -0,0 +1,65 @@
+import llm_code
+from retrieval_code import chunk_ranges, merge_ranges, select_chunks
+from trace_code import tracer
+
+FILLER = "cookies navigation menu login pricing careers blog " * 4
+
+
+def test_chunk_and_merge_ranges():
+    assert chunk_ranges(10, 4) == [(0, 4), (4, 8), (8, 10)]
+    assert merge_ranges([(8, 10), (0, 4), (4, 8), (12, 14)]) == [(0, 10), (12, 14)]
+
+
+def test_select_chunks_keeps_the_relevant_chunks(word_tokenizer):
+    pages = [
+        FILLER + "keys are encrypted with AES and rotated yearly " + FILLER,
+        FILLER + FILLER + "encryption keys are stored in an HSM",
+    ]
+    tokens = word_tokenizer.encode_batch(pages)
+
+    selections = select_chunks(tokens, "encryption keys", 16, word_tokenizer, chunk_size=8)
+
+    kept = [
+        word_tokenizer.decode(page[start:end])
+        for page, ranges in zip(tokens, selections)
+        for start, end in ranges
+    ]
+    assert sum(end - start for ranges in selections for start, end in ranges) <= 16
+    assert any("keys are encrypted" in text for text in kept)
+    assert any("HSM" in text for text in kept)
+    assert not any(text.startswith("cookies") and "keys" not in text for text in kept)
+
+
+def test_select_chunks_without_matches_keeps_the_beginning_of_pages(word_tokenizer):
+    tokens = word_tokenizer.encode_batch([FILLER, FILLER])
+
+    selections = select_chunks(tokens, "encryption", 16, word_tokenizer, chunk_size=8)
+
+    assert selections == [[(0, 8)], [(0, 8)]]
+
+
+def test_search_google_stays_within_the_budget(word_tokenizer, monkeypatch):
+    pages = {
+        "https://example.com/policy": FILLER * 20 + "data is encrypted at rest with AES",
+        "https://example.com/blog": FILLER * 20,
+    }
+    monkeypatch.setattr(
+        llm_code,
+        "google_search",
+        lambda query, num_results: [{"title": url, "link": url} for url in pages],
+    )
+    monkeypatch.setattr(
+        llm_code, "download_contents", lambda urls, deadline: [pages[url] for url in urls]
+    )
+    monkeypatch.setattr(llm_code, "SEARCH_TOKEN_BUDGET", 300)
+
+    with tracer.start_trace("search test") as root:
+        result = llm_code.search_google.invoke({"query": "encrypted at rest"})
+    search_span = next(
+        s for s in tracer.trace_spans(root["trace"]) if s["name"] == "tool.search_google"
+    )
+    tracer.drop(root["trace"])
+
+    assert "encrypted at rest with AES" in result
+    assert "Kept tokens:" in result
+    assert search_span["attributes"]["tokens"] <= 300
@@ -0,0 +1,61 @@
+import time
+
+import pytest
+
+import search_code
+from benchmark_code import serve_fixtures
+
+PAGES = ["trust_center.html", "privacy_policy.html", "docs_integrations.html"]
+
+
+@pytest.fixture
+def fixture_server(stores):
+    server, handler = serve_fixtures()
+    yield server.server_address[1], handler
+    server.shutdown()
+
+
+def test_download_contents(fixture_server, monkeypatch):
+    port, handler = fixture_server
+    monkeypatch.setattr(
+        search_code.host_rate_limiter, "host_limits", {"127.0.0.1": {"rate": 1000, "burst": 1000}}
+    )
+    monkeypatch.setattr(search_code.host_rate_limiter, "buckets", {})
+    urls = [f"http://127.0.0.1:{port}/{page}" for page in PAGES]
+
+    contents = search_code.download_contents(urls, deadline=10)
+
+    assert all(content for content in contents)
+    assert handler.requests == 3
+
+    # The pages are now cached
+    assert search_code.download_contents(urls, deadline=10) == contents
+    assert handler.requests == 3
+
+
+def test_rate_limited_host_does_not_delay_other_hosts(fixture_server, monkeypatch):
+    port, handler = fixture_server
+    # Both names reach the fixture server, but "localhost" gets one request every 2 seconds
+    monkeypatch.setattr(
+        search_code.host_rate_limiter,
+        "host_limits",
+        {
+            "127.0.0.1": {"rate": 1000, "burst": 1000},
+            "localhost": {"rate": 0.5, "burst": 1},
+        },
+    )
+    monkeypatch.setattr(search_code.host_rate_limiter, "buckets", {})
+    slow_urls = [f"http://localhost:{port}/{page}?{i}" for i in range(4) for page in PAGES]
+    fast_urls = [f"http://127.0.0.1:{port}/{page}" for page in PAGES]
+
+    start = time.monotonic()
+    futures = [search_code.ScheduledDownload(url, start + 3).start() for url in slow_urls]
+    fast_contents = search_code.download_contents(fast_urls, deadline=3)
+
+    # The backlog of the slow host doesn't hold the workers needed by the other host
+    assert all(fast_contents)
+    assert time.monotonic() - start < 1
+
+    # The slow host is downloaded until its next request would be after the deadline
+    results = [future.result(timeout=5) for future in futures]
+    assert sum(result is not None for result in results) == 2
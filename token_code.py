@@ -0,0 +1,321 @@
+import re
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+
+import tiktoken
+
+from constants import (
+    LLM_MODEL_PRICES,
+    QUESTION_TOKEN_BUDGET,
+    QUESTION_COST_BUDGET,
+    ASSESSMENT_TOKEN_BUDGET,
+    ASSESSMENT_COST_BUDGET,
+)
+
+ENCODING_NAME = "cl100k_base"
+
+# The tiktoken pre-tokenizer never joins a newline with the non-blank character that follows it,
+# so a text can be encoded block by block at these boundaries and give the same tokens.
+BLOCK_BOUNDARY = re.compile(r"(?<=\n)(?=\S)")
+BLOCK_SIZE = 8000
+
+
+class Tokenizer:
+    """
+    Tokenizer loading its encoding once, and returning token IDs that can be reused
+    to count and truncate a text without encoding it again.
+    """
+
+    def __init__(self, encoding_name=ENCODING_NAME, num_threads=8):
+        self.encoding_name = encoding_name
+        self.num_threads = num_threads
+        self.loaded_encoding = None
+        self.lock = threading.Lock()
+
+    @property
+    def encoding(self):
+        with self.lock:
+            if self.loaded_encoding is None:
+                self.loaded_encoding = tiktoken.get_encoding(self.encoding_name)
+            return self.loaded_encoding
+
+    def blocks(self, text):
+        """Split the text in blocks of about BLOCK_SIZE characters, cut at safe boundaries"""
+        start = 0
+        while start < len(text):
+            end = start + BLOCK_SIZE
+            if end < len(text):
+                boundary = BLOCK_BOUNDARY.search(text, end)
+                end = boundary.start() if boundary else len(text)
+            yield text[start:end]
+            start = end
+
+    def encode(self, text, stop_after=None):
+        """
+        Return the token IDs of the text.
+
+        :param text: Text to encode
+        :param stop_after: If set, stop encoding as soon as more than this number of tokens is found.
+            The result is then incomplete, but its length tells that the text is over the limit.
+        :return: List of token IDs
+        """
+        encoding = self.encoding
+        if stop_after is None:
+            return encoding.encode_ordinary(text)
+
+        tokens = []
+        for block in self.blocks(text):
+            tokens.extend(encoding.encode_ordinary(block))
+            if len(tokens) > stop_after:
+                break
+        return tokens
+
+    def encode_batch(self, texts, stop_after=None):
+        """Encode several texts in parallel. See encode for the parameters."""
+        if len(texts) <= 1:
+            return [self.encode(text, stop_after) for text in texts]
+
+        with ThreadPoolExecutor(max_workers=self.num_threads) as executor:
+            return list(executor.map(lambda text: self.encode(text, stop_after), texts))
+
+    def count(self, text):
+        return len(self.encode(text))
+
+    def decode(self, tokens):
+        return self.encoding.decode(tokens)
+
+    def truncate(self, text, max_tokens):
+        """Truncate the text to max_tokens, encoding only what is needed"""
+        tokens = self.encode(text, stop_after=max_tokens)
+        if len(tokens) <= max_tokens:
+            return text
+        return self.decode(tokens[:max_tokens])
+
+
+tokenizers = {}
+tokenizers_lock = threading.Lock()
+
+
+def get_tokenizer(encoding_name=ENCODING_NAME):
+    """Return the tokenizer of the encoding, shared by the whole process"""
+    with tokenizers_lock:
+        if encoding_name not in tokenizers:
+            tokenizers[encoding_name] = Tokenizer(encoding_name)
+        return tokenizers[encoding_name]
+
+
+tokenizer = get_tokenizer()
+
+
+# Assessment and question the LLM calls of the current thread or asyncio task are made for
+current_assessment = contextvars.ContextVar("current_assessment", default=None)
+current_question = contextvars.ContextVar("current_question", default=None)
+
+
+def model_price(model):
+    # example: gpt-4o-2024-05-13
+    sections = model.split("-")
+
+    model_name = model
+    for i in range(len(sections), 0, -1):
+        model_name = "-".join(sections[:i])
+        if model_name in LLM_MODEL_PRICES:
+            break
+
+    if model_name not in LLM_MODEL_PRICES:
+        model_name = list(LLM_MODEL_PRICES.keys())[0]
+
+    return LLM_MODEL_PRICES[model_name]
+
+
+def usage_cost(model, input_tokens, cached_input_tokens, output_tokens):
+    """Return the price in dollars of the tokens used by a call"""
+    price = model_price(model)
+    cost = price["input"] * (input_tokens - cached_input_tokens)
+    cost += price.get("cached_input", price["input"]) * cached_input_tokens
+    cost += price["output"] * output_tokens
+    return cost / 1000000
+
+
+class TokenLedger:
+    """
+    Token usage and costs per assessment, question, graph node and model.
+
+    Safe to use from several threads and asyncio tasks. Budgets in tokens or dollars can be
+    set per question and per assessment, and are checked with budget_exhausted.
+    """
+
+    counters = [
+        "calls",
+        "input",
+        "cached_input",
+        "output",
+        "total",
+        "cost",
+        "escalations",
+        "cache_hits",
+        "saved_cost",
+    ]
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.usage = {}
+        self.default_assessment = None
+        self.escalations = []
+        self.question_budget = {
+            "tokens": QUESTION_TOKEN_BUDGET,
+            "cost": QUESTION_COST_BUDGET,
+        }
+        self.assessment_budget = {
+            "tokens": ASSESSMENT_TOKEN_BUDGET,
+            "cost": ASSESSMENT_COST_BUDGET,
+        }
+
+    def start_assessment(self, assessment):
+        """Clear the usage of the assessment, and use it for calls made outside of any assessment context"""
+        with self.lock:
+            self.usage = {k: v for k, v in self.usage.items() if k[0] != assessment}
+            self.escalations = [
+                e for e in self.escalations if e["assessment"] != assessment
+            ]
+            self.default_assessment = assessment
+        current_assessment.set(assessment)
+
+    def record(
+        self,
+        model,
+        input_tokens,
+        cached_input_tokens,
+        output_tokens,
+        total_tokens,
+        node=None,
+        question=None,
+        assessment=None,
+    ):
+        assessment = assessment or current_assessment.get() or self.default_assessment
+        question = question or current_question.get()
+        key = (assessment, question, node, model)
+        cost = usage_cost(model, input_tokens, cached_input_tokens, output_tokens)
+
+        with self.lock:
+            if key not in self.usage:
+                self.usage[key] = {counter: 0 for counter in self.counters}
+            usage = self.usage[key]
+            usage["calls"] += 1
+            usage["input"] += input_tokens
+            usage["cached_input"] += cached_input_tokens
+            usage["output"] += output_tokens
+            usage["total"] += total_tokens
+            usage["cost"] += cost
+
+    def record_cache_hit(
+        self,
+        model,
+        input_tokens,
+        cached_input_tokens,
+        output_tokens,
+        node=None,
+        question=None,
+        assessment=None,
+    ):
+        """Record a call answered by the LLM response cache, as a call without tokens nor cost"""
+        assessment = assessment or current_assessment.get() or self.default_assessment
+        question = question or current_question.get()
+        key = (assessment, question, node, model)
+        saved = usage_cost(model, input_tokens, cached_input_tokens, output_tokens)
+
+        with self.lock:
+            if key not in self.usage:
+                self.usage[key] = {counter: 0 for counter in self.counters}
+            usage = self.usage[key]
+            usage["calls"] += 1
+            usage["cache_hits"] += 1
+            usage["saved_cost"] += saved
+
+    def record_escalation(self, model, reason, question=None, assessment=None):
+        """Record that a call of the model was escalated to a larger model, and why"""
+        assessment = assessment or current_assessment.get() or self.default_assessment
+        question = question or current_question.get()
+        key = (assessment, question, "escalation", model)
+
+        with self.lock:
+            if key not in self.usage:
+                self.usage[key] = {counter: 0 for counter in self.counters}
+            self.usage[key]["escalations"] += 1
+            self.escalations.append(
+                {
+                    "assessment": assessment,
+                    "question": question,
+                    "model": model,
+                    "reason": reason,
+                }
+            )
+
+    def escalations_of(self, assessment):
+        with self.lock:
+            return [e for e in self.escalations if e["assessment"] == assessment]
+
+    def totals(self, group_by="model", assessment=None, question=None):
+        """
+        Sum the usage, optionally filtered by assessment and question.
+
+        :param group_by: "model", "question", "node" or "assessment"
+        :return: Dictionary of counters per group
+        """
+        position = ["assessment", "question", "node", "model"].index(group_by)
+        totals = {}
+        with self.lock:
+            for key, usage in self.usage.items():
+                if assessment is not None and key[0] != assessment:
+                    continue
+                if question is not None and key[1] != question:
+                    continue
+                group = totals.setdefault(
+                    key[position], {counter: 0 for counter in self.counters}
+                )
+                for counter in self.counters:
+                    group[counter] += usage[counter]
+        return totals
+
+    def set_budgets(self, question=None, assessment=None):
+        """
+        Set the budgets, as dictionaries with "tokens" and "cost" limits. None or 0 means no limit.
+        """
+        with self.lock:
+            if question is not None:
+                self.question_budget = question
+            if assessment is not None:
+                self.assessment_budget = assessment
+
+    def budget_exhausted(self, question=None, assessment=None):
+        """Return a message if the budget of the question or the assessment is exhausted, else None"""
+        assessment = assessment or current_assessment.get() or self.default_assessment
+        question = question or current_question.get()
+
+        checks = [("assessment", self.assessment_budget, {"assessment": assessment})]
+        if question:
+            checks.append(
+                (
+                    "question",
+                    self.question_budget,
+                    {"assessment": assessment, "question": question},
+                )
+            )
+
+        for scope, budget, filters in checks:
+            if not budget.get("tokens") and not budget.get("cost"):
+                continue
+            used = {"tokens": 0, "cost": 0}
+            for usage in self.totals(**filters).values():
+                used["tokens"] += usage["total"]
+                used["cost"] += usage["cost"]
+            if budget.get("tokens") and used["tokens"] >= budget["tokens"]:
+                return f"Token budget of the {scope} exhausted ({used['tokens']}/{budget['tokens']} tokens)"
+            if budget.get("cost") and used["cost"] >= budget["cost"]:
+                return f"Cost budget of the {scope} exhausted ({used['cost']:0.2f}/{budget['cost']:0.2f}$)"
+
+        return None
+
+
+token_ledger = TokenLedger()
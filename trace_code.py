@@ -0,0 +1,172 @@
+import os
+import json
+import time
+import threading
+import functools
+import itertools
+import contextvars
+from contextlib import contextmanager
+
+from constants import TRACE_DIR, TRACE_FORMAT
+
+# Span the code of the current thread or asyncio task runs in
+current_span = contextvars.ContextVar("current_span", default=None)
+
+
+class Tracer:
+    """
+    Spans of the stages of the assessments: questions, graph nodes, LLM calls, searches,
+    downloads, parsing and tokenisation.
+
+    Each span records its parent, so the spans of a question form a tree. Spans started
+    outside of any other span are the roots of their own trace. Worker threads must run
+    in a copy of the context of the caller (contextvars.copy_context) to keep the parent.
+
+    Finished spans are kept per trace until the trace is dropped, or replaced by a new
+    trace started with the same name and attributes.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # Finished spans of each trace, and root span of each finished trace, by trace id
+        self.traces = {}
+        self.roots = {}
+        self.ids = itertools.count(1)
+
+    @contextmanager
+    def span(self, name, **attributes):
+        parent = current_span.get()
+        with self.lock:
+            span_id = next(self.ids)
+        span = {
+            "id": span_id,
+            "parent": parent["id"] if parent else None,
+            "trace": parent["trace"] if parent else span_id,
+            "name": name,
+            "start": time.time(),
+            "duration": 0,
+            "thread": threading.get_ident(),
+            "attributes": attributes,
+        }
+
+        token = current_span.set(span)
+        start = time.perf_counter()
+        try:
+            yield span
+        except BaseException as e:
+            span["error"] = repr(e)
+            raise
+        finally:
+            span["duration"] = time.perf_counter() - start
+            current_span.reset(token)
+            with self.lock:
+                self.traces.setdefault(span["trace"], []).append(span)
+                if span["parent"] is None:
+                    self.roots[span["trace"]] = span
+
+    def start_trace(self, name, **attributes):
+        """
+        Start the root span of a new trace, dropping the previous traces started with the
+        same name and attributes, for example the previous run of the same assessment.
+        """
+        with self.lock:
+            previous = [
+                trace
+                for trace, root in self.roots.items()
+                if root["name"] == name and root["attributes"] == attributes
+            ]
+        for trace in previous:
+            self.drop(trace)
+        return self.span(name, **attributes)
+
+    def drop(self, trace):
+        """Forget the spans of a trace, once it is exported and reported"""
+        with self.lock:
+            self.traces.pop(trace, None)
+            self.roots.pop(trace, None)
+
+    def trace_spans(self, trace):
+        """Return the spans of a trace, in the order they started"""
+        with self.lock:
+            spans = list(self.traces.get(trace, []))
+        return sorted(spans, key=lambda s: s["start"])
+
+    def find_trace(self, name, **attributes):
+        """Return the id of the last finished trace whose root span has this name and these attributes"""
+        with self.lock:
+            for trace, root in reversed(list(self.roots.items())):
+                if root["name"] == name and root["attributes"] == attributes:
+                    return trace
+        return None
+
+    def export_jsonl(self, trace, path):
+        with open(path, "w", encoding="utf-8") as f:
+            for span in self.trace_spans(trace):
+                f.write(json.dumps(span, ensure_ascii=False, default=str) + "\n")
+
+    def export_chrome_trace(self, trace, path):
+        """Export a trace in the Chrome trace event format, readable by chrome://tracing and Perfetto"""
+        events = []
+        for span in self.trace_spans(trace):
+            args = {"id": span["id"], "parent": span["parent"], **span["attributes"]}
+            if "error" in span:
+                args["error"] = span["error"]
+            events.append(
+                {
+                    "name": span["name"],
+                    "cat": span["name"].split(".")[0],
+                    "ph": "X",
+                    "ts": span["start"] * 1000000,
+                    "dur": span["duration"] * 1000000,
+                    "pid": os.getpid(),
+                    "tid": span["thread"],
+                    "args": args,
+                }
+            )
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(
+                {"traceEvents": events, "displayTimeUnit": "ms"},
+                f,
+                ensure_ascii=False,
+                default=str,
+            )
+
+    def export(self, trace, name, trace_dir=TRACE_DIR, trace_format=TRACE_FORMAT):
+        """
+        Save a trace in trace_dir, as JSON lines ("jsonl") or Chrome trace ("chrome").
+
+        :return: Path of the file, or None when trace_dir is empty
+        """
+        if not trace_dir:
+            return None
+        os.makedirs(trace_dir, exist_ok=True)
+
+        if trace_format == "chrome":
+            path = os.path.join(trace_dir, f"{name}.trace.json")
+            self.export_chrome_trace(trace, path)
+        else:
+            path = os.path.join(trace_dir, f"{name}.jsonl")
+            self.export_jsonl(trace, path)
+        return path
+
+
+tracer = Tracer()
+
+
+def span(name, **attributes):
+    """Context manager timing a stage, as a child of the current span"""
+    return tracer.span(name, **attributes)
+
+
+def traced(name):
+    """Decorator timing every call of a function as a span"""
+
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with tracer.span(name):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator